@@ -0,0 +1,152 @@
+# benchmark of the rch solver on generated inputs
+# usage: python benchmark.py [--iterations N] [--seed S] [--scenario NAME] [--out results.json] [--compare baseline.json]
+
+
+import argparse
+import tracemalloc
+import random
+import copy
+import json
+import time
+import debug_utils
+import rch
+
+
+'''
+generated inputs, sizes are in the input units (before scaling)
+unit = every dimension is a multiple of it (unit 1 gives gcd-unfriendly dimensions, so nothing is scaled down)
+rotate / stack = ratio of the package types that can be rotated / stacked above
+'''
+SCENARIOS = [
+    { 'name': 'small-uniform',        'container': (100, 80, 60),   'items': 40,  'types': 2,  'rotate': 1.0, 'stack': 1.0, 'unit': 10 },
+    { 'name': 'small-mixed',          'container': (100, 80, 60),   'items': 60,  'types': 8,  'rotate': 0.5, 'stack': 0.7, 'unit': 5 },
+    { 'name': 'medium-mixed',         'container': (240, 120, 120), 'items': 150, 'types': 12, 'rotate': 0.5, 'stack': 0.7, 'unit': 5 },
+    { 'name': 'medium-no-rotate',     'container': (240, 120, 120), 'items': 150, 'types': 12, 'rotate': 0.0, 'stack': 0.7, 'unit': 5 },
+    { 'name': 'medium-no-stack',      'container': (240, 120, 120), 'items': 150, 'types': 12, 'rotate': 0.5, 'stack': 0.0, 'unit': 5 },
+    { 'name': 'medium-gcd-1',         'container': (241, 119, 121), 'items': 150, 'types': 12, 'rotate': 0.5, 'stack': 0.7, 'unit': 1 },
+    { 'name': 'large-heterogeneous',  'container': (1200, 240, 260), 'items': 400, 'types': 60, 'rotate': 0.5, 'stack': 0.7, 'unit': 10 },
+]
+
+
+def generate_input(scenario: dict, seed: int) -> dict:
+    rng = random.Random(seed)
+    unit = scenario['unit']
+    container = scenario['container']
+    packages = []
+    amounts = [1] * scenario['types']
+    for _ in range(scenario['items'] - scenario['types']):
+        amounts[rng.randrange(scenario['types'])] += 1
+    for i, amount in enumerate(amounts):
+        # each dimension is between 1/12 and 1/3 of the container dimension
+        width, depth, height = [max(unit, rng.randint(c // 12, c // 3) // unit * unit) for c in container]
+        packages.append({
+            'type': f'type-{i}',
+            'width': width,
+            'depth': depth,
+            'height': height,
+            'weight': rng.randint(1, 50),
+            'profit': rng.randint(1, 100),
+            'priority': rng.randint(1, 10),
+            'amount': amount,
+            'canRotate': rng.random() < scenario['rotate'],
+            'canStackAbove': rng.random() < scenario['stack'],
+        })
+    return {
+        'container': { 'width': container[0], 'depth': container[1], 'height': container[2], 'maxWeight': 25 * scenario['items'] },
+        'packages': packages,
+    }
+
+
+def run_scenario(scenario: dict, iterations: int, seed: int) -> dict:
+    input_data = generate_input(scenario, seed)
+    input_data['iterations'] = iterations
+    boxes_total = sum(pkg['amount'] for pkg in input_data['packages'])
+
+    # timed run, the phase times are taken from the solve metrics
+    # (find_best_point runs inside construct_packing, so its time is included in both)
+    rch.METRICS.reset()
+    start = time.perf_counter()
+    packing_input = rch.prepare_input(copy.deepcopy(input_data))
+    prepare_time = time.perf_counter() - start
+    start = time.perf_counter()
+    result = rch.rch(packing_input, workers=1, seed=seed)
+    solve_time = time.perf_counter() - start
+    metrics = rch.METRICS.snapshot()
+    phases = { phase: { 'time': seconds, 'calls': calls } for phase, (calls, seconds) in metrics['timers'].items() }
+    phases['prepare'] = { 'time': prepare_time, 'calls': 1 }
+
+    # the peak memory is measured on a separate run, tracemalloc slows down the solve
+    tracemalloc.start()
+    rch.rch(rch.prepare_input(copy.deepcopy(dict(input_data, iterations=min(iterations, 3)))), workers=1, seed=seed)
+    _, peak_memory = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    packing = result.packing
+    return {
+        'scenario': scenario['name'],
+        'seed': seed,
+        'boxes': boxes_total,
+        'scalar': packing_input.scalar,
+        'iterations': result.iterations,
+        'time': solve_time,
+        'iterations_per_second': result.iterations / solve_time if solve_time > 0 else 0.0,
+        'peak_memory': peak_memory,
+        'used_space_ratio': packing.used_space_ratio(),
+        'profit': packing.total_profit,
+        'priority': packing.total_priority,
+        'boxes_placed': sum(len(box.get_all_real_boxes()) for box in packing.boxes),
+        'bound': packing_input.upper_bound(),
+        'phases': phases,
+        'counters': metrics['counters'],
+    }
+
+
+def run(scenarios: list[dict], iterations: int, seed: int) -> dict:
+    results = []
+    for scenario in scenarios:
+        result = run_scenario(scenario, iterations, seed)
+        print(f"{result['scenario']:<22} {result['time']:8.3f}s {result['iterations_per_second']:8.2f} it/s "
+              f"{result['peak_memory'] / 2**20:8.2f} MiB  space {result['used_space_ratio']:.4f}  "
+              f"placed {result['boxes_placed']}/{result['boxes']}")
+        results.append(result)
+    return { 'iterations': iterations, 'seed': seed, 'results': results }
+
+
+# prints the change of every metric of the current run relative to a previous run (same scenarios only)
+def compare(current: dict, baseline: dict) -> None:
+    metrics = ['time', 'iterations_per_second', 'peak_memory', 'used_space_ratio', 'profit', 'priority', 'boxes_placed']
+    baseline_results = { result['scenario']: result for result in baseline['results'] }
+    for result in current['results']:
+        other = baseline_results.get(result['scenario'])
+        if other is None: continue
+        changes = []
+        for metric in metrics:
+            before, after = other[metric], result[metric]
+            change = (after - before) / before * 100 if before != 0 else 0.0
+            changes.append(f'{metric} {change:+.1f}%')
+        print(f"{result['scenario']:<22} " + '  '.join(changes))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='benchmark of the rch solver on generated inputs')
+    parser.add_argument('--iterations', type=int, default=20)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--scenario', action='append', help='run only the named scenarios')
+    parser.add_argument('--out', help='write the results as json to this file')
+    parser.add_argument('--compare', help='results file of a previous run to compare with')
+    args = parser.parse_args()
+    # the solve prints its stats in debug mode
+    debug_utils.DEBUG_MODE = False
+
+    scenarios = [s for s in SCENARIOS if args.scenario is None or s['name'] in args.scenario]
+    results = run(scenarios, args.iterations, args.seed)
+    if args.out is not None:
+        with open(args.out, 'w') as out_file:
+            json.dump(results, out_file, indent=2)
+    if args.compare is not None:
+        with open(args.compare, 'r') as in_file:
+            compare(results, json.load(in_file))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,41 +1,86 @@
 import random
 from rch_enums import *
 from rch_types import *
+from metrics import *
 
 
-class Box:
+class BoxType:
     '''
-    size = (width, height, depth)
-    rotations = set of possible rotation types
+    the immutable data of a box, shared by all the boxes of the same type
+    size = (width, height, depth) before any rotation
+    rotations = possible rotation types (ordered, so seeded runs are reproducible)
     stackable = False (fragile) iff no box can be stacked above
     customer_code = group packages for each customer, and pack them in certain order
     priority = [1-10] the higher, the more likely the package will be packed (10 being hard constraint)
-    children = (relevant for combined boxes) - specifies which two boxes created this box
     '''
+    __slots__ = ('name', 'size', 'weight', 'profit', 'priority', 'rotations', 'stackable', 'customer_code')
+
     def __init__(
-        self, 
-        box_type: str,
-        size: Size, 
+        self,
+        name: str,
+        size: Size,
         weight: int, # C1
         profit: int,
         priority: int, # C3
         rotations: set[RotationType], # C4
         stackable: bool, # C5
-        combination: Combination = None,
         customer_code: int = 1, # C8
-        position: Point = None,
     ):
-        self.box_type = box_type
+        self.name = name
         self.size = size
         self.weight = weight
         self.profit = profit
         self.priority = priority
-        self.rotations = rotations
+        self.rotations = tuple(sorted(rotations, key=lambda rotation: rotation.value))
         self.stackable = stackable
-        self.combination = combination
         self.customer_code = customer_code
-        self.position = position
+
+    # box types are compared by value, so the types of packings that were solved in another process
+    # (and pickled back) still match the types of the input
+    def _key(self) -> tuple:
+        return (self.name, self.size, self.weight, self.profit, self.priority, self.rotations, self.stackable, self.customer_code)
+
+    def __eq__(self, other) -> bool: return isinstance(other, BoxType) and self._key() == other._key()
+
+    def __hash__(self) -> int: return hash(self._key())
+
+
+class Box:
+    '''
+    a single box in a single iteration, only keeps the state that changes during the iteration
+    kind = the (shared) BoxType of the box
+    size = the size after rotating the box
+    combination = (relevant for combined boxes) - specifies which two boxes created this box
+    '''
+    __slots__ = ('kind', 'size', 'rotation_type', 'position', 'combination')
+
+    def __init__(self, kind: BoxType, combination: Combination = None):
+        self.kind = kind
+        self.size = kind.size
         self.rotation_type = RotationType.NONE
+        self.position = None
+        self.combination = combination
+
+    @property
+    def box_type(self) -> str: return self.kind.name
+
+    @property
+    def weight(self) -> int: return self.kind.weight
+
+    @property
+    def profit(self) -> int: return self.kind.profit
+
+    @property
+    def priority(self) -> int: return self.kind.priority
+
+    @property
+    def rotations(self) -> tuple[RotationType]: return self.kind.rotations
+
+    @property
+    def stackable(self) -> bool: return self.kind.stackable
+
+    @property
+    def customer_code(self) -> int: return self.kind.customer_code
 
     def get_common_dims(self, other):
         common_dims = []
@@ -44,9 +89,12 @@ class Box:
         if self.size[2] == other.size[2]: common_dims.append('h')
         return common_dims
 
+    def random_rotation(self) -> RotationType:
+        return random.choice(self.kind.rotations)
+
     def rotate(self, new_rotation_type: RotationType = None) -> None:
         if new_rotation_type is None:
-            new_rotation_type = random.choice(list(self.rotations))
+            new_rotation_type = self.random_rotation()
         
         self.size = new_rotation_type.permute(self.size)
         self.rotation_type = self.rotation_type.rotate(new_rotation_type)
@@ -78,7 +126,7 @@ class Box:
         profit = box_a.profit + box_b.profit
         priority = box_a.priority + box_b.priority
         stackable = box_a.stackable and box_b.stackable
-        rotations = box_a.rotations.intersection(box_b.rotations)
+        rotations = set(box_a.rotations).intersection(box_b.rotations)
 
         size_a = box_a.size
         size_b = box_b.size
@@ -91,4 +139,44 @@ class Box:
             size = ((size_a[0] + size_b[0], size_a[1], size_a[2]))
 
         # call constructor
-        return cls('combined', size, weight, profit, priority, rotations, stackable, combination)
+        kind = BoxType('combined', size, weight, profit, priority, rotations, stackable)
+        return cls(kind, combination)
+
+
+class BoxTable:
+    '''
+    compact description of the input boxes: one row per box type with the amount of boxes of that type
+    the Box states of an iteration are created from it (see create_boxes)
+    '''
+    __slots__ = ('kinds', 'amounts')
+
+    def __init__(self, kinds: list[BoxType] = None, amounts: list[int] = None):
+        self.kinds = kinds if kinds is not None else []
+        self.amounts = amounts if amounts is not None else []
+
+    # total amount of boxes
+    def __len__(self) -> int: return sum(self.amounts)
+
+    def append(self, kind: BoxType, amount: int) -> None:
+        self.kinds.append(kind)
+        self.amounts.append(amount)
+
+    # a stable sort of the rows gives the same order as a stable sort of all the boxes (boxes of a type share the key)
+    def sorted(self, key, reverse: bool = False) -> BoxTable:
+        order = sorted(range(len(self.kinds)), key=lambda i: key(self.kinds[i]), reverse=reverse)
+        return BoxTable([self.kinds[i] for i in order], [self.amounts[i] for i in order])
+
+    # the rows that are left after removing used[kind] boxes of each kind (rows without boxes are dropped)
+    # (rows of equal box types share the used amount)
+    def subtract(self, used: dict[BoxType, int]) -> BoxTable:
+        used = dict(used)
+        remaining = BoxTable()
+        for kind, amount in zip(self.kinds, self.amounts):
+            taken = min(amount, used.get(kind, 0))
+            if taken > 0: used[kind] -= taken
+            if amount > taken: remaining.append(kind, amount - taken)
+        return remaining
+
+    @timed('create_boxes')
+    def create_boxes(self) -> list[Box]:
+        return [Box(kind) for kind, amount in zip(self.kinds, self.amounts) for _ in range(amount)]
@@ -1,4 +1,7 @@
-DEBUG_MODE = True
+import os
+
+# set DEBUG=0 to stop printing the stats of every solve
+DEBUG_MODE = os.environ.get('DEBUG', '1') == '1'
 
 
 def print_debug(message):
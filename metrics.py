@@ -0,0 +1,91 @@
+import functools
+import threading
+import time
+import os
+
+# set METRICS=0 to remove the timers and counters from the solve
+METRICS_ENABLED = os.environ.get('METRICS', '1') == '1'
+
+
+'''
+timers and counters of the solve phases (aggregated in each process)
+timers = phase -> [calls, seconds], counters = name -> value
+worker processes send a snapshot of their metrics back, it's merged into the metrics of the parent process
+'''
+class Metrics:
+    def __init__(self, enabled: bool = True):
+        self.enabled = enabled
+        self.timers = {}
+        self.counters = {}
+        self.lock = threading.Lock()
+
+    def count(self, name: str, value: int = 1) -> None:
+        if not self.enabled: return
+        self.counters[name] = self.counters.get(name, 0) + value
+
+    def add_time(self, phase: str, seconds: float, calls: int = 1) -> None:
+        if not self.enabled: return
+        timer = self.timers.get(phase)
+        if timer is None:
+            self.timers[phase] = [calls, seconds]
+        else:
+            timer[0] += calls
+            timer[1] += seconds
+
+    def snapshot(self) -> dict:
+        with self.lock:
+            return { 'timers': { phase: list(timer) for phase, timer in self.timers.items() }, 'counters': dict(self.counters) }
+
+    def merge(self, snapshot: dict) -> None:
+        with self.lock:
+            for phase, (calls, seconds) in snapshot['timers'].items(): self.add_time(phase, seconds, calls)
+            for name, value in snapshot['counters'].items(): self.count(name, value)
+
+    def reset(self) -> None:
+        with self.lock:
+            self.timers.clear()
+            self.counters.clear()
+
+    # the metrics in the prometheus text format
+    def to_prometheus(self, prefix: str = 'rch') -> str:
+        snapshot = self.snapshot()
+        lines = [
+            f'# HELP {prefix}_phase_seconds_total Time spent in each solve phase.',
+            f'# TYPE {prefix}_phase_seconds_total counter',
+        ]
+        lines.extend(f'{prefix}_phase_seconds_total{{phase="{phase}"}} {seconds}' for phase, (_, seconds) in sorted(snapshot['timers'].items()))
+        lines.extend([
+            f'# HELP {prefix}_phase_calls_total Number of times each solve phase ran.',
+            f'# TYPE {prefix}_phase_calls_total counter',
+        ])
+        lines.extend(f'{prefix}_phase_calls_total{{phase="{phase}"}} {calls}' for phase, (calls, _) in sorted(snapshot['timers'].items()))
+        for name, value in sorted(snapshot['counters'].items()):
+            lines.append(f'# TYPE {prefix}_{name}_total counter')
+            lines.append(f'{prefix}_{name}_total {value}')
+        return '\n'.join(lines) + '\n'
+
+
+METRICS = Metrics(METRICS_ENABLED)
+
+
+# decorator that adds the time of every call of the function to the phase
+def timed(phase: str):
+    def decorator(function):
+        if not METRICS.enabled: return function
+        @functools.wraps(function)
+        def timed_function(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                METRICS.add_time(phase, time.perf_counter() - start)
+        return timed_function
+    return decorator
+
+
+# runs the function and returns its result and the metrics recorded while it ran
+# for functions that run in a worker process (the process runs a single function at a time)
+def run_with_metrics(function, *args):
+    METRICS.reset()
+    result = function(*args)
+    return result, METRICS.snapshot()
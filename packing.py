@@ -1,43 +1,52 @@
+import collections
+import copy
+import numpy as np
 from rch_types import *
 from rch_used_space import *
+from rch_geometric_space import *
+from rch_potential_points import *
+from rch_resolution import *
 from util import *
 from box import *
+from rch_bounds import *
+from metrics import *
 
 
 class Packing:
-    def __init__(self, container: Container):
+    def __init__(self, container: Container, space_type: SpaceType = SpaceType.VOXEL):
         self.container = container
         self.boxes = []
         self.total_weight = 0
         self.total_priority = 0
         self.total_profit = 0
-        self.used_space = UsedSpace(container.size)
+        if space_type == SpaceType.GEOMETRIC:
+            self.used_space = GeometricSpace(container.size)
+        else:
+            self.used_space = UsedSpace(container.size)
 
-    def add(self, box: Box, point: Point, potential_points: list[Point]) -> None:
+    def add(self, box: Box, point: Point, potential_points: PotentialPoints) -> None:
         self.boxes.append(box)
         self.total_weight += box.weight
         self.total_profit += box.profit
         self.total_priority += box.priority
         self.used_space.add(box, point)
 
-        potential_points.remove(point)
-
-        corner_w = (point[0] + box.size[0], point[1], point[2])
-        projected_corner_w = self.used_space.vertical_projection(corner_w)
-        if projected_corner_w is not None:
-            potential_points.append(projected_corner_w)
-
-        corner_d = (point[0], point[1] + box.size[1], point[2])
-        projected_corner_d = self.used_space.vertical_projection(corner_d)
-        if projected_corner_d is not None:
-            potential_points.append(projected_corner_d)
+        # the box covers point itself and any other point inside of it
+        corner = (point[0] + box.size[0], point[1] + box.size[1], point[2] + box.size[2])
+        potential_points.evict_covered(point, corner)
 
-        corner_h = (point[0], point[1], point[2] + box.size[2])
-        projected_corner_h = self.used_space.vertical_projection(corner_h)
-        if projected_corner_h is not None:
-            potential_points.append(projected_corner_h)
+        corners = [
+            (point[0] + box.size[0], point[1], point[2]), # w
+            (point[0], point[1] + box.size[1], point[2]), # d
+            (point[0], point[1], point[2] + box.size[2]), # h
+        ]
+        for corner in corners:
+            projected_corner = self.used_space.vertical_projection(corner)
+            if projected_corner is not None and not self.used_space.is_occupied(projected_corner):
+                potential_points.add(projected_corner)
 
     def can_be_added(self, box: Box, point: Point) -> bool:
+        METRICS.count('can_be_added_checks')
         # does the box exceed the container weight limit
         new_total_weight = box.weight + self.total_weight
         if new_total_weight > self.container.weight_limit:
@@ -59,6 +68,28 @@ class Packing:
         floating_scores = [self.used_space.get_support_score(b, point) for b in real_boxes]
         return min(floating_scores)
 
+    # can_be_added for an (n, 3) array of points, returns a boolean mask
+    def can_be_added_batch(self, box: Box, points: np.ndarray) -> np.ndarray:
+        METRICS.count('can_be_added_checks', len(points))
+        feasible = np.zeros(len(points), dtype=bool)
+        if box.weight + self.total_weight > self.container.weight_limit:
+            return feasible
+        feasible = np.all(points + np.array(box.size) <= np.array(self.container.size), axis=1)
+        inside = np.flatnonzero(feasible)
+        feasible[inside] = self.used_space.can_be_added_batch(box, points[inside])
+        return feasible
+
+    # get_support_score for an (n, 3) array of points
+    def get_support_scores(self, box: Box, points: np.ndarray) -> np.ndarray:
+        real_boxes = box.get_all_real_boxes()
+        return np.min([self.used_space.get_support_scores(b, points) for b in real_boxes], axis=0)
+
+    # the value of the packing that the preference maximizes (see is_better_than)
+    def score(self, preference: str = 'volume') -> float:
+        if preference == 'profit':   return self.total_profit
+        if preference == 'priority': return self.total_priority
+        return self.used_space.ratio()
+
     def is_better_than(self, other: Packing, preference: str = 'volume') -> bool:
         if other is None: return True
         
@@ -74,11 +105,34 @@ class Packing:
         if preference == 'priority': return cmp_priority(self, other)
         return cmp_space(self, other)
         
+    # state of the packing and of its potential points, restore brings both back to it
+    def snapshot(self, potential_points: PotentialPoints) -> PackingState:
+        return PackingState(self, potential_points)
+
+    # the nbytes of a snapshot (see PackingState), without taking it
+    def snapshot_nbytes(self, potential_points: PotentialPoints) -> int:
+        # 100 bytes per potential point is a rough estimate of a dict item with a tuple key
+        return self.used_space.snapshot_nbytes() + 100 * len(potential_points)
+
+    # boxes = the boxes of the packing when the snapshot was taken, in order (their positions must be set)
+    def restore(self, state: PackingState, boxes: list[Box], potential_points: PotentialPoints) -> None:
+        self.boxes = list(boxes)
+        self.total_weight, self.total_profit, self.total_priority = state.totals
+        self.used_space.restore(state.used_space, self.boxes)
+        potential_points.restore(state.potential_points)
+
+    # drops the floating boxes, bottom-up so every box falls onto boxes that already settled
+    # (the boxes keep their order in the packing)
+    @timed('unfloat')
     def unfloat(self):
-        for box in self.boxes: self.used_space.unfloat(box)
+        for box in sorted(self.boxes, key=lambda box: box.position[2]): self.used_space.unfloat(box)
 
     def used_space_ratio(self) -> float: return self.used_space.ratio()
 
+    # number of packed boxes of each box type
+    def kind_counts(self) -> dict[BoxType, int]:
+        return collections.Counter(box.kind for block in self.boxes for box in block.get_all_real_boxes())
+
     def box_usage(self, packing_input: PackingInput):
         used_boxes = {}
         for block in self.boxes:
@@ -98,18 +152,59 @@ class Packing:
         return '\n'.join([space_str, profit_str, box_usage_str])
 
 
+class PackingState:
+    '''
+    snapshot of a packing under construction (see Packing.snapshot)
+    the boxes aren't kept, the snapshot can be restored into a packing of other boxes placed at the same positions
+    nbytes = approximate memory of the snapshot
+    '''
+    __slots__ = ('totals', 'used_space', 'potential_points', 'nbytes')
+
+    def __init__(self, packing: Packing, potential_points: PotentialPoints):
+        self.totals = (packing.total_weight, packing.total_profit, packing.total_priority)
+        self.nbytes = packing.snapshot_nbytes(potential_points)
+        self.used_space = packing.used_space.snapshot()
+        self.potential_points = potential_points.snapshot()
+
+
 class PackingInput:
-    def __init__(self, json_data, scalar):
+    '''
+    scalar = the packing is in units of scalar input units (the exact gcd of the sizes)
+    grid = edge of a voxel in input units, equal to the scalar unless the input uses the coarse resolution
+    with a coarse grid the json keeps its units, the package sizes are rounded up and the container sizes down
+    to the grid, and the results are moved back to the exact sizes (see to_real_units)
+    '''
+    def __init__(self, json_data, scalar, grid: int = None):
         self.original_json = json_data
         self.scalar = scalar
+        self.grid = grid if grid is not None else scalar
+        self.real_box_table = BoxTable() if grid is not None else None
+        # refine the positions of a coarse packing to the exact sizes (see compact_positions)
+        self.compact = json_data.get('compact', True)
+        # 'full' (default, an object per box) or 'compact' (columns, see PackingResult.solution_to_columns)
+        self.output_format = json_data.get('format', 'full')
+        # the admission decision on the input (see rch_admission.admit), None when it wasn't checked
+        self.admission = None
         self.preference = json_data['preference'] if 'preference' in json_data else 'volume'
-        # init container
-        container = json_data['container']
-        container_size = (container['width'], container['depth'], container['height'])
-        self.container = Container(container_size, container['maxWeight'])
+        self.budget = SolveBudget.from_json(json_data)
+        # 'on' (default), 'off' (don't use the solution cache) or 'budget' (only use solutions with at least the same time budget)
+        self.cache_mode = json_data['cache'] if 'cache' in json_data else 'on'
+        if self.cache_mode not in ('on', 'off', 'budget'): raise ValueError(f"'{self.cache_mode}' is not a valid cache mode")
+        # occupancy backend, 'voxel' (default) or 'geometric'
+        self.space_type = SpaceType(json_data['space']) if 'space' in json_data else SpaceType.VOXEL
+        self._upper_bound = None
+        # init containers, a single 'container' or a fleet of 'containers' (each with an optional 'count')
+        if self.is_fleet():
+            container_list = [c for c in json_data['containers'] for _ in range(int(c.get('count', 1)))]
+        else:
+            container_list = [json_data['container']]
+        self.containers = [self.parse_container(c, grid) for c in container_list]
+        self.container = self.containers[0]
+        self.real_containers = [self.parse_container(c) for c in container_list] if grid is not None else None
+        self.real_container = self.real_containers[0] if grid is not None else None
         
-        # init boxes
-        self.boxes = []
+        # init box types (one row per package, the boxes themselves are created per iteration)
+        self.box_table = BoxTable()
         packages = json_data['packages']
         for pkg in packages:
             # convert input to correct types (incase we get json where 'width' is a string for example)
@@ -119,26 +214,123 @@ class PackingInput:
             width, depth, height = int(pkg['width']), int(pkg['depth']), int(pkg['height'])
             priority = int(pkg['priority'])
             weight = int(pkg['weight'])
-            for _ in range(amount):
-                box = Box(
-                    box_type=pkg['type'],
-                    size=(width, depth, height),
-                    weight=weight,
-                    profit=float(pkg['profit']),
-                    priority=priority,
-                    rotations=set(list(RotationType)) if canRotate else set([RotationType.NONE]),
-                    stackable=canStackAbove,
-                    combination=None,
-                    customer_code=1
-                )
-                self.boxes.append(box)
+            kind = BoxType(
+                name=pkg['type'],
+                size=(width, depth, height),
+                weight=weight,
+                profit=float(pkg['profit']),
+                priority=priority,
+                rotations=set(list(RotationType)) if canRotate else set([RotationType.NONE]),
+                stackable=canStackAbove,
+                customer_code=1
+            )
+            if grid is not None:
+                self.real_box_table.append(kind, amount)
+                kind = BoxType(kind.name, ceil_to_grid(kind.size, grid), kind.weight, kind.profit, kind.priority, set(kind.rotations), kind.stackable, kind.customer_code)
+            self.box_table.append(kind, amount)
+        # the exact box type of every (coarse) box type
+        self.real_kinds = dict(zip(self.box_table.kinds, self.real_box_table.kinds)) if grid is not None else None
+
+    @staticmethod
+    def parse_container(container, grid: int = None) -> Container:
+        container_size = (container['width'], container['depth'], container['height'])
+        if grid is not None: container_size = floor_to_grid(container_size, grid)
+        return Container(container_size, container['maxWeight'])
+
+    def is_coarse(self) -> bool: return self.real_box_table is not None
+
+    def is_fleet(self) -> bool: return 'containers' in self.original_json
+
+    # the same input with a single container and other boxes (the parsed box types are shared)
+    def for_container(self, container: Container, box_table: BoxTable) -> PackingInput:
+        packing_input = copy.copy(self)
+        packing_input.container = container
+        packing_input.containers = [container]
+        packing_input.box_table = box_table
+        packing_input._upper_bound = None
+        if self.is_coarse(): packing_input.real_container = self.real_containers[self.containers.index(container)]
+        return packing_input
+
+    # the packing of a coarse input in the units of the input (with the exact box sizes)
+    # the result keeps the boxes, rotations and totals of the packing, its occupancy is geometric
+    def to_real_units(self, packing: Packing) -> Packing:
+        boxes = [box for block in packing.boxes for box in block.get_all_real_boxes()]
+        real_boxes = []
+        for box in boxes:
+            real_box = Box(self.real_kinds[box.kind])
+            real_box.rotate(box.rotation_type)
+            real_boxes.append(real_box)
+        cell_begin = np.array([box.position for box in boxes], dtype=np.int64).reshape(-1, 3)
+        if self.compact:
+            positions = compact_positions(
+                cell_begin,
+                np.array([box.size for box in boxes], dtype=np.int64).reshape(-1, 3),
+                np.array([box.size for box in real_boxes], dtype=np.int64).reshape(-1, 3),
+                np.array([box.stackable for box in boxes], dtype=bool),
+                packing.container.size[2],
+                self.real_container.size[2]
+            )
+        else:
+            positions = cell_begin * self.grid
+        real_packing = Packing(self.real_container, SpaceType.GEOMETRIC)
+        potential_points = PotentialPoints()
+        for box, position in zip(real_boxes, positions):
+            position = tuple(int(value) for value in position)
+            box.set_position(position)
+            real_packing.add(box, position, potential_points)
+        return real_packing
+
+    # upper bound of the score of any packing of the input (computed once)
+    def upper_bound(self) -> float:
+        if self._upper_bound is None:
+            self._upper_bound = upper_bound(self.box_table, self.container, self.preference)
+        return self._upper_bound
 
 
 class PackingResult:
-    def __init__(self, error: str = None, packing_input: PackingInput = None, packing: Packing = None):
+    def __init__(self, error: str = None, packing_input: PackingInput = None, packing: Packing = None, iterations: int = None, elapsed: float = None):
         self.error = error
         self.packing = packing
         self.packing_input = packing_input  
+        self.iterations = iterations
+        self.elapsed = elapsed
+        self._real_packing = None
+
+    # the rotation codes of the compact format, code i is the rotation (rotation-x, rotation-y, rotation-z) at index i
+    ROTATIONS = list(RotationType)
+
+    @staticmethod
+    def rotations_to_json() -> list:
+        return [[rotation.x, rotation.y, rotation.z] for rotation in map(to_rotation3d, PackingResult.ROTATIONS)]
+
+    # the compact format of the solution: a column per field, type = index of the box type in the packages
+    @staticmethod
+    def solution_to_columns(boxes: list[Box], packages) -> dict:
+        type_index = {}
+        for i, pkg in enumerate(packages): type_index.setdefault(pkg['type'], i)
+        rotation_index = { rotation_type: i for i, rotation_type in enumerate(PackingResult.ROTATIONS) }
+        return {
+            'type': [type_index[box.box_type] for box in boxes],
+            'x': [int(box.position[0]) for box in boxes],
+            'y': [int(box.position[1]) for box in boxes],
+            'z': [int(box.position[2]) for box in boxes],
+            'rotation': [rotation_index[box.rotation_type] for box in boxes],
+        }
+
+    @staticmethod
+    def packages_to_json(packages):
+        return [{
+            "type": pkg['type'],
+            "width": int(pkg['width']),
+            "height": int(pkg['height']),
+            "depth": int(pkg['depth'])
+        } for pkg in packages]
+
+    # the packing in the units of the output (only differs from the packing with a coarse grid)
+    def real_packing(self) -> Packing:
+        if not self.packing_input.is_coarse(): return self.packing
+        if self._real_packing is None: self._real_packing = self.packing_input.to_real_units(self.packing)
+        return self._real_packing
 
     def to_json(self):
         json_data = {}
@@ -146,8 +338,9 @@ class PackingResult:
             json_data['error'] = self.error
             return json_data
 
-        if self.packing is not None:
-            container_size = self.packing.container.size
+        packing = self.real_packing()
+        if packing is not None:
+            container_size = packing.container.size
             json_data['container'] = {
                 "width": int(container_size[0]),
                 "depth": int(container_size[1]),
@@ -155,33 +348,29 @@ class PackingResult:
                 "maxWeight": float(self.packing_input.container.weight_limit)
             }
             
-            packages = self.packing_input.original_json['packages']
-            json_data['packages'] = []
-            for pkg in packages:
-                json_data['packages'].append({
-                    "type": pkg['type'],
-                    "width": int(pkg['width']),
-                    "height": int(pkg['height']),
-                    "depth": int(pkg['depth'])
-                })
-            
-            json_data['solution'] = []
-            boxes = self.packing.boxes
+            json_data['packages'] = self.packages_to_json(self.packing_input.original_json['packages'])
             
-            ids = []
+            solution = []
+            seen = set()
             dup_count = 0
-
-            for block in boxes:
-                real_boxes = block.get_all_real_boxes()
-                for box in real_boxes:
-                    if id(box) not in ids:
-                        ids.append(id(box))
-                    else:
+            for block in packing.boxes:
+                for box in block.get_all_real_boxes():
+                    if id(box) in seen:
                         dup_count += 1
+                    else:
+                        seen.add(id(box))
+                    solution.append(box)
+            assert_debug(dup_count == 0)
+
+            if self.packing_input.output_format == 'compact':
+                json_data['solution'] = self.solution_to_columns(solution, self.packing_input.original_json['packages'])
+                json_data['rotations'] = self.rotations_to_json()
+            else:
+                json_data['solution'] = []
+                for box in solution:
                     rotation = to_rotation3d(box.rotation_type)
-                    box_type = box.box_type
                     json_data['solution'].append({
-                        "type": box_type,
+                        "type": box.box_type,
                         "x": box.position[0],
                         "y": box.position[1],
                         "z": box.position[2],
@@ -189,15 +378,73 @@ class PackingResult:
                         "rotation-y": rotation.y, 
                         "rotation-z": rotation.z
                     })
-            assert_debug(dup_count == 0)
         
         json_data['stats'] = {
-            'profit': self.packing.total_profit,
-            'weight': self.packing.total_weight,
-            'box_usage': self.packing.box_usage(self.packing_input),
-            'space_usage': self.packing.used_space_ratio()
+            'profit': packing.total_profit,
+            'weight': packing.total_weight,
+            'box_usage': packing.box_usage(self.packing_input),
+            'space_usage': packing.used_space_ratio(),
+            'iterations': self.iterations,
+            'time': self.elapsed
         }
+        # relative gap between the packing and the upper bound of the input (0 = the packing is optimal)
+        # (with a coarse grid both are taken on the grid that was solved)
+        bound = self.packing_input.upper_bound()
+        json_data['stats']['bound'] = bound
+        json_data['stats']['gap'] = max(0.0, bound - self.packing.score(self.packing_input.preference)) / bound if bound > 0 else 0.0
+        if self.packing_input.admission is not None:
+            json_data['stats']['admission'] = self.packing_input.admission.to_json()
 
         json_data['scalar'] = self.packing_input.scalar
+        json_data['grid'] = self.packing_input.grid
         return json_data
 
+
+class FleetResult:
+    '''
+    result of packing a fleet of containers
+    results = (index of the container in the fleet, its PackingResult) of every container that got boxes
+    unpacked = the boxes that didn't fit in any container
+    '''
+    def __init__(self, packing_input: PackingInput, results: list[tuple[int, PackingResult]], unpacked: BoxTable, iterations: int, elapsed: float):
+        self.packing_input = packing_input
+        self.results = results
+        self.unpacked = unpacked
+        self.iterations = iterations
+        self.elapsed = elapsed
+
+    def to_json(self):
+        containers = []
+        for index, result in self.results:
+            container_json = result.to_json()
+            # the packages, the scalar and the grid are the same for all the containers, they're only written once
+            del container_json['packages']
+            del container_json['scalar']
+            del container_json['grid']
+            container_json.pop('rotations', None)
+            container_json['stats'].pop('admission', None)
+            container_json['index'] = index
+            containers.append(container_json)
+
+        packings = [result.packing for _, result in self.results]
+        json_data = {
+            'packages': PackingResult.packages_to_json(self.packing_input.original_json['packages']),
+            'containers': containers,
+            'stats': {
+                'containers_used': len(containers),
+                'containers_available': len(self.packing_input.containers),
+                'profit': sum(packing.total_profit for packing in packings),
+                'priority': sum(packing.total_priority for packing in packings),
+                'weight': sum(packing.total_weight for packing in packings),
+                'unpacked': { kind.name: amount for kind, amount in zip(self.unpacked.kinds, self.unpacked.amounts) },
+                'iterations': self.iterations,
+                'time': self.elapsed
+            },
+            'scalar': self.packing_input.scalar,
+            'grid': self.packing_input.grid
+        }
+        if self.packing_input.admission is not None:
+            json_data['stats']['admission'] = self.packing_input.admission.to_json()
+        if self.packing_input.output_format == 'compact':
+            json_data['rotations'] = PackingResult.rotations_to_json()
+        return json_data
@@ -3,21 +3,40 @@
 
 
 import math
-import copy
 import traceback
 import random
 import os
 import json
+import multiprocessing
+import threading
+import collections
+import time
+import numpy as np
 from packing import *
+from rch_admission import *
+from solution_cache import *
+from rch_prefix_cache import *
+from metrics import *
 from debug_utils import *
 
 
 ALGORITHM_REPEAT_COUNT = int(os.environ.get('REPEAT', '100'))
-SKIP_COMBINE_PROBABILITY = 1
+PARALLEL_WORKERS = int(os.environ.get('WORKERS', '1'))
+RANDOM_SEED = int(os.environ['SEED']) if 'SEED' in os.environ else None
+PARALLEL_CHUNKS_PER_WORKER = 4
+SKIP_COMBINE_PROBABILITY = float(os.environ.get('SKIP_COMBINE', '1'))
+COMBINE_PASSES = int(os.environ.get('COMBINE_PASSES', '1'))
 REORDER_PROBABILITY = 0.5
 REORDER_RATIO_OFFSET = 0.3
 REORDER_RATIO_LOWER_BOUND = 1 - REORDER_RATIO_OFFSET
 REORDER_RATIO_HIGHER_BOUND = 1 + REORDER_RATIO_OFFSET
+BATCHED_POINT_EVALUATION = os.environ.get('BATCHED', '1') == '1'
+# abandon the constructions that can't beat the best packing so far
+INCUMBENT_PRUNING = os.environ.get('PRUNE', '1') == '1'
+# resume the constructions from the known prefixes of the earlier iterations (see rch_prefix_cache)
+PREFIX_REUSE = os.environ.get('PREFIX_REUSE', '1') == '1'
+# seconds between the checks of the cancel event of a job
+CANCEL_POLL_INTERVAL = 0.1
 
 
 def volume(size: Size) -> int: return size[0]*size[1]*size[2]
@@ -26,41 +45,77 @@ def volume(size: Size) -> int: return size[0]*size[1]*size[2]
 def chance(probability: float) -> bool: return random.random() < probability
 
 
-def preprocess_boxes(boxes: list[Box]) -> list[Box]:
-    processed_boxes = []
-    combined_boxes = []
-    for i in range(len(boxes)):
-        for j in range(i + 1, len(boxes)):
-            a = boxes[i]
-            b = boxes[j]
-            if not a.stackable or not b.stackable: continue
-            if i == j or a in combined_boxes or b in combined_boxes: continue
-            common_dims = a.get_common_dims(b)
-            if len(common_dims) >= 2:
-                # keep track of boxes that were combined (they'll be removed from the return value)
-                combined_boxes.append(a)
-                combined_boxes.append(b)
-                # add the combination to processed_boxes
-                processed_boxes.append(combine(a, b, common_dims))
-    # add all boxes that were not combined to the return value
-    processed_boxes.extend([box for box in boxes if box not in combined_boxes])
+# pairs every stackable box with the first box after it that shares at least two dimensions
+# (same pairs as checking all pairs in order), waiting boxes are kept in buckets per pair of dimensions,
+# so each box only looks at the heads of its three buckets
+def combine_pass(boxes: list[Box]) -> list[Box]:
+    waiting = {}
+    combined = [False] * len(boxes)
+    pairs = []
+    for j, b in enumerate(boxes):
+        if not b.stackable: continue
+        w, d, h = b.size
+        signatures = [('wd', w, d), ('wh', w, h), ('dh', d, h)]
+        partner = None
+        for signature in signatures:
+            bucket = waiting.get(signature)
+            if bucket is None: continue
+            # boxes that were combined through another bucket are dropped lazily
+            while len(bucket) > 0 and combined[bucket[0]]: bucket.popleft()
+            if len(bucket) > 0 and (partner is None or bucket[0] < partner):
+                partner = bucket[0]
+        if partner is None:
+            for signature in signatures:
+                waiting.setdefault(signature, collections.deque()).append(j)
+        else:
+            combined[partner] = combined[j] = True
+            pairs.append((partner, j))
 
+    # combine in the order of the first box (combine is random)
+    pairs.sort()
+    processed_boxes = [combine(boxes[i], boxes[j], boxes[i].get_common_dims(boxes[j])) for i, j in pairs]
+    # add all boxes that were not combined to the return value
+    processed_boxes.extend([box for i, box in enumerate(boxes) if not combined[i]])
     return processed_boxes
 
 
+# every pass can combine the blocks of the previous passes into larger blocks
+@timed('preprocess')
+def preprocess_boxes(boxes: list[Box], passes: int = COMBINE_PASSES) -> list[Box]:
+    for _ in range(passes):
+        processed_boxes = combine_pass(boxes)
+        if len(processed_boxes) == len(boxes): break
+        boxes = processed_boxes
+    return boxes
+
+
+# the sorting keys only use type fields, so they apply to both Box and BoxType
+def get_sorting_key(sorting_type: SortingType):
+    if sorting_type == SortingType.DECREASING_VOLUME:
+        return lambda box: (2 if box.stackable else 1, volume(box.size), box.priority, box.profit)
+    if sorting_type == SortingType.DECREASING_PRIORITY:
+        return lambda box: (box.priority, volume(box.size), box.profit)
+    if sorting_type == SortingType.DECREASING_PROFIT:
+        return lambda box: (box.profit, box.priority, volume(box.size))
+    return lambda box: (2 if box.stackable else 1, box.customer_code, volume(box.size), box.priority, box.profit)
+
+
+@timed('sort')
 def sort_boxes(boxes: list[Box], sorting_type: SortingType = None) -> None:
     if sorting_type is None:
         sorting_type = random.choice(list(SortingType))
-    if sorting_type == SortingType.DECREASING_VOLUME:
-        boxes.sort(key=lambda box: (2 if box.stackable else 1, volume(box.size), box.priority, box.profit), reverse=True)
-    elif sorting_type == SortingType.DECREASING_PRIORITY:
-        boxes.sort(key=lambda box: (box.priority, volume(box.size), box.profit), reverse=True)
-    elif sorting_type == SortingType.DECREASING_PROFIT:
-        boxes.sort(key=lambda box: (box.profit, box.priority, volume(box.size)), reverse=True)
-    else:
-        boxes.sort(key=lambda box: (2 if box.stackable else 1, box.customer_code, volume(box.size), box.priority, box.profit), reverse=True)
+    boxes.sort(key=get_sorting_key(sorting_type), reverse=True)
 
 
+# same order as sort_boxes on the boxes of the table, but only sorts the box types
+@timed('sort')
+def sort_box_table(box_table: BoxTable, sorting_type: SortingType = None) -> BoxTable:
+    if sorting_type is None:
+        sorting_type = random.choice(list(SortingType))
+    return box_table.sorted(get_sorting_key(sorting_type), reverse=True)
+
+
+@timed('perturb_phase1')
 def perturb_phase1(boxes: list[Box]) -> None:
     perturb_rotation = random.choice(list(PerturbRotation))
     if perturb_rotation == PerturbRotation.INDIVIDUAL:
@@ -69,10 +124,11 @@ def perturb_phase1(boxes: list[Box]) -> None:
         rotation_per_type = {}
         for box in boxes:
             if box.box_type not in rotation_per_type:
-                rotation_per_type[box.box_type] = random.choice(list(box.rotations))
+                rotation_per_type[box.box_type] = box.random_rotation()
             box.rotate(rotation_per_type[box.box_type])
 
 
+@timed('perturb_phase2')
 def perturb_phase2(boxes: list[Box]) -> None:
     perturb_order = random.choice(list(PerturbOrder))
     for i in range(len(boxes) - 1):
@@ -83,6 +139,13 @@ def perturb_phase2(boxes: list[Box]) -> None:
             boxes[i], boxes[i + 1] = boxes[i + 1], boxes[i]
 
 
+# the fit criterion of a point, lower is better
+def fit_key(point: Point, box: Box, packing: Packing) -> tuple:
+    floating = 1 - packing.get_support_score(box, point)
+    stack_score = point[2] if box.stackable else 0
+    return (floating, stack_score, point[0])
+
+
 # returns True iff a is "better" than b
 def is_better_fit_point(
     a: Point,
@@ -91,18 +154,39 @@ def is_better_fit_point(
     packing: Packing
 ) -> bool:
     if b is None: return True
-    a_floating = 1 - packing.get_support_score(box, a)
-    b_floating = 1 - packing.get_support_score(box, b)
-    a_stack_score = a[2] if box.stackable else 0
-    b_stack_score = b[2] if box.stackable else 0
-    return (a_floating, a_stack_score, a[0]) < (b_floating, b_stack_score, b[0])
-
-
-def find_best_point(box: Box, potential_points: list[Point], packing: Packing) -> Point:
+    return fit_key(a, box, packing) < fit_key(b, box, packing)
+
+
+# evaluates all the potential points at once and picks the best one with a single lexicographic
+# argmin over (floating, stack score, x), same order as is_better_fit_point (ties keep the first point)
+def find_best_point_batched(box: Box, potential_points: PotentialPoints, packing: Packing) -> Point:
+    if len(potential_points) == 0: return None
+    points = potential_points.as_array(box.stackable)
+    METRICS.count('points_evaluated', len(points))
+    points = points[packing.can_be_added_batch(box, points)]
+    if len(points) == 0: return None
+    floating = 1 - packing.get_support_scores(box, points)
+    stack_score = points[:, 2] if box.stackable else np.zeros(len(points))
+    best = np.lexsort((points[:, 0], stack_score, floating))[0]
+    return tuple(int(value) for value in points[best])
+
+
+@timed('find_best_point')
+def find_best_point(box: Box, potential_points: PotentialPoints, packing: Packing) -> Point:
+    if BATCHED_POINT_EVALUATION:
+        return find_best_point_batched(box, potential_points, packing)
     best_point = None
-    for point in potential_points:
-        if packing.can_be_added(box, point) and is_better_fit_point(point, best_point, box, packing):
-            best_point = point
+    best_key = None
+    evaluated = 0
+    # the points are ordered by the fit criterion, so a fully supported point can't be beaten by the next ones
+    for point in potential_points.ordered(box.stackable):
+        evaluated += 1
+        if not packing.can_be_added(box, point): continue
+        key = fit_key(point, box, packing)
+        if best_key is None or key < best_key:
+            best_point, best_key = point, key
+        if key[0] == 0: break
+    METRICS.count('points_evaluated', evaluated)
     return best_point
 
 
@@ -112,16 +196,47 @@ def is_feasible(packing: Packing) -> bool:
 
 # Algorithm 2
 # Constructive Packing Phase of RCH
-def construct_packing(boxes: list[Box], container: Container) -> Packing:
-    potential_points = [(0, 0, 0), (container.size[0], 0, 0)] # P = {BLF, BRF}
+# with the score of the best packing so far (incumbent_score), the construction is abandoned (returns None)
+# as soon as its optimistic bound shows it can't be better than that packing
+# rng = random source of the retry rotations
+# prefix_cache = the first pass starts after the longest prefix of the boxes that an earlier construction placed
+@timed('construct_packing')
+def construct_packing(
+    boxes: list[Box],
+    container: Container,
+    space_type: SpaceType = SpaceType.VOXEL,
+    preference: str = 'volume',
+    incumbent_score: float = None,
+    rng = random,
+    prefix_cache: PrefixCache = None
+) -> Packing:
+    potential_points = PotentialPoints([(0, 0, 0), (container.size[0], 0, 0)]) # P = {BLF, BRF}
     retry_list = []
-    packing = Packing(container)
+    packing = Packing(container, space_type)
+    prefix = prefix_cache.resume(boxes, packing, potential_points) if prefix_cache is not None else None
+    start = 0
+    if prefix is not None:
+        start = prefix.depth
+        retry_list.extend(prefix.failed)
+    bound = OptimisticBound(boxes, container, preference) if incumbent_score is not None else None
+    def is_pruned() -> bool:
+        if bound is None or not bound.cannot_beat(packing, incumbent_score): return False
+        METRICS.count('constructions_pruned')
+        return True
+    if bound is not None:
+        # the bound only shrinks, so checking after the whole prefix prunes the same constructions
+        for box in packing.boxes: bound.placed(box)
+    if is_pruned(): return None
     
-    for box in boxes: # foreach item i in L
+    for box in boxes[start:]: # foreach item i in L
         best_point = find_best_point(box, potential_points, packing)
+        if prefix is not None: prefix.record(box, best_point)
         if best_point is not None:
             box.set_position(best_point)
             packing.add(box, best_point, potential_points)
+            if bound is not None:
+                bound.placed(box)
+                if is_pruned(): return None
         else:
             # The insertion of box has failed
             retry_list.append(box)
@@ -129,45 +244,184 @@ def construct_packing(boxes: list[Box], container: Container) -> Packing:
     # print_debug(f'construct_packing:: boxes={len(boxes)} retry_list={len(retry_list)}')
    
     for box in retry_list:
-        box.rotate()
+        box.rotate(rng.choice(box.rotations))
         best_point = find_best_point(box, potential_points, packing)
         if best_point is not None:
             box.set_position(best_point)
             packing.add(box, best_point, potential_points)
+            if bound is not None:
+                bound.placed(box)
+                if is_pruned(): return None
+        elif bound is not None:
+            bound.discarded(box)
+            if is_pruned(): return None
     
+    METRICS.count('boxes_placed', len(packing.boxes))
     return packing
 
 
 # Algorithm 1
 # Randomized Constructive Heuristic
-def rch(packing_input: PackingInput) -> PackingResult:
+# runs a batch of iterations and returns the best packing found in them and the number of iterations that ran
+# the batch ends early once the budget of the input is exhausted (at least one iteration always runs)
+# stop_event is shared between parallel workers, it is set once any of them used all the boxes or reached the upper bound of the input
+# (or to cancel the solve)
+# on_improvement(packing, iterations) is called whenever the best packing improves
+def rch_iterations(packing_input: PackingInput, iterations: int, seed: int = None, stop_event = None, on_improvement = None) -> tuple[Packing, int]:
+    if seed is not None:
+        random.seed(seed)
     input_container = packing_input.container
-    input_boxes = packing_input.boxes
+    box_table = packing_input.box_table
+    budget = packing_input.budget
     best_packing = None
-    for i in range(ALGORITHM_REPEAT_COUNT): # iteration n=1 to N
-        container = copy.deepcopy(input_container)
-        boxes = copy.deepcopy(input_boxes)
+    iterations_run = 0
+    iterations_without_improvement = 0
+    bound = packing_input.upper_bound()
+    # the constructions of the batch share their prefixes (same container, same box types)
+    prefix_cache = PrefixCache() if PREFIX_REUSE else None
+    for i in range(iterations): # iteration n=1 to N
+        if i > 0 and budget.is_exhausted(iterations_without_improvement): break
+        if stop_event is not None and stop_event.is_set(): break
+        iterations_run += 1
+        METRICS.count('iterations')
+        # the container and the box types never change, so each iteration only needs fresh box states
+        container = input_container
 
-        # pre-process phase (section 4.2)
         if not chance(SKIP_COMBINE_PROBABILITY):
-            boxes = preprocess_boxes(boxes)
+            # pre-process phase (section 4.2)
+            boxes = preprocess_boxes(box_table.create_boxes())
+            # sort phase (section 4.3)
+            sort_boxes(boxes)
+        else:
+            # without combinations the boxes of a type stay identical, so sort the types only
+            boxes = sort_box_table(box_table).create_boxes()
 
-        # sort/perturb phase (section 4.3)
-        sort_boxes(boxes)
+        # perturb phase (section 4.3)
         perturb_phase1(boxes)
         perturb_phase2(boxes)
 
         # construct a solution (section 4.4)
-        packing = construct_packing(boxes, container)
-        if is_feasible(packing) and packing.is_better_than(best_packing, packing_input.preference):
+        # the retry rotations use their own random source (seeded from the main one), so an abandoned construction
+        # doesn't change the random choices of the next iterations
+        rng = random.Random(random.getrandbits(32))
+        incumbent_score = best_packing.score(packing_input.preference) if INCUMBENT_PRUNING and best_packing is not None else None
+        packing = construct_packing(boxes, container, packing_input.space_type, packing_input.preference, incumbent_score, rng, prefix_cache)
+        if packing is not None and is_feasible(packing) and packing.is_better_than(best_packing, packing_input.preference):
             best_packing = packing
-        # finish if we already used all the available boxes
-        if len(best_packing.boxes) == len(boxes): break
-    
+            iterations_without_improvement = 0
+            if on_improvement is not None: on_improvement(best_packing, iterations_run)
+        else:
+            iterations_without_improvement += 1
+        # finish if we already used all the available boxes, or the best packing reached the upper bound (it's optimal)
+        if len(best_packing.boxes) == len(boxes) or best_packing.score(packing_input.preference) >= bound - BOUND_TOLERANCE:
+            if stop_event is not None: stop_event.set()
+            break
+    return best_packing, iterations_run
+
+
+# split the iterations as evenly as possible between the workers
+def split_iterations(iterations: int, workers: int) -> list[int]:
+    workers = max(1, min(workers, iterations))
+    return [iterations // workers + (1 if i < iterations % workers else 0) for i in range(workers)]
+
+
+_worker_stop_event = None
+
+
+def _init_worker(stop_event) -> None:
+    global _worker_stop_event
+    _worker_stop_event = stop_event
+
+
+# returns the result of rch_iterations and the metrics of the batch
+def _run_worker_batch(args) -> tuple[tuple[Packing, int], dict]:
+    packing_input, iterations, seed = args
+    return run_with_metrics(rch_iterations, packing_input, iterations, seed, _worker_stop_event)
+
+
+# run the iterations on a process pool, split into PARALLEL_CHUNKS_PER_WORKER chunks per worker
+# chunk i runs with seed (base seed + i) and the chunks are reduced in order, so a seed gives the same result
+def rch_parallel(packing_input: PackingInput, iterations: int, workers: int, seed: int = None, stop_event = None, on_improvement = None) -> tuple[Packing, int]:
+    base_seed = seed if seed is not None else random.randrange(2**32)
+    batches = split_iterations(iterations, workers * PARALLEL_CHUNKS_PER_WORKER)
+    context = multiprocessing.get_context()
+    if stop_event is None:
+        stop_event = context.Event()
+    best_packing = None
+    iterations_run = 0
+    with context.Pool(min(workers, len(batches)), initializer=_init_worker, initargs=(stop_event,)) as pool:
+        for (packing, n), metrics in pool.imap(_run_worker_batch, [(packing_input, n, base_seed + i) for i, n in enumerate(batches)]):
+            METRICS.merge(metrics)
+            iterations_run += n
+            if packing is not None and packing.is_better_than(best_packing, packing_input.preference):
+                best_packing = packing
+                if on_improvement is not None: on_improvement(best_packing, iterations_run)
+    return best_packing, iterations_run
+
+
+'''
+the stop event of a single solve (see rch), the iterations set it once they used all the boxes or reached the upper bound
+flag = the event that is set (a multiprocessing event when the iterations run on a pool, so the workers share it)
+cancel_event = the stop event of the caller, it's only read, so the stop of a solve doesn't stop the next solves of the caller
+(e.g. the next containers of a fleet)
+'''
+class SolveStopEvent:
+    def __init__(self, flag, cancel_event = None):
+        self.flag = flag
+        self.cancel_event = cancel_event
+
+    def is_set(self) -> bool:
+        return self.flag.is_set() or (self.cancel_event is not None and self.cancel_event.is_set())
+
+    def set(self) -> None:
+        self.flag.set()
+
+
+# stop_event cancels the solve, it's never set by the solve itself
+def rch(packing_input: PackingInput, workers: int = PARALLEL_WORKERS, seed: int = RANDOM_SEED, stop_event = None, on_improvement = None) -> PackingResult:
+    start_time = time.time()
+    METRICS.count('solves')
+    packing_input.budget.start()
+    # computed before the input is sent to the workers, so they don't compute it again
+    packing_input.upper_bound()
+    iterations = packing_input.budget.iterations or ALGORITHM_REPEAT_COUNT
+    stop_event = SolveStopEvent(multiprocessing.get_context().Event() if workers > 1 else threading.Event(), stop_event)
+    if workers > 1:
+        best_packing, iterations_run = rch_parallel(packing_input, iterations, workers, seed, stop_event, on_improvement)
+    else:
+        best_packing, iterations_run = rch_iterations(packing_input, iterations, seed, stop_event, on_improvement)
+    if best_packing is None:
+        return PackingResult(error='The solve was stopped before the first iteration')
+
     print_debug(best_packing.get_stats(packing_input))
     best_packing.unfloat()
-    result = PackingResult(packing_input=packing_input, packing=best_packing)
+    result = PackingResult(packing_input=packing_input, packing=best_packing, iterations=iterations_run, elapsed=time.time() - start_time)
     return result
+
+
+# packs the boxes into the containers of the fleet one after the other (in the order of the input),
+# each container gets the boxes that are left from the previous ones and is solved by rch (with its parallel iterations)
+# the containers after the last box is packed stay empty, so the fleet uses as few containers of the order as it can
+# the budget of the input applies to each container
+# on_progress(fleet_result) is called after every packed container
+def rch_fleet(packing_input: PackingInput, workers: int = PARALLEL_WORKERS, seed: int = RANDOM_SEED, stop_event = None, on_progress = None) -> FleetResult:
+    start_time = time.time()
+    box_table = packing_input.box_table
+    results = []
+    iterations = 0
+    for i, container in enumerate(packing_input.containers):
+        if len(box_table) == 0: break
+        if stop_event is not None and stop_event.is_set(): break
+        result = rch(packing_input.for_container(container, box_table), workers, seed + i if seed is not None else None, stop_event)
+        if result.packing is None: break
+        iterations += result.iterations
+        # none of the boxes that are left fits in this container
+        if len(result.packing.boxes) == 0: continue
+        results.append((i, result))
+        box_table = box_table.subtract(result.packing.kind_counts())
+        if on_progress is not None:
+            on_progress(FleetResult(packing_input, list(results), box_table, iterations, time.time() - start_time))
+    return FleetResult(packing_input, results, box_table, iterations, time.time() - start_time)
     
 
 def parse_input(input_data: bytearray):
@@ -175,12 +429,16 @@ def parse_input(input_data: bytearray):
     return parsed_data
 
 
+def get_containers(input_data) -> list:
+    return input_data['containers'] if 'containers' in input_data else [input_data['container']]
+
+
 def get_scalar(input_data) -> int:
-    c = input_data['container']
+    containers = get_containers(input_data)
     scalars = []
     for dim in ['width', 'depth', 'height']:
         dim_list = list(map(lambda x: x[dim], input_data['packages']))
-        dim_list.append(c[dim])
+        dim_list.extend(c[dim] for c in containers)
         scalars.append(math.gcd(*dim_list))
     scalar = min(*scalars)
     return scalar
@@ -188,23 +446,104 @@ def get_scalar(input_data) -> int:
 
 def scale_input(input_data, scalar) -> None:
     if scalar == 1: return
-    c = input_data['container']
+    containers = get_containers(input_data)
     for dim in ['width', 'depth', 'height']:
         for pkg in input_data['packages']:
             pkg[dim] //= scalar
-        c[dim] //= scalar
-
-
-def pack(input_data):
-    result_json = None
-    try:
-        scalar = get_scalar(input_data)
+        for c in containers:
+            c[dim] //= scalar
+
+
+# scales the input data (in place) and parses it
+# with "resolution": "coarse" an input whose exact grid doesn't fit in the memory budget is solved on a coarser grid
+# the cost of the solve is checked first (see rch_admission.admit), it may be rejected (AdmissionRejected),
+# downscaled to a coarser grid (only with "resolution": "coarse") or get fewer iterations
+# concurrent_solves = number of solves that may run at the same time (e.g. the workers of the server), they share the memory limit
+def prepare_input(input_data, concurrent_solves: int = 1) -> PackingInput:
+    # the budget is validated before anything is estimated or scaled
+    budget = SolveBudget.from_json(input_data)
+    scalar = get_scalar(input_data)
+    grid = scalar
+    coarse = input_data.get('resolution', 'exact') == 'coarse'
+    if coarse:
+        memory_bytes = float(input_data.get('gridMemoryMB', GRID_MEMORY_MB)) * 2**20
+        grid = choose_grid(input_data['packages'], get_containers(input_data), scalar, memory_bytes)
+    admission = None
+    if ADMISSION_ENABLED:
+        iterations = budget.iterations if budget.iterations is not None else ALGORITHM_REPEAT_COUNT
+        admission = admit(input_data, grid, iterations, PARALLEL_WORKERS, PREFIX_CACHE_MB * 2**20 if PREFIX_REUSE else 0,
+                          concurrent_solves=concurrent_solves, downscale=coarse)
+        grid = admission.grid
+    if grid != scalar:
+        # the input keeps its units, the sizes are rounded to the grid when they're parsed
+        packing_input = PackingInput(input_data, 1, grid)
+    else:
         scale_input(input_data, scalar)
         packing_input = PackingInput(input_data, scalar)
-        result = rch(packing_input)
-        result_json = result.to_json()
+    if admission is not None:
+        packing_input.admission = admission
+        if admission.iterations is not None: packing_input.budget.iterations = admission.iterations
+    return packing_input
+
+
+def solve(packing_input: PackingInput):
+    if packing_input.is_fleet():
+        return rch_fleet(packing_input).to_json()
+    return rch(packing_input).to_json()
+
+
+'''
+an event of another process (a manager proxy) that is only asked every interval seconds, the solver checks its stop event
+every iteration and every call of a proxy is a round trip to the manager
+'''
+class PolledEvent:
+    def __init__(self, event, interval: float = CANCEL_POLL_INTERVAL):
+        self.event = event
+        self.interval = interval
+        self.checked = None
+        self.value = False
+
+    def is_set(self) -> bool:
+        if not self.value and (self.checked is None or time.monotonic() - self.checked >= self.interval):
+            self.value = self.event.is_set()
+            self.checked = time.monotonic()
+        return self.value
+
+    def set(self) -> None:
+        self.value = True
+        self.event.set()
+
+
+# solves the input and puts the best result so far on progress_queue after every improvement
+# the solve stops (with the best result so far) once cancel_event is set (it's checked every CANCEL_POLL_INTERVAL seconds)
+def solve_job(packing_input: PackingInput, progress_queue, cancel_event):
+    start_time = time.time()
+    cancel_event = PolledEvent(cancel_event)
+    def report_improvement(packing: Packing, iterations: int) -> None:
+        # the best packing is never changed by later iterations, so it can be unfloated already
+        packing.unfloat()
+        result = PackingResult(packing_input=packing_input, packing=packing, iterations=iterations, elapsed=time.time() - start_time)
+        progress_queue.put({ 'iterations': iterations, 'result': result.to_json() })
+    if packing_input.is_fleet():
+        # the progress of a fleet is reported per packed container
+        def report_container(result: FleetResult) -> None:
+            progress_queue.put({ 'iterations': result.iterations, 'result': result.to_json() })
+        return rch_fleet(packing_input, stop_event=cancel_event, on_progress=report_container).to_json()
+    return rch(packing_input, stop_event=cancel_event, on_improvement=report_improvement).to_json()
+
+
+def pack(input_data, cache: SolutionCache = None):
+    result_json = None
+    try:
+        packing_input = prepare_input(input_data)
+        if cache is not None:
+            result_json = cache.get(packing_input)
+        if result_json is None:
+            result_json = solve(packing_input)
+            if cache is not None:
+                cache.put(packing_input, result_json)
     except Exception as e:
-        result = PackingResult(error=f'Exception: {e}')
+        result_json = PackingResult(error=f'Exception: {e}').to_json()
         print_debug(traceback.format_exc())
     return result_json
 
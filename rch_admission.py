@@ -0,0 +1,139 @@
+import math
+import os
+from packing import *
+
+
+# half of the memory of the host in MB (2048 when it's unknown)
+def _default_memory_mb() -> float:
+    try:
+        return os.sysconf('SC_PHYS_PAGES') * os.sysconf('SC_PAGE_SIZE') / 2**21
+    except (ValueError, OSError, AttributeError):
+        return 2048
+
+
+# ADMISSION=0 solves every input as it is
+ADMISSION_ENABLED = os.environ.get('ADMISSION', '1') == '1'
+# limits checked against the estimate before the solver allocates anything, the memory is shared by all the
+# solves that run at the same time, the time is per solve
+ADMISSION_MEMORY_MB = float(os.environ.get('ADMISSION_MEMORY_MB', _default_memory_mb()))
+ADMISSION_TIME_LIMIT = float(os.environ.get('ADMISSION_TIME_LIMIT', '300'))
+ADMISSION_MAX_ITEMS = int(os.environ.get('ADMISSION_MAX_ITEMS', '200000'))
+
+# the time model of an iteration, fitted on the benchmark scenarios (within a factor of 2 of the measured time):
+# every placed box pays a fixed cost, an update of the prefix sums (proportional to the container volume)
+# and a search over the potential points (proportional to the number of boxes)
+SECONDS_PER_BOX = 2.4e-5
+SECONDS_PER_BOX_VOXEL = 3.3e-10
+SECONDS_PER_BOX_PAIR = 2.9e-7
+# the current construction, the best packing and the temporaries of an update each take a voxel map
+VOXEL_MAPS_PER_WORKER = 3
+# Box states, potential points and cuboids of a box, counted twice (the current construction and the best packing)
+BYTES_PER_BOX = 2 * 600
+
+
+class AdmissionRejected(Exception):
+    def __init__(self, message):
+        super().__init__(message)
+
+
+class CostEstimate:
+    '''
+    predicted cost of a solve, from the sizes of the input only
+    size = size of the largest container on the grid (volume = its voxels), items = number of boxes
+    rotatable = share of the boxes that may rotate (they are tried in more orientations)
+    memory = peak bytes of all the worker processes, iteration_time = seconds per iteration
+    '''
+    def __init__(self, size: Size, items: int, box_volume: int, rotatable: float, space_type: SpaceType, workers: int, reserved_bytes: float):
+        volume = math.prod(size)
+        self.volume = volume
+        self.items = items
+        self.rotatable = rotatable
+        # the boxes that don't fit are still tried, but only the placed ones grow the packing
+        placed = items * min(1.0, volume / box_volume) if box_volume > 0 else 0
+        self.iteration_time = (1 + rotatable) * (placed * SECONDS_PER_BOX + items * placed * SECONDS_PER_BOX_PAIR)
+        if space_type == SpaceType.VOXEL:
+            self.iteration_time += placed * volume * SECONDS_PER_BOX_VOXEL
+            self.map_bytes = voxel_bytes(size) * volume
+        else:
+            self.map_bytes = 0
+        self.worker_bytes = VOXEL_MAPS_PER_WORKER * self.map_bytes + reserved_bytes + items * BYTES_PER_BOX
+        self.memory = workers * self.worker_bytes
+
+    @classmethod
+    def from_input(cls, input_data, grid: int, workers: int = 1, reserved_bytes: float = 0):
+        space_type = SpaceType(input_data['space']) if 'space' in input_data else SpaceType.VOXEL
+        containers = input_data['containers'] if 'containers' in input_data else [input_data['container']]
+        size = max((floor_to_grid((int(c['width']), int(c['depth']), int(c['height'])), grid) for c in containers), key=math.prod)
+        items = 0
+        box_volume = 0
+        rotatable = 0
+        for pkg in input_data['packages']:
+            amount = int(pkg['amount'])
+            items += amount
+            box_volume += amount * math.prod(ceil_to_grid((int(pkg['width']), int(pkg['depth']), int(pkg['height'])), grid))
+            if str(pkg['canRotate']).lower() == 'true': rotatable += amount
+        return cls(size, items, box_volume, rotatable / items if items > 0 else 0, space_type, workers, reserved_bytes)
+
+
+class Admission:
+    '''
+    the decision on an input: actions = what was changed to fit the limits ('downscale_grid', 'cap_iterations'),
+    grid = the grid to solve on, iterations = the capped number of iterations (None = as requested)
+    '''
+    def __init__(self, estimate: CostEstimate, grid: int, iterations: int = None, actions: list[str] = None):
+        self.estimate = estimate
+        self.grid = grid
+        self.iterations = iterations
+        self.actions = actions or []
+
+    def to_json(self):
+        return {
+            'decision': 'accepted' if len(self.actions) == 0 else 'adjusted',
+            'actions': self.actions,
+            'memory_mb': self.estimate.memory / 2**20,
+            'iteration_time': self.estimate.iteration_time,
+            'iterations': self.iterations,
+            'grid': self.grid,
+        }
+
+
+# checks the estimated cost of the input against the limits, raises AdmissionRejected when it can't fit them
+# grid = the grid the input would be solved on, iterations = the iterations it would run (with the timeLimit of the request)
+# the memory limit is shared by the concurrent_solves that may run at the same time (each with its workers)
+# with downscale (the input opted in to the coarse resolution) a voxel map that needs too much memory is solved on
+# a coarser grid instead of being rejected, and the iterations are capped to the time limit
+def admit(input_data, grid: int, iterations: int, workers: int = 1, reserved_bytes: float = 0,
+          memory_limit: float = None, time_limit: float = None, max_items: int = None,
+          concurrent_solves: int = 1, downscale: bool = False) -> Admission:
+    memory_limit = (ADMISSION_MEMORY_MB if memory_limit is None else memory_limit) * 2**20 / max(1, concurrent_solves)
+    time_limit = ADMISSION_TIME_LIMIT if time_limit is None else time_limit
+    max_items = ADMISSION_MAX_ITEMS if max_items is None else max_items
+    estimate = CostEstimate.from_input(input_data, grid, workers, reserved_bytes)
+    actions = []
+    if estimate.items > max_items:
+        raise AdmissionRejected(f'The input has {estimate.items} boxes, at most {max_items} are allowed')
+
+    if estimate.memory > memory_limit and estimate.map_bytes > 0 and downscale:
+        # the memory that is left for the voxel maps after the boxes and the reserved memory
+        map_budget = (memory_limit / workers - (estimate.worker_bytes - VOXEL_MAPS_PER_WORKER * estimate.map_bytes)) / VOXEL_MAPS_PER_WORKER
+        if map_budget > 0:
+            containers = input_data['containers'] if 'containers' in input_data else [input_data['container']]
+            grid = choose_grid(input_data['packages'], containers, grid, map_budget)
+            estimate = CostEstimate.from_input(input_data, grid, workers, reserved_bytes)
+            actions.append('downscale_grid')
+    if estimate.memory > memory_limit:
+        hint = '' if downscale or estimate.map_bytes == 0 else ' (set "resolution": "coarse" to solve it on a coarser grid)'
+        raise AdmissionRejected(f'The solve needs about {estimate.memory / 2**20:.3g} MB, the limit is {memory_limit / 2**20:.3g} MB{hint}')
+
+    time_left = float(input_data['timeLimit']) if input_data.get('timeLimit') is not None else None
+    # the solver always runs the first iteration, even when it takes longer than the timeLimit of the request
+    iteration_limit = min(time_limit, time_left) if time_left is not None else time_limit
+    if estimate.iteration_time > iteration_limit:
+        raise AdmissionRejected(f'An iteration takes about {estimate.iteration_time:.3g} seconds, the limit is {iteration_limit:.3g} seconds')
+    capped = None
+    # a timeLimit within the limit already bounds the iterations
+    if time_left is None or time_left > time_limit:
+        if iterations * estimate.iteration_time / workers > time_limit:
+            capped = max(1, int(time_limit * workers / estimate.iteration_time))
+            actions.append('cap_iterations')
+    return Admission(estimate, grid, capped, actions)
@@ -0,0 +1,111 @@
+import math
+from rch_types import *
+from box import *
+
+
+# a packing whose score is within the tolerance of the upper bound is optimal
+BOUND_TOLERANCE = 1e-9
+
+
+def fits_in_container(kind: BoxType, container: Container) -> bool:
+    for rotation in kind.rotations:
+        size = rotation.permute(kind.size)
+        if size[0] <= container.size[0] and size[1] <= container.size[1] and size[2] <= container.size[2]:
+            return True
+    return False
+
+
+# value of the fractional knapsack, items = (value, cost, amount) of a single unit
+# the units are taken by decreasing value per cost until the capacity is used (the last one partially)
+def fractional_knapsack(items: list[tuple[float, float, int]], capacity: float) -> float:
+    total = 0.0
+    for value, cost, amount in sorted(items, key=lambda item: item[0] / item[1] if item[1] > 0 else math.inf, reverse=True):
+        if value <= 0: continue
+        if cost * amount <= capacity:
+            total += value * amount
+            capacity -= cost * amount
+        else:
+            total += value * capacity / cost
+            break
+    return total
+
+
+# upper bound of Packing.score(preference) for any packing of the boxes in the container
+# the value that fits by volume and by weight is bounded separately (each one as a fractional knapsack)
+def upper_bound(box_table: BoxTable, container: Container, preference: str = 'volume') -> float:
+    container_volume = container.size[0] * container.size[1] * container.size[2]
+    rows = [
+        (kind, amount) for kind, amount in zip(box_table.kinds, box_table.amounts)
+        if fits_in_container(kind, container) and kind.weight <= container.weight_limit
+    ]
+    volumes = [kind.size[0] * kind.size[1] * kind.size[2] for kind, _ in rows]
+    if preference == 'profit':
+        values = [kind.profit for kind, _ in rows]
+    elif preference == 'priority':
+        values = [kind.priority for kind, _ in rows]
+    else:
+        values = volumes
+
+    by_volume = fractional_knapsack([(value, volume, amount) for value, volume, (_, amount) in zip(values, volumes, rows)], container_volume)
+    by_weight = fractional_knapsack([(value, kind.weight, amount) for value, (kind, amount) in zip(values, rows)], container.weight_limit)
+    bound = min(by_volume, by_weight)
+    if preference not in ('profit', 'priority'):
+        # the volume score is the ratio of the container that is used
+        bound /= container_volume
+    return bound
+
+
+'''
+optimistic score of a packing under construction: its score so far plus the value of every box that may still be placed
+a box may still be placed while its weight fits in the weight that is left (the total weight only grows),
+and with the volume preference the packing can't use more than the volume of the container
+the pending boxes are grouped by weight, so the groups that don't fit anymore are dropped in order (heaviest first)
+'''
+class OptimisticBound:
+    def __init__(self, boxes: list[Box], container: Container, preference: str = 'volume'):
+        self.preference = preference
+        self.container_volume = container.size[0] * container.size[1] * container.size[2]
+        self.weight_left = container.weight_limit
+        self.pending_by_weight = {}
+        for box in boxes:
+            self.pending_by_weight[box.weight] = self.pending_by_weight.get(box.weight, 0) + self.value(box)
+        self.weights = sorted(self.pending_by_weight, reverse=True)
+        self.dropped_weights = 0
+        self.pending = sum(self.pending_by_weight.values())
+        self._drop_heavy()
+
+    def value(self, box: Box) -> float:
+        if self.preference == 'profit':   return box.profit
+        if self.preference == 'priority': return box.priority
+        return box.size[0] * box.size[1] * box.size[2]
+
+    def _drop_heavy(self) -> None:
+        while self.dropped_weights < len(self.weights) and self.weights[self.dropped_weights] > self.weight_left:
+            self.pending -= self.pending_by_weight[self.weights[self.dropped_weights]]
+            self.dropped_weights += 1
+
+    def _remove(self, box: Box) -> None:
+        value = self.value(box)
+        self.pending_by_weight[box.weight] -= value
+        # the value of a dropped group isn't pending anymore
+        if box.weight <= self.weight_left: self.pending -= value
+
+    # the box was placed, its value moves from the pending boxes to the packing
+    def placed(self, box: Box) -> None:
+        self._remove(box)
+        self.weight_left -= box.weight
+        self._drop_heavy()
+
+    # the box can't be placed anymore
+    def discarded(self, box: Box) -> None:
+        self._remove(box)
+
+    def optimistic_score(self, packing: Packing) -> float:
+        if self.preference == 'profit':   return packing.total_profit + self.pending
+        if self.preference == 'priority': return packing.total_priority + self.pending
+        used = packing.used_space.used_space_count
+        return min(used + self.pending, self.container_volume) / self.container_volume
+
+    # True iff the packing can't become better than a packing with the incumbent score (Packing.is_better_than)
+    def cannot_beat(self, packing: Packing, incumbent_score: float) -> bool:
+        return self.optimistic_score(packing) <= incumbent_score - BOUND_TOLERANCE * max(1.0, abs(incumbent_score))
@@ -0,0 +1,279 @@
+# distributed rch: a coordinator splits the iterations of a solve into seeded chunks (like rch_parallel)
+# and runs them on worker processes on other hosts, over TCP
+# usage: python rch_distributed.py worker PORT [HOST]    (start a worker, on 127.0.0.1 unless HOST is given)
+#        python rch_distributed.py solve INPUT HOST:PORT...  (solve an input with the workers)
+#
+# the messages are pickled, every message is signed with an HMAC of DISTRIBUTED_SECRET that is checked before
+# it's unpickled, a worker only listens on other hosts than 127.0.0.1 with a secret
+
+
+import selectors
+import signal
+import hashlib
+import hmac
+import threading
+import socket
+import struct
+import pickle
+import random
+import time
+import json
+import os
+import rch
+
+# comma-separated HOST:PORT addresses of the workers the server solves with (empty = solve locally)
+DISTRIBUTED_WORKERS = [address for address in os.environ.get('DISTRIBUTED_WORKERS', '').split(',') if address != '']
+# the key the messages between the coordinator and the workers are signed with (the same on all the hosts)
+DISTRIBUTED_SECRET = os.environ.get('DISTRIBUTED_SECRET', '').encode('utf-8')
+
+_HEADER = struct.Struct('!Q')
+_DIGEST_SIZE = hashlib.sha256().digest_size
+
+
+def _sign(data: bytes) -> bytes:
+    return hmac.new(DISTRIBUTED_SECRET, data, hashlib.sha256).digest()
+
+
+def send_message(connection: socket.socket, message) -> None:
+    data = pickle.dumps(message, protocol=pickle.HIGHEST_PROTOCOL)
+    connection.sendall(_HEADER.pack(len(data)) + _sign(data) + data)
+
+
+def _receive_exactly(connection: socket.socket, size: int) -> bytes:
+    chunks = []
+    while size > 0:
+        chunk = connection.recv(min(size, 1 << 20))
+        if chunk == b'': return None
+        chunks.append(chunk)
+        size -= len(chunk)
+    return b''.join(chunks)
+
+
+# returns None once the connection is closed (or it sent a message with a wrong signature)
+def receive_message(connection: socket.socket):
+    header = _receive_exactly(connection, _HEADER.size + _DIGEST_SIZE)
+    if header is None: return None
+    data = _receive_exactly(connection, _HEADER.unpack(header[:_HEADER.size])[0])
+    if data is None: return None
+    if not hmac.compare_digest(header[_HEADER.size:], _sign(data)):
+        rch.print_debug('dropped a connection with a wrong message signature')
+        return None
+    return pickle.loads(data)
+
+
+def parse_address(address: str) -> tuple[str, int]:
+    host, _, port = address.rpartition(':')
+    return (host, int(port))
+
+
+# runs a chunk in the process of a worker session (see WorkerSession), the stop event of the process is the one
+# of the session, returns (iterations_run, score, result_json)
+def _run_chunk(packing_input: rch.PackingInput, iterations: int, seed: int, time_left: float) -> tuple:
+    start_time = time.time()
+    # the deadline is sent as the time that is left, so the clocks of the hosts don't have to agree
+    packing_input.budget.deadline = start_time + time_left if time_left is not None else None
+    packing, iterations_run = rch.rch_iterations(packing_input, iterations, seed, rch._worker_stop_event)
+    if packing is None: return iterations_run, None, None
+    score = packing.score(packing_input.preference)
+    packing.unfloat()
+    result_json = rch.PackingResult(packing_input=packing_input, packing=packing, iterations=iterations_run, elapsed=time.time() - start_time).to_json()
+    return iterations_run, score, result_json
+
+
+'''
+the worker side of a coordinator connection
+messages from the coordinator:
+    ('input', packing_input)                            the input of the following chunks
+    ('run', index, iterations, seed, time_left)         run a chunk, answered with a 'result' message
+    ('cancel',)                                         stop the running chunk (it still sends its result)
+the result of a chunk is ('result', index, iterations_run, score, complete, result_json), where complete = the chunk
+stopped because it found a packing that can't be improved, and result_json is its best (unfloated) packing (or None)
+the chunks run in a process of the session (the coordinator sends one chunk at a time), so the sessions of a worker
+use their own cores and random state, a thread of the session waits for the result of the chunk
+the processes are started by a fork server, the worker itself has the threads of the other sessions
+'''
+class WorkerSession:
+    def __init__(self, connection: socket.socket):
+        self.connection = connection
+        self.send_lock = threading.Lock()
+        self.packing_input = None
+        context = rch.multiprocessing.get_context('forkserver')
+        self.stop_event = context.Event()
+        self.pool = context.Pool(1, initializer=rch._init_worker, initargs=(self.stop_event,))
+        self.cancelled = False
+        self.chunk = None
+
+    def run(self) -> None:
+        try:
+            while True:
+                message = receive_message(self.connection)
+                if message is None or message[0] == 'close': break
+                if message[0] == 'input':
+                    self.packing_input = message[1]
+                elif message[0] == 'run':
+                    self.stop_event.clear()
+                    self.cancelled = False
+                    self.chunk = threading.Thread(target=self.run_chunk, args=message[1:], daemon=True)
+                    self.chunk.start()
+                elif message[0] == 'cancel':
+                    self.cancelled = True
+                    self.stop_event.set()
+        finally:
+            self.stop_event.set()
+            if self.chunk is not None: self.chunk.join()
+            self.pool.terminate()
+            self.connection.close()
+
+    def run_chunk(self, index: int, iterations: int, seed: int, time_left: float) -> None:
+        iterations_run, score, result_json = self.pool.apply(_run_chunk, (self.packing_input, iterations, seed, time_left))
+        complete = self.stop_event.is_set() and not self.cancelled
+        try:
+            with self.send_lock:
+                send_message(self.connection, ('result', index, iterations_run, score, complete, result_json))
+        except OSError:
+            pass
+
+
+# a worker that listens on other hosts than 127.0.0.1 needs the DISTRIBUTED_SECRET of the coordinator
+def serve_worker(port: int, host: str = '127.0.0.1', on_listening = None) -> None:
+    if host not in ('127.0.0.1', 'localhost', '::1') and DISTRIBUTED_SECRET == b'':
+        raise ValueError(f'A worker on {host or "all the interfaces"} needs a DISTRIBUTED_SECRET')
+    # exit normally when the worker is terminated, so the processes of the sessions are terminated with it
+    signal.signal(signal.SIGTERM, lambda signum, frame: exit(0))
+    with socket.create_server((host, port)) as server:
+        if on_listening is not None: on_listening(server.getsockname()[1])
+        while True:
+            connection, _ = server.accept()
+            connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            threading.Thread(target=WorkerSession(connection).run, daemon=True).start()
+
+
+'''
+the coordinator side of a distributed solve
+chunk i runs (base seed + i) with the same split as rch_parallel, and the chunk results are reduced in the order
+of the chunks, so the same seed (and the same number of workers) gives the same result as long as the solve isn't
+stopped early (time budget, cancellation or a chunk that found a packing that can't be improved)
+the chunks are handed out one at a time to each worker, the chunk of a worker that disconnects is given to another one
+(unreachable workers are skipped, the split of the chunks still depends only on the number of addresses)
+'''
+class Coordinator:
+    def __init__(self, addresses: list[str], chunks_per_worker: int = rch.PARALLEL_CHUNKS_PER_WORKER):
+        self.addresses = addresses
+        self.chunks_per_worker = chunks_per_worker
+
+    def solve(self, packing_input: rch.PackingInput, seed: int = None, stop_event = None) -> dict:
+        start_time = time.time()
+        budget = packing_input.budget
+        budget.start()
+        packing_input.upper_bound()
+        iterations = budget.iterations or rch.ALGORITHM_REPEAT_COUNT
+        base_seed = seed if seed is not None else random.randrange(2**32)
+        chunks = rch.split_iterations(iterations, len(self.addresses) * self.chunks_per_worker)
+        pending = list(range(len(chunks)))
+        results = {}
+        running = {}
+        stopping = False
+
+        selector = selectors.DefaultSelector()
+        connections = []
+        try:
+            for address in self.addresses:
+                try:
+                    connection = socket.create_connection(parse_address(address))
+                except OSError as e:
+                    # the solve goes on with the workers that are reachable
+                    rch.print_debug(f'worker {address} is unreachable: {e}')
+                    continue
+                connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+                send_message(connection, ('input', packing_input))
+                connections.append(connection)
+                selector.register(connection, selectors.EVENT_READ)
+            live = list(connections)
+
+            def assign_chunks() -> None:
+                for connection in live:
+                    if stopping or len(pending) == 0: return
+                    if connection in running: continue
+                    index = pending.pop(0)
+                    time_left = max(0.0, budget.deadline - time.time()) if budget.deadline is not None else None
+                    send_message(connection, ('run', index, chunks[index], base_seed + index, time_left))
+                    running[connection] = index
+                if len(running) == 0 and len(pending) > 0 and not stopping:
+                    raise ConnectionError('All the workers disconnected')
+
+            def cancel_running() -> None:
+                for connection in running: send_message(connection, ('cancel',))
+
+            assign_chunks()
+            while len(running) > 0:
+                if not stopping and ((stop_event is not None and stop_event.is_set()) or budget.is_exhausted(0)):
+                    stopping = True
+                    cancel_running()
+                for key, _ in selector.select(timeout=0.1):
+                    connection = key.fileobj
+                    message = receive_message(connection)
+                    if message is None:
+                        # the worker is gone, its chunk goes back to the queue
+                        selector.unregister(connection)
+                        live.remove(connection)
+                        if connection in running: pending.insert(0, running.pop(connection))
+                    else:
+                        _, index, iterations_run, score, complete, result_json = message
+                        del running[connection]
+                        results[index] = (iterations_run, score, result_json)
+                        if complete and not stopping:
+                            stopping = True
+                            cancel_running()
+                    assign_chunks()
+            for connection in live: send_message(connection, ('close',))
+        finally:
+            selector.close()
+            for connection in connections: connection.close()
+
+        best_score, best_json = None, None
+        iterations_run = 0
+        for index in sorted(results):
+            n, score, result_json = results[index]
+            iterations_run += n
+            if score is not None and (best_score is None or score > best_score):
+                best_score, best_json = score, result_json
+        if best_json is None:
+            return rch.PackingResult(error='The solve was stopped before the first iteration').to_json()
+        best_json['stats']['iterations'] = iterations_run
+        best_json['stats']['time'] = time.time() - start_time
+        return best_json
+
+
+# rch.solve with the DISTRIBUTED_WORKERS (a fleet or a solve without workers runs locally)
+def solve(packing_input: rch.PackingInput):
+    if len(DISTRIBUTED_WORKERS) == 0 or packing_input.is_fleet():
+        return rch.solve(packing_input)
+    return Coordinator(DISTRIBUTED_WORKERS).solve(packing_input, rch.RANDOM_SEED)
+
+
+def _run_local_worker(ports) -> None:
+    serve_worker(0, '127.0.0.1', on_listening=ports.put)
+
+
+# starts count worker processes on this machine, returns the processes and their addresses
+# (they aren't daemons, a worker starts the processes of its sessions, so the caller terminates them)
+def start_local_workers(count: int):
+    context = rch.multiprocessing.get_context()
+    ports = context.Queue()
+    processes = [context.Process(target=_run_local_worker, args=(ports,)) for _ in range(count)]
+    for process in processes: process.start()
+    addresses = [f'127.0.0.1:{ports.get()}' for _ in processes]
+    return processes, addresses
+
+
+if __name__ == '__main__':
+    from sys import argv
+
+    if len(argv) in (3, 4) and argv[1] == 'worker':
+        serve_worker(int(argv[2]), *argv[3:])
+    elif len(argv) >= 4 and argv[1] == 'solve':
+        with open(argv[2], 'r') as in_file:
+            packing_input = rch.prepare_input(rch.parse_input(in_file.read()))
+        print(json.dumps(Coordinator(argv[3:]).solve(packing_input, rch.RANDOM_SEED), indent=2))
+    else:
+        print('usage: rch_distributed.py worker PORT [HOST] | rch_distributed.py solve INPUT HOST:PORT...')
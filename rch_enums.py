@@ -9,6 +9,12 @@ class UsedSpaceType(Enum):
     UNAVAIL  = 2
 
 
+@unique
+class SpaceType(Enum):
+    VOXEL     = 'voxel'
+    GEOMETRIC = 'geometric'
+
+
 @unique
 class PerturbOrder(Enum):
     VOLUME = auto()
@@ -0,0 +1,161 @@
+from rch_enums import *
+from rch_types import *
+import numpy as np
+
+
+# the container floor (width x depth) is split into GRID_CELLS x GRID_CELLS cells at most
+GRID_CELLS = 32
+
+
+class Cuboid:
+    __slots__ = ('begin', 'end', 'space_type', 'box')
+
+    def __init__(self, begin: Point, end: Point, space_type: UsedSpaceType, box: Box = None):
+        self.begin = begin
+        self.end = end
+        self.space_type = space_type
+        self.box = box
+
+    def intersects(self, begin: Point, end: Point) -> bool:
+        return all(self.begin[i] < end[i] and begin[i] < self.end[i] for i in range(3))
+
+    def footprint_overlap(self, begin: Point, end: Point) -> int:
+        w = min(self.end[0], end[0]) - max(self.begin[0], begin[0])
+        d = min(self.end[1], end[1]) - max(self.begin[1], begin[1])
+        return w * d if w > 0 and d > 0 else 0
+
+    def contains_column(self, x: int, y: int) -> bool:
+        return self.begin[0] <= x < self.end[0] and self.begin[1] <= y < self.end[1]
+
+
+'''
+occupancy map that keeps the placed boxes as axis-aligned cuboids instead of voxels
+the cuboids are indexed by a uniform grid over the container floor, so queries only look at nearby boxes
+memory grows with the number of boxes and not with the container volume
+the semantics are the same as UsedSpace (including the unavailable layer above non-stackable boxes)
+'''
+class GeometricSpace:
+    def __init__(self, size: Size):
+        self.size = size
+        self.volume = size[0]*size[1]*size[2]
+        self.used_space_count = 0
+        self.cuboids = []
+        self.cell_size = max(1, -(-max(size[0], size[1]) // GRID_CELLS))
+        self.grid = {}
+
+    def _cells(self, begin: Point, end: Point):
+        for i in range(begin[0] // self.cell_size, (max(begin[0], end[0] - 1)) // self.cell_size + 1):
+            for j in range(begin[1] // self.cell_size, (max(begin[1], end[1] - 1)) // self.cell_size + 1):
+                yield (i, j)
+
+    def _insert(self, cuboid: Cuboid) -> None:
+        self.cuboids.append(cuboid)
+        for cell in self._cells(cuboid.begin, cuboid.end):
+            self.grid.setdefault(cell, []).append(cuboid)
+
+    def _remove(self, cuboid: Cuboid) -> None:
+        self.cuboids.remove(cuboid)
+        for cell in self._cells(cuboid.begin, cuboid.end):
+            self.grid[cell].remove(cuboid)
+
+    # all cuboids whose grid cells overlap the given floor area (may include cuboids that don't touch it)
+    def _candidates(self, begin: Point, end: Point) -> list[Cuboid]:
+        candidates = {}
+        for cell in self._cells(begin, end):
+            for cuboid in self.grid.get(cell, ()):
+                candidates[id(cuboid)] = cuboid
+        return list(candidates.values())
+
+    def _is_free(self, begin: Point, end: Point) -> bool:
+        return not any(cuboid.intersects(begin, end) for cuboid in self._candidates(begin, end))
+
+    def _supporting_tops(self, begin: Point, end: Point, below: int, exclude: Box = None) -> list[int]:
+        tops = []
+        for cuboid in self._candidates(begin, end):
+            if cuboid.space_type != UsedSpaceType.USED or cuboid.box is exclude: continue
+            if cuboid.end[2] <= below and cuboid.footprint_overlap(begin, end) > 0:
+                tops.append(cuboid.end[2])
+        return tops
+
+    def is_floating(self, box: Box) -> bool:
+        x, y, z = box.position
+        if z == 0: return False
+        begin = (x, y, z)
+        end = (x + box.size[0], y + box.size[1], z)
+        return z not in self._supporting_tops(begin, end, z, exclude=box)
+
+    def unfloat(self, box: Box) -> None:
+        x, y, z = box.position
+        if z == 0: return
+        begin = (x, y, z)
+        end = (x + box.size[0], y + box.size[1], z)
+        new_z = max(self._supporting_tops(begin, end, z, exclude=box), default=0)
+        if new_z == z: return
+        # the floor area doesn't change, so the cuboid stays in its grid cells and moves in place
+        cuboid = next(c for c in self._candidates(begin, end) if c.box is box)
+        cuboid.begin = (x, y, new_z)
+        cuboid.end = (cuboid.end[0], cuboid.end[1], new_z + box.size[2])
+        box.set_position((x, y, new_z))
+
+    def ratio(self) -> float:
+        return self.used_space_count / self.volume
+
+    # the cuboids without their boxes, restore(snapshot, boxes) brings the space back to it
+    # memory of a snapshot, without taking it (100 bytes per cuboid is a rough estimate of a tuple of tuples)
+    def snapshot_nbytes(self) -> int:
+        return 100 * len(self.cuboids)
+
+    def snapshot(self) -> tuple:
+        return (self.used_space_count, [(cuboid.begin, cuboid.end, cuboid.space_type) for cuboid in self.cuboids])
+
+    # boxes = the boxes of the used cuboids of the snapshot, in the order they were added
+    # (they may be other Box objects at the same positions, e.g. the boxes of another iteration)
+    def restore(self, snapshot: tuple, boxes: list[Box]) -> None:
+        self.used_space_count = snapshot[0]
+        self.cuboids = []
+        self.grid = {}
+        boxes = iter(boxes)
+        for begin, end, space_type in snapshot[1]:
+            self._insert(Cuboid(begin, end, space_type, next(boxes) if space_type == UsedSpaceType.USED else None))
+
+    def add(self, box: Box, point: Point) -> None:
+        self.used_space_count += box.size[0]*box.size[1]*box.size[2]
+        end = (point[0] + box.size[0], point[1] + box.size[1], point[2] + box.size[2])
+        self._insert(Cuboid(point, end, UsedSpaceType.USED, box))
+        if not box.stackable and end[2] < self.size[2] - 1:
+            self._insert(Cuboid((point[0], point[1], end[2]), (end[0], end[1], end[2] + 1), UsedSpaceType.UNAVAIL))
+
+    def can_be_added(self, box: Box, point: Point) -> bool:
+        end = (point[0] + box.size[0], point[1] + box.size[1], point[2] + box.size[2])
+        if not box.stackable and end[2] < self.size[2] - 1:
+            if not self._is_free((point[0], point[1], end[2]), (end[0], end[1], self.size[2])): return False
+        return self._is_free(point, end)
+
+    def is_occupied(self, point: Point) -> bool:
+        end = (point[0] + 1, point[1] + 1, point[2] + 1)
+        return not self._is_free(point, end)
+
+    def vertical_projection(self, point: Point) -> Point:
+        x, y, z = point
+        if x >= self.size[0] or y >= self.size[1] or z >= self.size[2]: return None
+        projected_z = 0
+        for cuboid in self._candidates(point, (x + 1, y + 1, z + 1)):
+            if not cuboid.contains_column(x, y): continue
+            if cuboid.begin[2] <= z < cuboid.end[2]: return point
+            if cuboid.end[2] <= z: projected_z = max(projected_z, cuboid.end[2])
+        return (x, y, projected_z)
+
+    def get_support_score(self, box: Box, point: Point) -> float:
+        if point[2] == 0: return 1
+        end = (point[0] + box.size[0], point[1] + box.size[1], point[2])
+        supported_area = 0
+        for cuboid in self._candidates(point, end):
+            if cuboid.space_type == UsedSpaceType.USED and cuboid.end[2] == point[2]:
+                supported_area += cuboid.footprint_overlap(point, end)
+        return supported_area / (box.size[0] * box.size[1])
+
+    def can_be_added_batch(self, box: Box, points: np.ndarray) -> np.ndarray:
+        return np.array([self.can_be_added(box, tuple(point)) for point in points], dtype=bool)
+
+    def get_support_scores(self, box: Box, points: np.ndarray) -> np.ndarray:
+        return np.array([self.get_support_score(box, tuple(point)) for point in points], dtype=float)
@@ -0,0 +1,86 @@
+from rch_types import *
+import numpy as np
+
+
+'''
+set of the potential (extreme) points of a packing
+membership, insertion and removal are O(1) and duplicates are ignored
+the points are also indexed by their (x, y) bucket of BUCKET_SIZE x BUCKET_SIZE, so evicting the points under a box
+only looks at the points near it
+points are iterated in the order of the fit criterion (see rch.is_better_fit_point):
+by (z, x) for stackable boxes and by x for non-stackable boxes (their stack score is 0),
+so the first fully supported feasible point is the best one
+'''
+class PotentialPoints:
+    BUCKET_SIZE = 16
+
+    def __init__(self, points: list[Point] = ()):
+        self.points = {}
+        self.buckets = {}
+        self._ordered = {}
+        for point in points: self.add(point)
+
+    def _bucket(self, point: Point) -> tuple[int, int]:
+        return (point[0] // self.BUCKET_SIZE, point[1] // self.BUCKET_SIZE)
+
+    def __len__(self) -> int: return len(self.points)
+
+    def __contains__(self, point: Point) -> bool: return point in self.points
+
+    def __iter__(self): return iter(self.points)
+
+    def add(self, point: Point) -> bool:
+        if point in self.points: return False
+        self.points[point] = None
+        self.buckets.setdefault(self._bucket(point), set()).add(point)
+        self._ordered.clear()
+        return True
+
+    def remove(self, point: Point) -> None:
+        del self.points[point]
+        key = self._bucket(point)
+        self.buckets[key].discard(point)
+        if len(self.buckets[key]) == 0: del self.buckets[key]
+        self._ordered.clear()
+
+    # remove all the points inside the cuboid [begin, end), no box can be placed at them anymore
+    # only the buckets under the cuboid are looked at (or all the buckets, when there are fewer of them)
+    def evict_covered(self, begin: Point, end: Point) -> None:
+        if end[0] <= begin[0] or end[1] <= begin[1] or end[2] <= begin[2]: return
+        x0, y0 = self._bucket(begin)
+        x1, y1 = self._bucket((end[0] - 1, end[1] - 1))
+        if (x1 - x0 + 1) * (y1 - y0 + 1) <= len(self.buckets):
+            keys = [(x, y) for x in range(x0, x1 + 1) for y in range(y0, y1 + 1) if (x, y) in self.buckets]
+        else:
+            keys = [(x, y) for x, y in self.buckets if x0 <= x <= x1 and y0 <= y <= y1]
+        covered = []
+        for key in keys:
+            bucket = self.buckets[key]
+            inside = [p for p in bucket if begin[0] <= p[0] < end[0] and begin[1] <= p[1] < end[1] and begin[2] <= p[2] < end[2]]
+            if len(inside) == 0: continue
+            bucket.difference_update(inside)
+            if len(bucket) == 0: del self.buckets[key]
+            covered.extend(inside)
+        for point in covered: del self.points[point]
+        if len(covered) > 0: self._ordered.clear()
+
+    def ordered(self, stackable: bool) -> list[Point]:
+        if stackable not in self._ordered:
+            key = (lambda p: (p[2], p[0], p[1])) if stackable else (lambda p: (p[0], p[2], p[1]))
+            points = sorted(self.points, key=key)
+            self._ordered[stackable] = (points, np.array(points, dtype=np.int64).reshape(-1, 3))
+        return self._ordered[stackable][0]
+
+    # same as ordered, as an (n, 3) array
+    def as_array(self, stackable: bool) -> np.ndarray:
+        self.ordered(stackable)
+        return self._ordered[stackable][1]
+
+    def snapshot(self) -> dict:
+        return dict(self.points)
+
+    def restore(self, snapshot: dict) -> None:
+        self.points = dict(snapshot)
+        self.buckets = {}
+        for point in self.points: self.buckets.setdefault(self._bucket(point), set()).add(point)
+        self._ordered.clear()
@@ -0,0 +1,112 @@
+import collections
+import os
+from packing import *
+from metrics import *
+
+# memory of the packing snapshots kept by the prefix cache of a solve (per worker), in MB
+PREFIX_CACHE_MB = float(os.environ.get('PREFIX_CACHE_MB', '64'))
+# the trie stops growing after this many placements (the known prefixes are still reused)
+PREFIX_CACHE_MAX_NODES = 500000
+# a snapshot is only worth its copies when it saves replaying at least this many placements
+PREFIX_SNAPSHOT_MIN_REPLAY = 2
+
+
+class PrefixNode:
+    '''
+    a box of the first pass of construct_packing, after the boxes of its parents
+    position = where the box was placed (None = it didn't fit and went to the retry list)
+    state = snapshot of the packing right after the box (kept for a few nodes only)
+    '''
+    __slots__ = ('children', 'position', 'state')
+
+    def __init__(self, position: Point = None):
+        self.children = None
+        self.position = position
+        self.state = None
+
+
+'''
+trie of the first passes of the constructions of a solve, keyed by the box types and sizes in their order
+the first pass is deterministic (find_best_point only looks at the box, the packing and the potential points),
+so a construction whose boxes start with a known sequence places them at the known positions without searching
+the deepest snapshot on the path is restored and only the placements after it are replayed (Packing.add);
+a snapshot is taken where a construction leaves the trie, the point where the next sequences are likely to branch
+the snapshots are evicted least recently used first to stay within max_bytes
+combined boxes end the prefix (their combination isn't part of the key)
+'''
+class PrefixCache:
+    def __init__(self, max_bytes: float = PREFIX_CACHE_MB * 2**20, max_nodes: int = PREFIX_CACHE_MAX_NODES):
+        self.max_bytes = max_bytes
+        self.max_nodes = max_nodes
+        self.root = PrefixNode()
+        self.nodes = 1
+        self.states = collections.OrderedDict()
+        self.state_bytes = 0
+
+    @staticmethod
+    def key(box: Box):
+        return (box.kind, box.size) if box.combination is None else None
+
+    def _store(self, node: PrefixNode, state: PackingState) -> None:
+        node.state = state
+        self.states[node] = None
+        self.state_bytes += state.nbytes
+        while self.state_bytes > self.max_bytes:
+            evicted, _ = self.states.popitem(last=False)
+            self.state_bytes -= evicted.state.nbytes
+            evicted.state = None
+
+    # brings the (empty) packing and potential points to the state after the longest known prefix of the boxes
+    # and sets the positions of the placed boxes of the prefix, returns a cursor that records the rest of the first pass
+    def resume(self, boxes: list[Box], packing: Packing, potential_points: PotentialPoints) -> PrefixCursor:
+        path = []
+        node = self.root
+        checkpoint = 0
+        for box in boxes:
+            key = self.key(box)
+            if key is None or node.children is None or key not in node.children: break
+            node = node.children[key]
+            path.append(node)
+            if node.state is not None: checkpoint = len(path)
+
+        for box, step in zip(boxes, path):
+            if step.position is not None: box.set_position(step.position)
+        if checkpoint > 0:
+            state_node = path[checkpoint - 1]
+            self.states.move_to_end(state_node)
+            packing.restore(state_node.state, [box for box, step in zip(boxes[:checkpoint], path) if step.position is not None], potential_points)
+        for box, step in zip(boxes[checkpoint:len(path)], path[checkpoint:]):
+            if step.position is not None: packing.add(box, step.position, potential_points)
+
+        # the size is checked before the snapshot copies the space, a voxel map larger than the cache is never copied
+        if len(path) - checkpoint >= PREFIX_SNAPSHOT_MIN_REPLAY and len(path) < len(boxes) and packing.snapshot_nbytes(potential_points) <= self.max_bytes:
+            self._store(node, packing.snapshot(potential_points))
+            METRICS.count('prefix_snapshots')
+        METRICS.count('prefix_boxes_reused', len(path))
+        failed = [box for box, step in zip(boxes, path) if step.position is None]
+        return PrefixCursor(self, node, len(path), failed)
+
+
+class PrefixCursor:
+    '''
+    position of a construction in the trie (see PrefixCache.resume)
+    depth = number of boxes of the known prefix, failed = the boxes of the prefix that went to the retry list
+    '''
+    def __init__(self, cache: PrefixCache, node: PrefixNode, depth: int, failed: list[Box]):
+        self.cache = cache
+        self.node = node
+        self.depth = depth
+        self.failed = failed
+
+    # the next box of the first pass was placed at position (None = it didn't fit)
+    def record(self, box: Box, position: Point) -> None:
+        if self.node is None: return
+        key = PrefixCache.key(box)
+        if key is None or self.cache.nodes >= self.cache.max_nodes:
+            self.node = None
+            return
+        child = PrefixNode(position)
+        if self.node.children is None: self.node.children = {}
+        self.node.children[key] = child
+        self.cache.nodes += 1
+        self.node = child
@@ -0,0 +1,103 @@
+import math
+import os
+import numpy as np
+from rch_types import *
+from rch_used_space import UsedSpace
+
+# memory of the voxel map of the largest container in the coarse resolution mode, in MB
+GRID_MEMORY_MB = float(os.environ.get('GRID_MEMORY_MB', '256'))
+
+
+# bytes per voxel of UsedSpace: the int8 map and the two summed-area tables
+def voxel_bytes(size: Size) -> int:
+    return UsedSpace.bytes_per_voxel(size)
+
+
+def ceil_to_grid(size: Size, cell: int) -> Size:
+    return tuple(-(-dim // cell) for dim in size)
+
+
+def floor_to_grid(size: Size, cell: int) -> Size:
+    return tuple(dim // cell for dim in size)
+
+
+def _volume(size) -> int: return size[0] * size[1] * size[2]
+
+
+def _sizes(items: list) -> list[Size]:
+    return [(int(item['width']), int(item['depth']), int(item['height'])) for item in items]
+
+
+# the edge of the voxel grid for the packages and containers (in input units), so the voxel map of the largest
+# container fits in memory_bytes, the exact scalar is kept when it fits
+# any grid up to twice the coarsest one fits as well, the one that loses the least volume by rounding is picked
+# (the package sizes are rounded up and the container sizes down)
+def choose_grid(packages: list, containers: list, exact_scalar: int, memory_bytes: float) -> int:
+    package_sizes = _sizes(packages)
+    amounts = [int(pkg['amount']) for pkg in packages]
+    container_sizes = _sizes(containers)
+
+    def memory(cell: int) -> int:
+        return max(voxel_bytes(floor_to_grid(size, cell)) * _volume(floor_to_grid(size, cell)) for size in container_sizes)
+
+    def waste(cell: int) -> float:
+        packages_volume = sum(amount * _volume(size) for size, amount in zip(package_sizes, amounts))
+        rounded_volume = sum(amount * _volume(ceil_to_grid(size, cell)) * cell**3 for size, amount in zip(package_sizes, amounts))
+        kept = sum(_volume(floor_to_grid(size, cell)) * cell**3 / _volume(size) for size in container_sizes) / len(container_sizes)
+        return math.inf if kept == 0 else rounded_volume / max(1, packages_volume) / kept
+
+    if memory(exact_scalar) <= memory_bytes: return exact_scalar
+    # the volume shrinks with the cube of the cell, so start close to the coarsest grid
+    cell = max(exact_scalar + 1, int((memory(1) / memory_bytes) ** (1 / 3)))
+    while memory(cell) > memory_bytes: cell += 1
+    return min(range(cell, 2 * cell + 1), key=lambda c: (waste(c), c))
+
+
+# positions (in input units) of boxes that were placed on a coarse grid, moved back to their exact sizes
+# cell_begin, cell_size = position and (rotated) size of the boxes in cells, size = their exact (rotated) sizes
+# boxes that were apart along an axis stay in the same order along it, each box is moved back to the end of
+# the boxes before it (a longest path over the exact sizes), and then every box falls onto the boxes below it
+# so a box never gets closer to the origin than the exact sizes allow and the packing stays collision-free
+# the memory is linear in the number of boxes (the boxes before a box are found with a sweep along x and y,
+# and along z with a pass over the boxes that end below it)
+def compact_positions(cell_begin: np.ndarray, cell_size: np.ndarray, size: np.ndarray, stackable: np.ndarray, cell_height: int, height: int) -> np.ndarray:
+    n = len(size)
+    cell_end = cell_begin + cell_size
+    # the unavailable layer above a non-stackable box (see UsedSpace.add)
+    layer = (~stackable & (cell_end[:, 2] < cell_height - 1)).astype(np.int64)
+    position = np.zeros((n, 3), dtype=np.int64)
+    for axis in range(2):
+        # the boxes that end before a box begins were all placed before it (in the order of their beginnings)
+        ends = np.argsort(cell_end[:, axis], kind='stable')
+        ended = 0
+        reach = 0
+        for j in np.argsort(cell_begin[:, axis], kind='stable'):
+            while ended < n and cell_end[ends[ended], axis] <= cell_begin[j, axis]:
+                reach = max(reach, position[ends[ended], axis] + size[ends[ended], axis])
+                ended += 1
+            position[j, axis] = reach
+    # along z only the boxes below whose floors overlap count (the others are already apart along x or y),
+    # they are among the boxes that end before the box begins
+    ends = np.argsort(cell_end[:, 2], kind='stable')
+    end_z = cell_end[ends, 2]
+    begin_x, begin_y = cell_begin[ends, 0], cell_begin[ends, 1]
+    end_x, end_y = cell_end[ends, 0], cell_end[ends, 1]
+    extent = size[ends, 2] + layer[ends]
+    for j in np.argsort(cell_begin[:, 2], kind='stable'):
+        k = np.searchsorted(end_z, cell_begin[j, 2], side='right')
+        if k == 0: continue
+        previous = (begin_x[:k] < cell_end[j, 0]) & (cell_begin[j, 0] < end_x[:k]) & (begin_y[:k] < cell_end[j, 1]) & (cell_begin[j, 1] < end_y[:k])
+        if previous.any(): position[j, 2] = (position[ends[:k][previous], 2] + extent[:k][previous]).max()
+
+    # the boxes no longer line up after the compaction, so let them fall (bottom-up)
+    order = np.argsort(position[:, 2], kind='stable')
+    begin_x, begin_y = position[order, 0], position[order, 1]
+    end_x, end_y = begin_x + size[order, 0], begin_y + size[order, 1]
+    # the tops of the boxes in the order they fell
+    top = np.zeros(n, dtype=np.int64)
+    for k, i in enumerate(order):
+        under = (begin_x[:k] < end_x[k]) & (begin_x[k] < end_x[:k]) & (begin_y[:k] < end_y[k]) & (begin_y[k] < end_y[:k])
+        position[i, 2] = min(position[i, 2], top[:k][under].max(initial=0))
+        top[k] = position[i, 2] + size[i, 2]
+        if not stackable[i] and top[k] < height - 1: top[k] += 1
+    return position
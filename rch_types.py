@@ -1,4 +1,5 @@
 from rch_enums import *
+import time
 
 
 class PackingInput: pass
@@ -6,6 +7,11 @@ class Combination:  pass
 class Rotation3D:   pass
 class Packing:      pass
 class Box:          pass
+class BoxTable:     pass
+class SolveBudget:  pass
+class PackingState: pass
+class PrefixCache:  pass
+class PrefixCursor: pass
 
 
 Point = tuple[int, int, int]
@@ -18,6 +24,56 @@ class Container:
         self.weight_limit = weight_limit
 
 
+class InvalidBudget(ValueError):
+    def __init__(self, message):
+        super().__init__(message)
+
+
+class SolveBudget:
+    '''
+    limits of a single solve, the solver returns the best packing found when any of them is reached
+    iterations = maximal number of iterations (None = the default of the solver)
+    time_limit = wall-clock budget in seconds (None = no limit)
+    patience = stop after this many iterations in a row without an improvement (None = no limit)
+    '''
+    def __init__(self, iterations: int = None, time_limit: float = None, patience: int = None):
+        self.iterations = iterations
+        self.time_limit = time_limit
+        self.patience = patience
+        self.deadline = None
+
+    # raises InvalidBudget when a limit isn't a number or would stop the solve before its first iteration
+    @classmethod
+    def from_json(cls, json_data):
+        def limit(name: str, parse, minimum):
+            value = json_data.get(name)
+            if value is None: return None
+            try:
+                value = parse(value)
+            except (TypeError, ValueError):
+                raise InvalidBudget(f"'{name}' must be a number, got {json_data[name]!r}")
+            # not (value > minimum) also rejects nan
+            if not value > minimum: raise InvalidBudget(f"'{name}' must be greater than {minimum}, got {value}")
+            return value
+        return cls(limit('iterations', int, 0), limit('timeLimit', float, 0), limit('patience', int, 0))
+
+    # the deadline is absolute (wall-clock), so it's the same for all the worker processes
+    def start(self) -> None:
+        self.deadline = time.time() + self.time_limit if self.time_limit is not None else None
+
+    # True iff a solve with this budget ran at least as long as a solve with the other budget: every limit is
+    # at least the same (None = no limit, for iterations None = the default of the solver, which only covers itself)
+    def covers(self, other: SolveBudget) -> bool:
+        def at_least(limit, other_limit) -> bool:
+            return limit is None or (other_limit is not None and limit >= other_limit)
+        if (self.iterations is None) != (other.iterations is None): return False
+        return at_least(self.iterations, other.iterations) and at_least(self.time_limit, other.time_limit) and at_least(self.patience, other.patience)
+
+    def is_exhausted(self, iterations_without_improvement: int) -> bool:
+        if self.deadline is not None and time.time() >= self.deadline: return True
+        return self.patience is not None and iterations_without_improvement >= self.patience
+
+
 # rotation in degrees
 class Rotation3D():
     def __init__(self, x: int = 0, y: int = 0, z: int = 0):
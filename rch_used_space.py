@@ -1,19 +1,145 @@
 from rch_enums import *
 from rch_types import *
+import os
 import numpy as np
 
 
+# the summed-area tables are rebuilt once the queries checked this many pending cuboids per voxel of the container
+# since the last rebuild (see UsedSpace.update_sats)
+SAT_REBUILD_RATIO = float(os.environ.get('SAT_REBUILD_RATIO', '0.25'))
+# a cuboid whose suffix of the tables has at most this many voxels is added to the tables right away, that's cheaper
+# than counting it in the queries
+SAT_EAGER_VOXELS = int(os.environ.get('SAT_EAGER_VOXELS', str(2**18)))
+
+
 class OccupiedSpace(Exception):
     def __init__(self, message):
         super().__init__(message)
 
 
+# the unsigned type of a summed-area table that counts regions of at most cells voxels
+# the table is kept modulo the range of its type, a count of fewer voxels than that is still exact
+def sat_dtype(cells: int):
+    return np.uint16 if cells < 2**16 else np.uint32 if cells < 2**32 else np.uint64
+
+
 class UsedSpace:
     def __init__(self, size: Size):
         self.size = size
         self.volume = size[0]*size[1]*size[2]
         self.used_space_count = 0
-        self.used_space_map = np.zeros(size)
+        # int8 is enough for UsedSpaceType
+        self.used_space_map = np.zeros(size, dtype=np.int8)
+        # summed-area tables of the occupied (used or unavailable) voxels and of the used voxels:
+        # occupied_sat[x, y, z] = number of occupied voxels in [0, x) x [0, y) x [0, z)
+        # the used voxels are only counted in the layer under a box, so that table is sized by the floor
+        # (usually 2 bytes per voxel) and the occupied one by the volume
+        self.occupied_sat = np.zeros((size[0] + 1, size[1] + 1, size[2] + 1), dtype=sat_dtype(self.volume))
+        self.used_sat = np.zeros((size[0] + 1, size[1] + 1, size[2] + 1), dtype=sat_dtype(size[0] * size[1]))
+        # the tables are updated lazily: a change of a voxel changes the whole suffix of the tables after it, so the
+        # cuboids added since the last update are kept in pending (begins, ends, is_used) and the queries count them on
+        # top of the tables, stale = the tables don't match the voxel map (e.g. after unfloat), see update_sats
+        self.pending = (np.zeros((0, 3), dtype=np.int64), np.zeros((0, 3), dtype=np.int64), np.zeros(0, dtype=bool))
+        self.pending_checks = 0
+        self.stale = False
+        # 2.5D index of the top surface: for each (x, y) column the z right above the highest
+        # occupied voxel (0 for an empty column) and the UsedSpaceType of that voxel
+        self.height_map = np.zeros(size[:2], dtype=np.int32)
+        self.top_type_map = np.zeros(size[:2], dtype=np.int8)
+
+    def _update_height_map(self, begin_w: int, end_w: int, begin_d: int, end_d: int, top: int, space_type: UsedSpaceType) -> None:
+        heights = self.height_map[begin_w:end_w, begin_d:end_d]
+        is_top = heights <= top
+        heights[is_top] = top
+        self.top_type_map[begin_w:end_w, begin_d:end_d][is_top] = space_type.value
+
+    # mask of the columns in the area that have a used voxel right below z
+    # columns whose top surface is at z are answered by the height map, only columns
+    # that are occupied above z (e.g. under an overhang) need to look at the voxel layer
+    def _support_mask(self, begin_w: int, end_w: int, begin_d: int, end_d: int, z: int) -> np.ndarray:
+        heights = self.height_map[begin_w:end_w, begin_d:end_d]
+        supported = (heights == z) & (self.top_type_map[begin_w:end_w, begin_d:end_d] == UsedSpaceType.USED.value)
+        covered = heights > z
+        if covered.any():
+            supported |= covered & (self.used_space_map[begin_w:end_w, begin_d:end_d, z - 1] == UsedSpaceType.USED.value)
+        return supported
+
+    # bytes per voxel of the voxel map and the summed-area tables of a container (without the 2D maps)
+    @staticmethod
+    def bytes_per_voxel(size: Size) -> int:
+        return 1 + np.dtype(sat_dtype(size[0] * size[1] * size[2])).itemsize + np.dtype(sat_dtype(size[0] * size[1])).itemsize
+
+    # brings the summed-area tables up to date with the voxel map once they're stale, or once the queries spent about as
+    # much time on the pending cuboids as a rebuild takes
+    # (adding a cuboid to the tables right away touched the whole suffix of the tables after it, O(container volume) per add,
+    # now an add is O(box volume) and the rebuilds are paid by the queries)
+    def update_sats(self, force: bool = False) -> None:
+        if not (force or self.stale or self.pending_checks >= SAT_REBUILD_RATIO * self.volume): return
+        for sat, voxels in [(self.occupied_sat, self.used_space_map != UsedSpaceType.NOT_USED.value), (self.used_sat, self.used_space_map == UsedSpaceType.USED.value)]:
+            table = sat[1:, 1:, 1:]
+            table[...] = voxels
+            # the sums wrap around in the unsigned table (see sat_dtype)
+            for axis in range(3): np.cumsum(table, axis=axis, out=table)
+        self.pending = (self.pending[0][:0], self.pending[1][:0], self.pending[2][:0])
+        self.pending_checks = 0
+        self.stale = False
+
+    # add value to every voxel of the cuboid [begin, end) in the summed-area table
+    # the change is separable, so it's an outer product of the overlap along each axis over the suffix of the table after begin
+    def _add_cuboid_to_sat(self, sat: np.ndarray, begin: Point, end: Point, value: int) -> None:
+        overlaps = [np.minimum(np.arange(1, self.size[i] - begin[i] + 1, dtype=sat.dtype), end[i] - begin[i]) for i in range(3)]
+        sat[begin[0]+1:, begin[1]+1:, begin[2]+1:] += (value * overlaps[0])[:, None, None] * np.multiply.outer(overlaps[1], overlaps[2])
+
+    # adds an occupied cuboid (also used with is_used) to the tables, right away when its suffix is small, otherwise to pending
+    def _add_to_sats(self, begin: Point, end: Point, is_used: bool) -> None:
+        if self.stale: return
+        if (self.size[0] - begin[0]) * (self.size[1] - begin[1]) * (self.size[2] - begin[2]) <= SAT_EAGER_VOXELS:
+            self._add_cuboid_to_sat(self.occupied_sat, begin, end, 1)
+            if is_used: self._add_cuboid_to_sat(self.used_sat, begin, end, 1)
+            return
+        begins, ends, used = self.pending
+        self.pending = (np.vstack([begins, begin]), np.vstack([ends, end]), np.append(used, is_used))
+
+    # number of voxels of the pending cuboids in [begin, end) (only of the used ones with used)
+    # begin and end are either points or (n, 3) arrays of points, like for _sat_count
+    def _pending_count(self, begin, end, used: bool = False):
+        begins, ends, is_used = self.pending
+        if used: begins, ends = begins[is_used], ends[is_used]
+        if len(begins) == 0: return 0
+        if isinstance(begin, tuple):
+            self.pending_checks += len(begins)
+            overlaps = np.minimum(end, ends) - np.maximum(begin, begins)
+            return int(np.clip(overlaps, 0, None).prod(axis=1).sum())
+        self.pending_checks += len(begin) * len(begins)
+        overlaps = np.minimum(end[:, None, :], ends[None, :, :]) - np.maximum(begin[:, None, :], begins[None, :, :])
+        return np.clip(overlaps, 0, None).prod(axis=2).sum(axis=1)
+
+    # number of voxels in [begin, end) counted by the summed-area table, eight lookups regardless of the size
+    # begin and end are either points or (n, 3) arrays of points
+    # the sum is taken modulo the range of the table (see sat_dtype)
+    @staticmethod
+    def _sat_count(sat: np.ndarray, begin, end):
+        modulus = 1 << (8 * sat.itemsize)
+        if isinstance(begin, tuple):
+            x0, y0, z0 = begin
+            x1, y1, z1 = end
+            return (
+                int(sat[x1, y1, z1]) - int(sat[x0, y1, z1]) - int(sat[x1, y0, z1]) - int(sat[x1, y1, z0])
+                + int(sat[x0, y0, z1]) + int(sat[x0, y1, z0]) + int(sat[x1, y0, z0]) - int(sat[x0, y0, z0])
+            ) % modulus
+        x0, y0, z0 = begin.T
+        x1, y1, z1 = end.T
+        # a uint64 table never wraps around, its counts fit in int64
+        if sat.dtype == np.uint64: sat = sat.view(np.int64)
+        count = (
+            sat[x1, y1, z1].astype(np.int64) - sat[x0, y1, z1] - sat[x1, y0, z1] - sat[x1, y1, z0]
+            + sat[x0, y0, z1] + sat[x0, y1, z0] + sat[x1, y0, z0] - sat[x0, y0, z0]
+        )
+        return count if sat.dtype == np.int64 else count % modulus
+
+    def occupied_count(self, begin: Point, end: Point) -> int:
+        self.update_sats()
+        return int(self._sat_count(self.occupied_sat, begin, end)) + self._pending_count(begin, end)
 
     def is_floating(self, box: Box) -> bool:
         if box.position[2] == 0: return False
@@ -21,24 +147,58 @@ class UsedSpace:
         end_w = begin_w + box.size[0]
         begin_d = box.position[1]
         end_d = begin_d + box.size[1]
-        area_below = self.used_space_map[begin_w:end_w, begin_d:end_d, box.position[2] - 1]
-        return np.all(area_below != UsedSpaceType.USED.value)
+        return not self._support_mask(begin_w, end_w, begin_d, end_d, box.position[2]).any()
 
+    # moves the box straight down onto the highest used voxel under it (or the floor), in a single move
+    # the voxels the box passes on the way keep their type
     def unfloat(self, box: Box) -> None:
-        while self.is_floating(box):
-            z = box.position[2]
-            x, y, _ = box.position
-            box.position = (x, y, z - 1)
-            begin_w = box.position[0]
-            end_w = begin_w + box.size[0]
-            begin_d = box.position[1]
-            end_d = begin_d + box.size[1]
-            self.used_space_map[begin_w:end_w, begin_d:end_d, z + box.size[2] - 1] = UsedSpaceType.NOT_USED.value
-            self.used_space_map[begin_w:end_w, begin_d:end_d, z - 1] = UsedSpaceType.USED.value
+        if not self.is_floating(box): return
+        x, y, z = box.position
+        end_w = x + box.size[0]
+        end_d = y + box.size[1]
+        top = z + box.size[2]
+        below = self.used_space_map[x:end_w, y:end_d, :z] == UsedSpaceType.USED.value
+        # the top of the highest used voxel of each column below the box
+        tops = z - below[:, :, ::-1].argmax(axis=2)
+        new_z = int(tops[below.any(axis=2)].max(initial=0))
+        new_top = new_z + box.size[2]
+
+        self.used_space_map[x:end_w, y:end_d, z:top] = UsedSpaceType.NOT_USED.value
+        self.used_space_map[x:end_w, y:end_d, new_z:new_top] = UsedSpaceType.USED.value
+        box.set_position((x, y, new_z))
+        # the boxes are usually settled one after the other, the tables are rebuilt once for all of them
+        self.stale = True
+
+        # the columns the box was the top of get the highest occupied voxel that is left
+        heights = self.height_map[x:end_w, y:end_d]
+        was_top = heights == top
+        if was_top.any():
+            column = self.used_space_map[x:end_w, y:end_d, :top]
+            depth = (column != UsedSpaceType.NOT_USED.value)[:, :, ::-1].argmax(axis=2)
+            heights[was_top] = (top - depth)[was_top]
+            top_types = np.take_along_axis(column, (top - 1 - depth)[:, :, None], axis=2)[:, :, 0]
+            self.top_type_map[x:end_w, y:end_d][was_top] = top_types[was_top]
 
     def ratio(self) -> float:
         return self.used_space_count / self.volume
 
+    # copy of the state, restore(snapshot) brings the space back to it (see rch_prefix_cache)
+    # memory of a snapshot, without taking it
+    def snapshot_nbytes(self) -> int:
+        return sum(array.nbytes for array in (self.used_space_map, self.occupied_sat, self.used_sat, self.height_map, self.top_type_map))
+
+    def snapshot(self) -> tuple:
+        return (self.used_space_count, self.pending, self.stale, self.used_space_map.copy(), self.occupied_sat.copy(), self.used_sat.copy(), self.height_map.copy(), self.top_type_map.copy())
+
+    # boxes = the boxes that were in the space when the snapshot was taken (not needed by the voxels)
+    # the arrays are copied again, so the snapshot can be restored any number of times
+    def restore(self, snapshot: tuple, boxes: list[Box]) -> None:
+        self.used_space_count = snapshot[0]
+        self.pending = snapshot[1]
+        self.pending_checks = 0
+        self.stale = snapshot[2]
+        self.used_space_map, self.occupied_sat, self.used_sat, self.height_map, self.top_type_map = (array.copy() for array in snapshot[3:])
+
     def add(self, box: Box, point: Point) -> None:
         self.used_space_count += box.size[0]*box.size[1]*box.size[2]
         begin_w = point[0]
@@ -46,8 +206,12 @@ class UsedSpace:
         begin_d = point[1]
         end_d = begin_d + box.size[1]
         self.used_space_map[begin_w:end_w, begin_d:end_d, point[2]:point[2]+box.size[2]] = UsedSpaceType.USED.value
+        self._update_height_map(begin_w, end_w, begin_d, end_d, point[2] + box.size[2], UsedSpaceType.USED)
+        self._add_to_sats(point, (end_w, end_d, point[2] + box.size[2]), True)
         if not box.stackable and point[2] + box.size[2] < self.size[2] - 1:
             self.used_space_map[begin_w:end_w, begin_d:end_d, point[2]+box.size[2]] = UsedSpaceType.UNAVAIL.value
+            self._update_height_map(begin_w, end_w, begin_d, end_d, point[2] + box.size[2] + 1, UsedSpaceType.UNAVAIL)
+            self._add_to_sats((begin_w, begin_d, point[2] + box.size[2]), (end_w, end_d, point[2] + box.size[2] + 1), False)
 
     def can_be_added(self, box: Box, point: Point) -> bool:
         begin_w = point[0]
@@ -58,16 +222,19 @@ class UsedSpace:
         end_h = begin_h + box.size[2]
         
         if not box.stackable and end_h < self.size[2] - 1:
-            area_above = self.used_space_map[begin_w:end_w, begin_d:end_d, end_h:self.size[2]]
-            is_area_above_free = np.all(area_above == UsedSpaceType.NOT_USED.value)
+            is_area_above_free = self.occupied_count((begin_w, begin_d, end_h), (end_w, end_d, self.size[2])) == 0
             if not is_area_above_free: return False
         
-        box_area = self.used_space_map[begin_w:end_w, begin_d:end_d, begin_h:end_h]
-        return np.all(box_area == UsedSpaceType.NOT_USED.value)
+        return self.occupied_count((begin_w, begin_d, begin_h), (end_w, end_d, end_h)) == 0
         
+    def is_occupied(self, point: Point) -> bool:
+        return self.used_space_map[point] != UsedSpaceType.NOT_USED.value
+
     def vertical_projection(self, point: Point) -> Point:
         x, y, z = point
         if x >= self.size[0] or y >= self.size[1] or z >= self.size[2]: return None
+        # everything above the top surface of the column is free
+        if z >= self.height_map[x, y]: return (x, y, int(self.height_map[x, y]))
         if self.used_space_map[x, y, z] != UsedSpaceType.NOT_USED.value: return point
 
         while z > 0 and self.used_space_map[x, y, z - 1] == UsedSpaceType.NOT_USED.value:
@@ -81,6 +248,29 @@ class UsedSpace:
         end_w = begin_w + box.size[0]
         begin_d = point[1]
         end_d = begin_d + box.size[1]
-        count = np.count_nonzero(self.used_space_map[begin_w:end_w, begin_d:end_d, point[2] - 1] == UsedSpaceType.USED.value)
+        count = np.count_nonzero(self._support_mask(begin_w, end_w, begin_d, end_d, point[2]))
         return count / (box.size[0] * box.size[1])
 
+    # vectorized can_be_added for an (n, 3) array of points (all inside the container)
+    def can_be_added_batch(self, box: Box, points: np.ndarray) -> np.ndarray:
+        self.update_sats()
+        ends = points + np.array(box.size)
+        is_free = self._sat_count(self.occupied_sat, points, ends) + self._pending_count(points, ends) == 0
+        if not box.stackable and ends.shape[0] > 0:
+            check_above = ends[:, 2] < self.size[2] - 1
+            begins_above = points.copy()
+            begins_above[:, 2] = ends[:, 2]
+            ends_above = ends.copy()
+            ends_above[:, 2] = self.size[2]
+            is_free &= ~check_above | (self._sat_count(self.occupied_sat, begins_above, ends_above) + self._pending_count(begins_above, ends_above) == 0)
+        return is_free
+
+    # vectorized get_support_score for an (n, 3) array of points, counts the used voxels right below the footprint
+    def get_support_scores(self, box: Box, points: np.ndarray) -> np.ndarray:
+        self.update_sats()
+        ends = points + np.array(box.size)
+        ends[:, 2] = points[:, 2]
+        begins = points.copy()
+        begins[:, 2] = np.maximum(points[:, 2] - 1, 0)
+        scores = (self._sat_count(self.used_sat, begins, ends) + self._pending_count(begins, ends, used=True)) / (box.size[0] * box.size[1])
+        return np.where(points[:, 2] == 0, 1.0, scores)
@@ -1,74 +1,488 @@
-from http.server import BaseHTTPRequestHandler, HTTPServer
-from socketserver import ThreadingMixIn
+from http import HTTPStatus
+import concurrent.futures
+import multiprocessing
+import threading
 import traceback
+import uuid
 import logging
+import asyncio
 import json
+import time
 import rch
+import rch_distributed
 import os
 
 PORT = os.environ.get('PORT', '8080')
+CACHE_SIZE = int(os.environ.get('CACHE_SIZE', '128'))
+CACHE_TTL = float(os.environ.get('CACHE_TTL', '3600'))
+# number of solves that run at the same time (each one in its own process)
+SOLVER_WORKERS = int(os.environ.get('SOLVER_WORKERS', str(os.cpu_count() or 1)))
+# number of solves that may wait for a free worker, more requests are rejected with 503
+QUEUE_SIZE = int(os.environ.get('QUEUE_SIZE', '16'))
+RETRY_AFTER = int(os.environ.get('RETRY_AFTER', '5'))
+MAX_BODY_SIZE = int(os.environ.get('MAX_BODY_SIZE', str(64 * 1024 * 1024)))
+# finished jobs are kept for JOB_TTL seconds
+JOB_TTL = float(os.environ.get('JOB_TTL', '3600'))
+# number of manifests in a single /api/solve/batch request
+MAX_BATCH_SIZE = int(os.environ.get('MAX_BATCH_SIZE', '1000'))
+# streamed responses are written in chunks of about this many characters
+STREAM_CHUNK_SIZE = 64 * 1024
 
-class RequestHandler(BaseHTTPRequestHandler):
-    def do_OPTIONS(self):
-        self.send_response(200)
-        self.send_header('Access-Control-Allow-Origin', '*')
-        self.send_header('Access-Control-Allow-Methods', 'GET, POST, OPTIONS')
-        self.send_header("Access-Control-Allow-Headers", "X-Requested-With, Content-Type") 
-        self.end_headers()
-    
-    def do_POST(self):
+CORS_HEADERS = {
+    'Access-Control-Allow-Origin': '*',
+    'Access-Control-Allow-Methods': 'GET, POST, DELETE, OPTIONS',
+    'Access-Control-Allow-Headers': 'X-Requested-With, Content-Type',
+}
+
+
+class HttpError(Exception):
+    def __init__(self, code: int, message: str = None, headers: dict = None):
+        super().__init__(message or HTTPStatus(code).phrase)
+        self.code = code
+        self.headers = headers or {}
+
+
+# stream is an async iterator of bytes, it is written as it's produced (instead of body)
+class Response:
+    def __init__(self, code: int = 200, body: bytes = b'', content_type: str = 'application/json', headers: dict = None, stream = None):
+        self.code = code
+        self.body = body
+        self.content_type = content_type
+        self.headers = headers or {}
+        self.stream = stream
+
+    @classmethod
+    def from_json(cls, data, code: int = 200):
+        return cls(code, json.dumps(data, indent=2).encode('utf-8'))
+
+    # the data is encoded (without whitespace) while it's written, the whole document is never held as a string
+    @classmethod
+    def from_json_stream(cls, data, code: int = 200):
+        async def chunks():
+            parts = []
+            size = 0
+            for part in json.JSONEncoder(separators=(',', ':')).iterencode(data):
+                parts.append(part)
+                size += len(part)
+                if size >= STREAM_CHUNK_SIZE:
+                    yield ''.join(parts).encode('utf-8')
+                    parts = []
+                    size = 0
+            if len(parts) > 0: yield ''.join(parts).encode('utf-8')
+        return cls(code, stream=chunks())
+
+
+# parses the body of a request, it must be a json document of the expected type (dict or list)
+def parse_body(body: bytes, expected: type):
+    try:
+        data = json.loads(body)
+    except (json.JSONDecodeError, UnicodeDecodeError) as e:
+        raise HttpError(400, f'Invalid JSON: {e}')
+    if type(data) != expected:
+        raise HttpError(400, 'Expected a list of manifests' if expected == list else 'Expected a JSON object')
+    return data
+
+
+# the compact format is streamed, the full format keeps the indented response
+def is_compact(input_data) -> bool:
+    return type(input_data) == dict and input_data.get('format') == 'compact'
+
+
+class QueueFull(Exception):
+    pass
+
+
+'''
+runs the solves on a fixed number of worker processes
+at most max_waiting solves wait for a free worker, any solve above that is rejected (QueueFull)
+'''
+class SolveQueue:
+    def __init__(self, workers: int, max_waiting: int):
+        self.workers = workers
+        self.max_waiting = max_waiting
+        self.executor = concurrent.futures.ProcessPoolExecutor(workers)
+        self.slots = asyncio.Semaphore(workers)
+        self.waiting = 0
+        self.running = 0
+        self.started = 0
+        self.rejected = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+
+    # the number of solves that can be admitted now, a free worker or a place in the queue each
+    def capacity(self) -> int:
+        return max(0, self.workers - self.running + self.max_waiting - self.waiting)
+
+    # reserves count places in the queue (or raises QueueFull when they don't all fit), each must be followed by run_admitted
+    def admit(self, count: int = 1) -> None:
+        if count > self.capacity():
+            self.rejected += 1
+            raise QueueFull()
+        self.waiting += count
+
+    async def run(self, function, *args):
+        self.admit()
+        return await self.run_admitted(function, *args)
+
+    async def run_admitted(self, function, *args):
+        enqueue_time = time.monotonic()
         try:
-            if self.path == '/api/solve':
-                # read data
-                content_len = int(self.headers.get('Content-Length'))
-                data = self.rfile.read(content_len)
-                parsed_data = json.loads(data)
-                # print(json.dumps(parsed_data, indent=2))
-                # find solution and parse to bytes
-                solution = rch.pack(parsed_data)
-                solution_str = json.dumps(solution, indent=2)
-                solution_bytes = solution_str.encode('utf-8')
-                
-                # 200 OK
-                self.send_response(code=200)
-                # set headers
-                self.send_header('Content-type', 'application/json')
-                self.send_header('Content-length', len(solution_bytes))
-                self.send_header('Access-Control-Allow-Origin', '*')
-                self.send_header('Access-Control-Allow-Methods', 'GET, POST, OPTIONS')
-                self.send_header("Access-Control-Allow-Headers", "X-Requested-With, Content-Type") 
-                self.end_headers()
-                # write solution json to body
-                self.wfile.write(solution_bytes)
-        except Exception as e:
-            traceback.print_exc()
-            print(e)
-            # 500 Internal Server Error
-            self.send_error(code=500)
-
-
-class ThreadedHTTPServer(ThreadingMixIn, HTTPServer):
-    """Handle requests in a separate thread."""
-
-
-def run(handler_class=RequestHandler, port=int(PORT)):
-    logging.basicConfig(level=logging.INFO)
-    server_address = ('', port)
-    httpd = ThreadedHTTPServer(server_address, handler_class)
+            await self.slots.acquire()
+        finally:
+            self.waiting -= 1
+        wait = time.monotonic() - enqueue_time
+        self.started += 1
+        self.total_wait += wait
+        self.max_wait = max(self.max_wait, wait)
+        self.running += 1
+        try:
+            result, metrics = await asyncio.get_running_loop().run_in_executor(self.executor, rch.run_with_metrics, function, *args)
+            rch.METRICS.merge(metrics)
+            return result
+        finally:
+            self.running -= 1
+            self.slots.release()
+
+    def stats(self) -> dict:
+        return {
+            'workers': self.workers,
+            'running': self.running,
+            'queue_depth': self.waiting,
+            'queue_size': self.max_waiting,
+            'started': self.started,
+            'rejected': self.rejected,
+            'average_wait': self.total_wait / self.started if self.started > 0 else 0.0,
+            'max_wait': self.max_wait,
+        }
+
+    def shutdown(self) -> None:
+        self.executor.shutdown(cancel_futures=True)
+
+
+'''
+a solve that runs in the background, the worker process reports every improvement through progress_queue
+events = the progress events so far (and the final event once the job is finished), for the event streams
+'''
+class Job:
+    FINISHED = ('done', 'failed', 'cancelled')
+
+    def __init__(self, manager):
+        self.id = uuid.uuid4().hex
+        self.status = 'queued'
+        self.iterations = 0
+        self.result = None
+        self.error = None
+        self.cancel_requested = False
+        self.finished_time = None
+        self.progress_queue = manager.Queue()
+        self.cancel_event = manager.Event()
+        self.events = []
+        self.changed = asyncio.Condition()
+
+    def is_finished(self) -> bool: return self.status in Job.FINISHED
+
+    def to_json(self) -> dict:
+        json_data = { 'id': self.id, 'status': self.status, 'iterations': self.iterations, 'result': self.result }
+        if self.error is not None: json_data['error'] = self.error
+        return json_data
+
+    async def add_event(self, event: str, data) -> None:
+        async with self.changed:
+            self.events.append((event, data))
+            self.changed.notify_all()
+
+    # yields the events from the first one, and waits for new ones until the job is finished
+    async def stream_events(self):
+        index = 0
+        while True:
+            async with self.changed:
+                await self.changed.wait_for(lambda: index < len(self.events))
+                events = self.events[index:]
+            index += len(events)
+            for event, data in events:
+                yield f'event: {event}\ndata: {json.dumps(data)}\n\n'.encode('utf-8')
+                if event in Job.FINISHED: return
+
+
+class SolveServer:
+    def __init__(self, workers: int = SOLVER_WORKERS, queue_size: int = QUEUE_SIZE):
+        self.cache = rch.SolutionCache(CACHE_SIZE, CACHE_TTL)
+        self.queue = SolveQueue(workers, queue_size)
+        self.jobs = {}
+        # the job queues and events are shared with the worker processes through a manager (started on the first job)
+        self.manager = None
+
+    def submit_job(self, input_data) -> Job:
+        packing_input = rch.prepare_input(input_data, self.queue.workers)
+        if self.manager is None:
+            self.manager = multiprocessing.Manager()
+        self.remove_expired_jobs()
+        job = Job(self.manager)
+        result = self.cache.get(packing_input)
+        if result is None:
+            self.queue.admit()
+        self.jobs[job.id] = job
+        asyncio.create_task(self.run_job(job, packing_input, result))
+        return job
+
+    async def run_job(self, job: Job, packing_input, cached_result) -> None:
+        if cached_result is not None:
+            job.result = cached_result
+            job.status = 'done'
+        else:
+            job.status = 'running'
+            progress = asyncio.create_task(self.forward_progress(job))
+            try:
+                job.result = await self.queue.run_admitted(rch.solve_job, packing_input, job.progress_queue, job.cancel_event)
+                if 'error' in job.result:
+                    job.error = job.result['error']
+                    job.result = None
+                job.status = 'cancelled' if job.cancel_requested else 'failed' if job.error is not None else 'done'
+                if job.status == 'done':
+                    self.cache.put(packing_input, job.result)
+            except Exception as e:
+                traceback.print_exc()
+                job.error = f'Exception: {e}'
+                job.status = 'failed'
+            # all the progress was reported before the solve returned, so the end marker comes after it
+            job.progress_queue.put(None)
+            await progress
+        job.finished_time = time.monotonic()
+        if job.result is not None: job.iterations = job.result['stats']['iterations']
+        await job.add_event(job.status, job.to_json())
+
+    # the progress queue is read by a thread of the job, a job that waits on the default executor of the loop
+    # would hold one of its threads, and the jobs after its max_workers wouldn't get their progress
+    async def forward_progress(self, job: Job) -> None:
+        loop = asyncio.get_running_loop()
+        updates = asyncio.Queue()
+        def receive() -> None:
+            while True:
+                progress = job.progress_queue.get()
+                loop.call_soon_threadsafe(updates.put_nowait, progress)
+                if progress is None: return
+        threading.Thread(target=receive, daemon=True).start()
+        while True:
+            progress = await updates.get()
+            if progress is None: return
+            job.iterations = progress['iterations']
+            job.result = progress['result']
+            await job.add_event('progress', progress)
+
+    def cancel_job(self, job: Job) -> None:
+        if job.is_finished(): return
+        job.cancel_requested = True
+        job.cancel_event.set()
+
+    def remove_expired_jobs(self) -> None:
+        now = time.monotonic()
+        for job_id in [job_id for job_id, job in self.jobs.items() if job.finished_time is not None and now - job.finished_time > JOB_TTL]:
+            del self.jobs[job_id]
+
+    def get_job(self, job_id: str) -> Job:
+        if job_id not in self.jobs: raise HttpError(404, 'Job not found')
+        return self.jobs[job_id]
+
+    def shutdown(self) -> None:
+        self.queue.shutdown()
+        if self.manager is not None:
+            self.manager.shutdown()
+
+    # the solve metrics (merged from the worker processes) and the queue and cache metrics, in the prometheus text format
+    def metrics(self) -> str:
+        queue = self.queue.stats()
+        cache = self.cache.stats()
+        gauges = [
+            ('queue_running', 'gauge', queue['running']),
+            ('queue_depth', 'gauge', queue['queue_depth']),
+            ('queue_started_total', 'counter', queue['started']),
+            ('queue_rejected_total', 'counter', queue['rejected']),
+            ('queue_max_wait_seconds', 'gauge', queue['max_wait']),
+            ('cache_size', 'gauge', cache['size']),
+            ('cache_hits_total', 'counter', cache['hits']),
+            ('cache_misses_total', 'counter', cache['misses']),
+            ('cache_evictions_total', 'counter', cache['evictions']),
+            ('jobs', 'gauge', len(self.jobs)),
+        ]
+        lines = []
+        for name, metric_type, value in gauges:
+            lines.append(f'# TYPE rch_{name} {metric_type}')
+            lines.append(f'rch_{name} {value}')
+        return rch.METRICS.to_prometheus() + '\n'.join(lines) + '\n'
+
+    # cache lookups happen here, only misses are sent to a worker process
+    async def solve(self, input_data):
+        packing_input = rch.prepare_input(input_data, self.queue.workers)
+        result = self.cache.get(packing_input)
+        if result is None:
+            result = await self.queue.run(rch_distributed.solve, packing_input)
+            self.cache.put(packing_input, result)
+        return result
+
+    # solves the manifests concurrently, the results are in the same order with an error result for any failed manifest
+    async def solve_batch(self, manifests: list) -> list:
+        results = [None] * len(manifests)
+        misses = []
+        for i, input_data in enumerate(manifests):
+            try:
+                packing_input = rch.prepare_input(input_data, self.queue.workers)
+            except Exception as e:
+                results[i] = rch.PackingResult(error=f'Exception: {e}').to_json()
+                continue
+            results[i] = self.cache.get(packing_input)
+            if results[i] is None: misses.append((i, packing_input))
+
+        if len(misses) > 0:
+            # the manifests that don't fit in the queue get an error result (the batch is rejected when none fits)
+            admitted = max(1, min(len(misses), self.queue.capacity()))
+            self.queue.admit(admitted)
+            for i, _ in misses[admitted:]:
+                results[i] = rch.PackingResult(error='Solver queue is full').to_json()
+            misses = misses[:admitted]
+            solved = await asyncio.gather(*[self.queue.run_admitted(rch_distributed.solve, packing_input) for _, packing_input in misses], return_exceptions=True)
+            for (i, packing_input), result in zip(misses, solved):
+                if isinstance(result, Exception):
+                    result = rch.PackingResult(error=f'Exception: {result}').to_json()
+                self.cache.put(packing_input, result)
+                results[i] = result
+        return results
+
+    async def dispatch(self, method: str, path: str, body: bytes) -> Response:
+        if method == 'OPTIONS':
+            return Response()
+        if method == 'POST' and path == '/api/solve':
+            input_data = parse_body(body, dict)
+            compact = is_compact(input_data)
+            try:
+                solution = await self.solve(input_data)
+            except QueueFull:
+                raise HttpError(503, 'Solver queue is full', { 'Retry-After': str(RETRY_AFTER) })
+            except rch.AdmissionRejected as e:
+                raise HttpError(413, str(e))
+            except rch.InvalidBudget as e:
+                raise HttpError(400, str(e))
+            return Response.from_json_stream(solution) if compact else Response.from_json(solution)
+        if method == 'POST' and path == '/api/solve/batch':
+            manifests = parse_body(body, list)
+            if len(manifests) > MAX_BATCH_SIZE: raise HttpError(413, f'At most {MAX_BATCH_SIZE} manifests per batch')
+            compact = any(is_compact(input_data) for input_data in manifests)
+            try:
+                solutions = await self.solve_batch(manifests)
+            except QueueFull:
+                raise HttpError(503, 'Solver queue is full', { 'Retry-After': str(RETRY_AFTER) })
+            return Response.from_json_stream(solutions) if compact else Response.from_json(solutions)
+        if method == 'GET' and path == '/metrics':
+            return Response(body=self.metrics().encode('utf-8'), content_type='text/plain; version=0.0.4')
+        if method == 'GET' and path == '/api/status':
+            return Response.from_json({ 'queue': self.queue.stats(), 'cache': self.cache.stats(), 'jobs': len(self.jobs) })
+        if path.startswith('/api/jobs'):
+            return await self.dispatch_job(method, path.strip('/').split('/')[2:], body)
+        raise HttpError(404)
+
+    # POST /api/jobs, GET /api/jobs/<id>, GET /api/jobs/<id>/events, DELETE /api/jobs/<id>
+    async def dispatch_job(self, method: str, path: list[str], body: bytes) -> Response:
+        if method == 'POST' and len(path) == 0:
+            try:
+                job = self.submit_job(parse_body(body, dict))
+            except QueueFull:
+                raise HttpError(503, 'Solver queue is full', { 'Retry-After': str(RETRY_AFTER) })
+            except rch.AdmissionRejected as e:
+                raise HttpError(413, str(e))
+            except rch.InvalidBudget as e:
+                raise HttpError(400, str(e))
+            # 202 Accepted
+            return Response.from_json(job.to_json(), 202)
+        if len(path) == 0: raise HttpError(404)
+        job = self.get_job(path[0])
+        if method == 'GET' and len(path) == 1:
+            return Response.from_json(job.to_json())
+        if method == 'GET' and path[1:] == ['events']:
+            return Response(content_type='text/event-stream', headers={ 'Cache-Control': 'no-cache' }, stream=job.stream_events())
+        if method == 'DELETE' and len(path) == 1:
+            self.cancel_job(job)
+            return Response.from_json(job.to_json(), 202)
+        raise HttpError(404)
+
+    async def handle_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        try:
+            try:
+                method, path, headers = await read_request_head(reader)
+                content_len = int(headers.get('content-length', '0'))
+                if content_len > MAX_BODY_SIZE: raise HttpError(413)
+                body = await reader.readexactly(content_len)
+                response = await self.dispatch(method, path.split('?', 1)[0], body)
+            except HttpError as e:
+                response = Response.from_json({ 'error': str(e) }, e.code)
+                response.headers.update(e.headers)
+            except (asyncio.IncompleteReadError, ConnectionError):
+                return
+            except Exception as e:
+                traceback.print_exc()
+                print(e)
+                # 500 Internal Server Error
+                response = Response.from_json({ 'error': 'Internal Server Error' }, 500)
+            await write_response(writer, response)
+        finally:
+            writer.close()
+
+
+async def read_request_head(reader: asyncio.StreamReader) -> tuple[str, str, dict]:
+    request_line = (await reader.readline()).decode('latin-1').strip()
+    if request_line == '': raise asyncio.IncompleteReadError(b'', None)
+    parts = request_line.split(' ')
+    if len(parts) != 3: raise HttpError(400)
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b'\r\n', b'\n', b''): break
+        name, _, value = line.decode('latin-1').partition(':')
+        headers[name.strip().lower()] = value.strip()
+    return parts[0], parts[1], headers
+
+
+async def write_response(writer: asyncio.StreamWriter, response: Response) -> None:
+    head = [f'HTTP/1.1 {response.code} {HTTPStatus(response.code).phrase}']
+    headers = dict(CORS_HEADERS, **response.headers)
+    headers['Content-Type'] = response.content_type
+    if response.stream is None:
+        headers['Content-Length'] = str(len(response.body))
+    headers['Connection'] = 'close'
+    head.extend(f'{name}: {value}' for name, value in headers.items())
+    writer.write(('\r\n'.join(head) + '\r\n\r\n').encode('latin-1'))
+    if response.stream is None:
+        writer.write(response.body)
+    else:
+        # the end of the stream is marked by closing the connection
+        async for chunk in response.stream:
+            writer.write(chunk)
+            await writer.drain()
+    await writer.drain()
+
+
+async def serve(port: int) -> None:
+    solve_server = SolveServer()
+    server = await asyncio.start_server(solve_server.handle_connection, '', port)
     logging.info('Starting server...\n')
     try:
-        httpd.serve_forever()
-    except KeyboardInterrupt:
-        pass
+        async with server:
+            await server.serve_forever()
     finally:
-        httpd.server_close()
+        solve_server.shutdown()
         logging.info('Stopping server...\n')
 
 
+def run(port=int(PORT)):
+    logging.basicConfig(level=logging.INFO)
+    try:
+        asyncio.run(serve(port))
+    except KeyboardInterrupt:
+        pass
+
+
 if __name__ == '__main__':
     from sys import argv
 
     if len(argv) == 2:
         run(port=int(argv[1]))
     else:
-        run()
\ No newline at end of file
+        run()
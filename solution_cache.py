@@ -0,0 +1,116 @@
+import collections
+import copy
+import threading
+import hashlib
+import json
+import time
+from packing import *
+
+
+class CacheEntry:
+    def __init__(self, result, budget: SolveBudget):
+        self.result = result
+        self.budget = budget
+        self.created = time.monotonic()
+
+
+'''
+cache of solved packings, keyed by a hash of the normalized (scaled) input
+the key ignores the order of the packages and the solve options (budget, cache mode, occupancy backend)
+entries are evicted by LRU once there are more than max_size of them, or once they are older than ttl seconds
+(the LRU order isn't the order of creation, so an expired entry is dropped when it's looked up, and the expired
+entries are swept once the oldest one may have expired)
+'''
+class SolutionCache:
+    def __init__(self, max_size: int = 128, ttl: float = 3600):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        # when the oldest entry expires (see _evict_expired)
+        self.next_sweep = 0.0
+
+    @staticmethod
+    def make_key(packing_input: PackingInput) -> str:
+        # a coarse input is keyed by its exact sizes (the results are in its units)
+        box_table = packing_input.real_box_table if packing_input.is_coarse() else packing_input.box_table
+        packages = sorted(
+            [kind.name, list(kind.size), kind.weight, kind.profit, kind.priority, [r.name for r in kind.rotations], kind.stackable, amount]
+            for kind, amount in zip(box_table.kinds, box_table.amounts)
+        )
+        containers = packing_input.real_containers if packing_input.is_coarse() else packing_input.containers
+        containers = [[list(container.size), container.weight_limit] for container in containers]
+        canonical = [containers, packing_input.is_fleet(), packing_input.preference, packages, packing_input.is_coarse() and [packing_input.grid, packing_input.compact], packing_input.output_format]
+        return hashlib.sha256(json.dumps(canonical).encode('utf-8')).hexdigest()
+
+    def _is_expired(self, entry: CacheEntry, now: float) -> bool:
+        return now - entry.created >= self.ttl
+
+    def _evict_expired(self) -> None:
+        now = time.monotonic()
+        if now < self.next_sweep: return
+        for key in [key for key, entry in self.entries.items() if self._is_expired(entry, now)]:
+            del self.entries[key]
+            self.evictions += 1
+        self.next_sweep = min((entry.created for entry in self.entries.values()), default=now) + self.ttl
+
+    # the compact solutions index the packages of the cached input, which may be in another order than the packages of
+    # the input (the key ignores the order), returns the result with the indices mapped by the type names to the packages
+    # (a copy, the cached result is shared by all the hits)
+    @staticmethod
+    def remap_types(result, packages):
+        type_index = {}
+        for i, pkg in enumerate(packages): type_index.setdefault(pkg['type'], i)
+        remap = [type_index[pkg['type']] for pkg in result['packages']]
+        if remap == list(range(len(remap))): return result
+        result = copy.deepcopy(result)
+        solutions = [container['solution'] for container in result['containers']] if 'containers' in result else [result['solution']]
+        for solution in solutions:
+            solution['type'] = [remap[i] for i in solution['type']]
+        return result
+
+    # returns the cached result json of the input (restamped with its scalar and packages), or None
+    # with cache mode 'budget' only results of a solve with at least the same time budget are used
+    def get(self, packing_input: PackingInput):
+        if packing_input.cache_mode == 'off': return None
+        key = self.make_key(packing_input)
+        with self.lock:
+            self._evict_expired()
+            entry = self.entries.get(key)
+            if entry is not None and self._is_expired(entry, time.monotonic()):
+                del self.entries[key]
+                self.evictions += 1
+                entry = None
+            if entry is None or (packing_input.cache_mode == 'budget' and not entry.budget.covers(packing_input.budget)):
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+        result = dict(entry.result)
+        if packing_input.output_format == 'compact':
+            result = dict(self.remap_types(entry.result, packing_input.original_json['packages']))
+        result['packages'] = PackingResult.packages_to_json(packing_input.original_json['packages'])
+        result['scalar'] = packing_input.scalar
+        result['grid'] = packing_input.grid
+        result['stats'] = dict(result['stats'], cached=True)
+        return result
+
+    def put(self, packing_input: PackingInput, result) -> None:
+        if packing_input.cache_mode == 'off' or self.max_size <= 0: return
+        if result is None or 'error' in result: return
+        key = self.make_key(packing_input)
+        with self.lock:
+            entry = CacheEntry(result, packing_input.budget)
+            self.entries[key] = entry
+            self.next_sweep = min(self.next_sweep, entry.created + self.ttl)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+    def stats(self) -> dict:
+        with self.lock:
+            return { 'size': len(self.entries), 'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions }
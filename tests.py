@@ -1,6 +1,25 @@
 import unittest
+import asyncio
+import threading
+import queue
+import random
+import time
+import json
+import copy
+import socket
+import pickle
 from rch_types import *
-from rch import combine
+from rch import combine, volume
+import rch
+import server
+import benchmark
+import rch_distributed
+import rch_admission
+import rch_used_space
+import numpy as np
+from rch_used_space import UsedSpace
+from rch_potential_points import PotentialPoints
+from solution_cache import SolutionCache
 
 
 def get_testing_box(size: Size, rotations: set(RotationType) = set(list(RotationType))) -> Box:
@@ -14,6 +33,22 @@ def get_testing_box(size: Size, rotations: set(RotationType) = set(list(Rotation
     )
 
 
+def get_testing_input(preference: str = 'volume') -> dict:
+    return {
+        'container': { 'width': 10, 'depth': 8, 'height': 6, 'maxWeight': 1000 },
+        'preference': preference,
+        'packages': [
+            { 'type': 'a', 'width': 4, 'depth': 3, 'height': 2, 'amount': 6, 'canRotate': True, 'canStackAbove': True, 'priority': 3, 'weight': 10, 'profit': 5 },
+            { 'type': 'b', 'width': 2, 'depth': 2, 'height': 2, 'amount': 8, 'canRotate': False, 'canStackAbove': True, 'priority': 1, 'weight': 4, 'profit': 2 },
+            { 'type': 'c', 'width': 5, 'depth': 4, 'height': 3, 'amount': 3, 'canRotate': True, 'canStackAbove': False, 'priority': 7, 'weight': 30, 'profit': 9 },
+        ]
+    }
+
+
+def get_testing_packing_input(preference: str = 'volume') -> PackingInput:
+    return rch.PackingInput(get_testing_input(preference), 1)
+
+
 class TestRotationMethods(unittest.TestCase):
     def test_rotations(self):
         size = (0, 1, 2)
@@ -114,5 +149,993 @@ class TestRotationMethods(unittest.TestCase):
         self.assertEqual(box.combination.second.position, (4, 1, 1))
 
 
+class TestParallelRch(unittest.TestCase):
+    def test_split_iterations(self):
+        self.assertEqual(rch.split_iterations(10, 4), [3, 3, 2, 2])
+        self.assertEqual(rch.split_iterations(2, 4), [1, 1])
+
+    def test_seeded_iterations_are_reproducible(self):
+        a, _ = rch.rch_iterations(get_testing_packing_input(), 5, seed=7)
+        b, _ = rch.rch_iterations(get_testing_packing_input(), 5, seed=7)
+        self.assertEqual([box.position for box in a.boxes], [box.position for box in b.boxes])
+
+    def test_parallel_result(self):
+        packing_input = get_testing_packing_input()
+        parallel, _ = rch.rch_parallel(packing_input, 8, 2, seed=7)
+        best = None
+        for i, n in enumerate(rch.split_iterations(8, 2 * rch.PARALLEL_CHUNKS_PER_WORKER)):
+            packing, _ = rch.rch_iterations(packing_input, n, seed=7 + i)
+            if packing.is_better_than(best, packing_input.preference): best = packing
+        self.assertEqual(parallel.used_space_ratio(), best.used_space_ratio())
+
+
+class TestSolveBudget(unittest.TestCase):
+    def test_iterations(self):
+        input_data = get_testing_input()
+        input_data['iterations'] = 3
+        result = rch.rch(rch.PackingInput(input_data, 1), workers=1, seed=1).to_json()
+        self.assertLessEqual(result['stats']['iterations'], 3)
+
+    def test_patience(self):
+        packing_input = get_testing_packing_input()
+        packing_input.budget = SolveBudget(patience=2)
+        packing_input.budget.start()
+        _, iterations = rch.rch_iterations(packing_input, 1000, seed=1)
+        self.assertLess(iterations, 1000)
+
+    def test_time_limit(self):
+        budget = SolveBudget(time_limit=0)
+        budget.start()
+        self.assertTrue(budget.is_exhausted(0))
+        self.assertFalse(SolveBudget().is_exhausted(10**6))
+
+    def test_invalid_budget(self):
+        for json_data in [{ 'iterations': -1 }, { 'iterations': 0 }, { 'patience': 0 }, { 'timeLimit': 0 },
+                          { 'timeLimit': -5 }, { 'timeLimit': 'nan' }, { 'iterations': 'many' }]:
+            with self.assertRaises(rch.InvalidBudget):
+                SolveBudget.from_json(json_data)
+        budget = SolveBudget.from_json({ 'iterations': 1, 'timeLimit': 0.5, 'patience': 1 })
+        self.assertEqual((budget.iterations, budget.time_limit, budget.patience), (1, 0.5, 1))
+
+    def test_invalid_budget_by_server(self):
+        async def run():
+            solve_server = server.SolveServer(workers=1, queue_size=1)
+            try:
+                input_data = get_testing_input()
+                input_data['iterations'] = -1
+                await solve_server.dispatch('POST', '/api/solve', json.dumps(input_data).encode('utf-8'))
+            finally:
+                solve_server.shutdown()
+        with self.assertRaises(server.HttpError) as context:
+            asyncio.run(run())
+        self.assertEqual(context.exception.code, 400)
+        self.assertIn('iterations', str(context.exception))
+
+
+class TestSolutionCache(unittest.TestCase):
+    def scaled_input(self, factor: int) -> dict:
+        input_data = get_testing_input()
+        input_data['iterations'] = 2
+        for dim in ['width', 'depth', 'height']:
+            input_data['container'][dim] *= factor
+            for pkg in input_data['packages']: pkg[dim] *= factor
+        return input_data
+
+    def test_key_ignores_order_and_scale(self):
+        input_data = self.scaled_input(3)
+        input_data['packages'].reverse()
+        a = rch.prepare_input(self.scaled_input(1))
+        b = rch.prepare_input(input_data)
+        self.assertEqual(SolutionCache.make_key(a), SolutionCache.make_key(b))
+        c = rch.prepare_input(get_testing_input('profit'))
+        self.assertNotEqual(SolutionCache.make_key(a), SolutionCache.make_key(c))
+
+    def test_hit_is_restamped(self):
+        cache = SolutionCache(max_size=4, ttl=60)
+        first = rch.pack(self.scaled_input(1), cache)
+        second = rch.pack(self.scaled_input(2), cache)
+        self.assertEqual(second['scalar'], 2)
+        self.assertTrue(second['stats']['cached'])
+        self.assertEqual(first['solution'], second['solution'])
+        self.assertEqual(cache.stats()['hits'], 1)
+
+    def test_opt_out_and_budget(self):
+        cache = SolutionCache(max_size=4, ttl=60)
+        input_data = self.scaled_input(1)
+        input_data['timeLimit'] = 1
+        rch.pack(input_data, cache)
+        input_data = self.scaled_input(1)
+        input_data['cache'] = 'off'
+        self.assertNotIn('cached', rch.pack(input_data, cache)['stats'])
+        input_data = self.scaled_input(1)
+        input_data['cache'] = 'budget'
+        input_data['timeLimit'] = 5
+        self.assertNotIn('cached', rch.pack(input_data, cache)['stats'])
+
+    def test_eviction(self):
+        cache = SolutionCache(max_size=1, ttl=60)
+        rch.pack(self.scaled_input(1), cache)
+        rch.pack(get_testing_input('profit'), cache)
+        self.assertEqual(cache.stats()['size'], 1)
+        self.assertEqual(cache.stats()['evictions'], 1)
+        cache.ttl = 0
+        self.assertIsNone(cache.get(rch.prepare_input(get_testing_input('profit'))))
+        self.assertEqual(cache.stats()['size'], 0)
+
+    def test_reordered_entry_expires(self):
+        cache = SolutionCache(max_size=4, ttl=60)
+        rch.pack(self.scaled_input(1), cache)
+        rch.pack(get_testing_input('profit'), cache)
+        # the first entry is now the most recently used one
+        self.assertIsNotNone(cache.get(rch.prepare_input(self.scaled_input(1))))
+        cache.entries[SolutionCache.make_key(rch.prepare_input(self.scaled_input(1)))].created -= 60
+        self.assertIsNone(cache.get(rch.prepare_input(self.scaled_input(1))))
+        self.assertIsNotNone(cache.get(rch.prepare_input(get_testing_input('profit'))))
+
+    def test_budget_covers_all_limits(self):
+        self.assertFalse(SolveBudget(iterations=10).covers(SolveBudget(time_limit=60)))
+        self.assertFalse(SolveBudget(patience=5).covers(SolveBudget(patience=50)))
+        self.assertFalse(SolveBudget().covers(SolveBudget(iterations=10)))
+        self.assertTrue(SolveBudget(iterations=20, patience=50).covers(SolveBudget(iterations=10, time_limit=5, patience=5)))
+        self.assertTrue(SolveBudget().covers(SolveBudget(time_limit=5)))
+
+    def test_invalid_cache_mode(self):
+        input_data = get_testing_input()
+        input_data['cache'] = 'of'
+        with self.assertRaises(ValueError):
+            rch.prepare_input(input_data)
+
+
+class TestSolveQueue(unittest.TestCase):
+    def test_full_queue_is_rejected(self):
+        async def run():
+            queue = server.SolveQueue(workers=1, max_waiting=0)
+            try:
+                results = await asyncio.gather(queue.run(time.sleep, 0.5), queue.run(time.sleep, 0.5), return_exceptions=True)
+            finally:
+                queue.shutdown()
+            return results, queue.stats()
+        results, stats = asyncio.run(run())
+        self.assertIsNone(results[0])
+        self.assertIsInstance(results[1], server.QueueFull)
+        self.assertEqual(stats['rejected'], 1)
+        self.assertEqual(stats['started'], 1)
+
+    def test_batch_larger_than_the_queue_is_rejected(self):
+        queue = server.SolveQueue(workers=1, max_waiting=2)
+        try:
+            with self.assertRaises(server.QueueFull):
+                queue.admit(4)
+            queue.admit(3)
+            self.assertEqual(queue.capacity(), 0)
+        finally:
+            queue.shutdown()
+
+
+class TestBenchmark(unittest.TestCase):
+    def test_generated_input_is_seeded(self):
+        scenario = benchmark.SCENARIOS[1]
+        self.assertEqual(benchmark.generate_input(scenario, 4), benchmark.generate_input(scenario, 4))
+        input_data = benchmark.generate_input(scenario, 4)
+        self.assertEqual(sum(pkg['amount'] for pkg in input_data['packages']), scenario['items'])
+        self.assertEqual(len(input_data['packages']), scenario['types'])
+
+    def test_phases_are_timed(self):
+        result = benchmark.run_scenario(benchmark.SCENARIOS[0], 2, seed=1)
+        self.assertEqual(result['phases']['construct_packing']['calls'], result['iterations'])
+        self.assertGreater(result['peak_memory'], 0)
+
+
+class TestMetrics(unittest.TestCase):
+    def test_solve_is_measured(self):
+        rch.METRICS.reset()
+        packing, iterations = rch.rch_iterations(get_testing_packing_input(), 3, seed=2)
+        metrics = rch.METRICS.snapshot()
+        self.assertEqual(metrics['timers']['construct_packing'][0], iterations)
+        self.assertEqual(metrics['counters']['iterations'], iterations)
+        self.assertGreaterEqual(metrics['counters']['boxes_placed'], len(packing.boxes))
+        self.assertGreater(metrics['counters']['points_evaluated'], 0)
+
+    def test_worker_metrics_are_merged(self):
+        rch.METRICS.reset()
+        _, iterations = rch.rch_parallel(get_testing_packing_input(), 8, 2, seed=7)
+        self.assertEqual(rch.METRICS.snapshot()['counters']['iterations'], iterations)
+
+    def test_prometheus_format(self):
+        metrics = rch.Metrics()
+        metrics.add_time('sort', 0.5)
+        metrics.merge({ 'timers': { 'sort': [2, 1.0] }, 'counters': { 'iterations': 4 } })
+        text = metrics.to_prometheus()
+        self.assertIn('rch_phase_seconds_total{phase="sort"} 1.5\n', text)
+        self.assertIn('rch_phase_calls_total{phase="sort"} 3\n', text)
+        self.assertIn('rch_iterations_total 4\n', text)
+
+
+class TestFleet(unittest.TestCase):
+    def get_fleet_input(self) -> dict:
+        input_data = get_testing_input()
+        del input_data['container']
+        input_data['containers'] = [{ 'width': 6, 'depth': 8, 'height': 6, 'maxWeight': 1000, 'count': 4 }]
+        input_data['iterations'] = 5
+        return input_data
+
+    def test_boxes_are_split_between_containers(self):
+        for workers in [1, 2]:
+            self.check_fleet(workers)
+
+    def check_fleet(self, workers: int):
+        packing_input = rch.prepare_input(self.get_fleet_input())
+        self.assertEqual(len(packing_input.containers), 4)
+        result = rch.rch_fleet(packing_input, workers=workers, seed=3).to_json()
+        stats = result['stats']
+        self.assertGreaterEqual(stats['containers_used'], 2)
+        self.assertEqual([container['index'] for container in result['containers']], list(range(stats['containers_used'])))
+        placed = {}
+        for container in result['containers']:
+            for box in container['solution']:
+                placed[box['type']] = placed.get(box['type'], 0) + 1
+        for pkg in get_testing_input()['packages']:
+            self.assertEqual(placed.get(pkg['type'], 0) + stats['unpacked'].get(pkg['type'], 0), pkg['amount'])
+
+    def test_fleet_input_is_scaled(self):
+        input_data = self.get_fleet_input()
+        for item in input_data['packages'] + input_data['containers']:
+            for dim in ['width', 'depth', 'height']: item[dim] *= 2
+        self.assertEqual(rch.get_scalar(input_data), 2)
+        packing_input = rch.prepare_input(copy.deepcopy(input_data))
+        self.assertEqual(packing_input.containers[0].size, (6, 8, 6))
+        input_data['containers'].append({ 'width': 13, 'depth': 16, 'height': 12, 'maxWeight': 1000 })
+        self.assertEqual(rch.get_scalar(input_data), 1)
+
+    def test_bound_stop_of_a_job_container(self):
+        # every container reaches its bound with two boxes, which stops its solve but not the job
+        input_data = {
+            'containers': [{ 'width': 4, 'depth': 3, 'height': 4, 'maxWeight': 1000, 'count': 3 }],
+            'iterations': 5,
+            'packages': [{ 'type': 'a', 'width': 4, 'depth': 3, 'height': 2, 'amount': 6, 'canRotate': True, 'canStackAbove': True, 'priority': 1, 'weight': 1, 'profit': 1 }],
+        }
+        for workers in [1, 2]:
+            cancel_event = threading.Event()
+            packing_input = rch.prepare_input(copy.deepcopy(input_data))
+            result = rch.rch_fleet(packing_input, workers, stop_event=rch.PolledEvent(cancel_event)).to_json()
+            self.assertEqual(result['stats']['containers_used'], 3)
+            self.assertFalse(cancel_event.is_set())
+        result = rch.solve_job(rch.prepare_input(copy.deepcopy(input_data)), queue.Queue(), threading.Event())
+        self.assertEqual(result['stats']['containers_used'], 3)
+        self.assertEqual(result['stats']['unpacked'], {})
+
+
+class TestCoarseResolution(unittest.TestCase):
+    def get_input(self) -> dict:
+        # sizes in mm with a gcd of 1, the exact voxel map would take 4.4 MB
+        input_data = get_testing_input()
+        for item in input_data['packages'] + [input_data['container']]:
+            for dim in ['width', 'depth', 'height']: item[dim] *= 10
+        input_data['packages'][0]['width'] = 37
+        input_data['container']['width'] = 103
+        input_data['resolution'] = 'coarse'
+        input_data['gridMemoryMB'] = 0.01
+        input_data['iterations'] = 5
+        return input_data
+
+    def assert_collision_free(self, packing: Packing) -> None:
+        boxes = packing.boxes
+        for i, a in enumerate(boxes):
+            for k in range(3): self.assertLessEqual(a.position[k] + a.size[k], packing.container.size[k])
+            for b in boxes[i + 1:]:
+                self.assertFalse(all(a.position[k] < b.position[k] + b.size[k] and b.position[k] < a.position[k] + a.size[k] for k in range(3)))
+
+    def test_exact_grid_when_it_fits(self):
+        input_data = self.get_input()
+        input_data['gridMemoryMB'] = 64
+        packing_input = rch.prepare_input(input_data)
+        self.assertEqual((packing_input.grid, packing_input.scalar), (1, 1))
+        self.assertFalse(packing_input.is_coarse())
+
+    def test_grid_fits_memory(self):
+        input_data = self.get_input()
+        packing_input = rch.prepare_input(copy.deepcopy(input_data))
+        self.assertTrue(packing_input.is_coarse())
+        size = packing_input.container.size
+        self.assertLessEqual(size[0] * size[1] * size[2] * rch.voxel_bytes(size), 0.01 * 2**20)
+        # the boxes are rounded up and the container down
+        self.assertEqual(size, tuple(dim // packing_input.grid for dim in (103, 80, 60)))
+        self.assertEqual(packing_input.box_table.kinds[0].size[0], -(-37 // packing_input.grid))
+        # the input keeps its units
+        self.assertEqual(packing_input.original_json['packages'][0]['width'], 37)
+
+    def test_solution_in_input_units(self):
+        for compact in [False, True]:
+            input_data = self.get_input()
+            input_data['compact'] = compact
+            packing_input = rch.prepare_input(input_data)
+            result = rch.rch(packing_input, workers=1, seed=2)
+            result_json = result.to_json()
+            self.assertEqual((result_json['scalar'], result_json['grid']), (1, packing_input.grid))
+            self.assertEqual(result_json['container']['width'], 103)
+            self.assertEqual(result_json['packages'][0]['width'], 37)
+            real_packing = result.real_packing()
+            self.assertEqual(len(real_packing.boxes), len(result_json['solution']))
+            self.assertTrue(all(box.kind in packing_input.real_box_table.kinds for box in real_packing.boxes))
+            self.assert_collision_free(real_packing)
+            if compact:
+                self.assertFalse(any(real_packing.used_space.is_floating(box) for box in real_packing.boxes))
+
+    def test_compaction_closes_the_gaps(self):
+        # two boxes of 3 (rounded to a cell of 5) side by side along x, and a third one on top of the first one
+        positions = rch.compact_positions(
+            np.array([(0, 0, 0), (1, 0, 0), (0, 0, 1)]), np.array([(1, 1, 1)] * 3), np.array([(3, 3, 3)] * 3),
+            np.array([True] * 3), cell_height=4, height=20
+        )
+        self.assertEqual(positions.tolist(), [[0, 0, 0], [3, 0, 0], [0, 0, 3]])
+        # nothing rests right on a non-stackable box
+        positions = rch.compact_positions(
+            np.array([(0, 0, 0), (0, 0, 2)]), np.array([(1, 1, 1)] * 2), np.array([(3, 3, 3)] * 2),
+            np.array([False, True]), cell_height=4, height=20
+        )
+        self.assertEqual(positions.tolist(), [[0, 0, 0], [0, 0, 4]])
+
+
+class TestBounds(unittest.TestCase):
+    def test_fractional_knapsack(self):
+        # (value, cost, amount)
+        self.assertEqual(rch.fractional_knapsack([(2, 1, 3), (10, 2, 1), (1, 1, 10)], 6), 10 + 6 + 1)
+        self.assertEqual(rch.fractional_knapsack([(3, 2, 1)], 1), 1.5)
+
+    def test_upper_bounds(self):
+        packing_input = get_testing_packing_input()
+        box_table = packing_input.box_table
+        # volume of the boxes = 144 + 64 + 180 < 480
+        self.assertAlmostEqual(rch.upper_bound(box_table, Container((10, 8, 6), 1000), 'volume'), 388 / 480)
+        container = Container((10, 8, 6), 100)
+        # volume per weight: a 2.4, b 2, c 2, so the weight limit of 100 is filled by a (60) and 40 more at 2
+        self.assertAlmostEqual(rch.upper_bound(box_table, container, 'volume'), (144 + 40 * 2) / 480)
+        # profit per weight: b 0.5, a 0.5, c 0.3, so the weight limit of 100 is filled by a and b (92) and 8 of c
+        self.assertAlmostEqual(rch.upper_bound(box_table, container, 'profit'), 30 + 16 + 8 * 9 / 30)
+        # only b fits in the container, and 27 / 8 of it by volume
+        self.assertEqual(rch.upper_bound(box_table, Container((3, 3, 3), 1000), 'priority'), 27 / 8)
+
+    def test_optimal_packing_stops_the_solve(self):
+        input_data = get_testing_input()
+        input_data['container'] = { 'width': 4, 'depth': 4, 'height': 4, 'maxWeight': 1000 }
+        input_data['packages'] = input_data['packages'][1:2]
+        input_data['packages'][0]['amount'] = 10
+        input_data['iterations'] = 50
+        result = rch.rch(rch.PackingInput(input_data, 1), workers=1, seed=1).to_json()
+        self.assertEqual(result['stats']['bound'], 1.0)
+        self.assertEqual(result['stats']['gap'], 0.0)
+        self.assertLess(result['stats']['iterations'], 50)
+
+    def test_packing_within_bound(self):
+        for preference in ['volume', 'profit', 'priority']:
+            result = rch.rch(get_testing_packing_input(preference), workers=1, seed=4).to_json()
+            self.assertGreaterEqual(result['stats']['gap'], 0.0)
+            self.assertLess(result['stats']['gap'], 1.0)
+
+
+class TestIncumbentPruning(unittest.TestCase):
+    def test_same_result_without_pruning(self):
+        results = []
+        for pruning in [False, True]:
+            rch.INCUMBENT_PRUNING = pruning
+            try:
+                for preference in ['volume', 'profit', 'priority']:
+                    packing, iterations = rch.rch_iterations(get_testing_packing_input(preference), 10, seed=9)
+                    results.append(([box.position for box in packing.boxes], iterations))
+            finally:
+                rch.INCUMBENT_PRUNING = True
+        self.assertEqual(results[:3], results[3:])
+
+    def test_unbeatable_incumbent(self):
+        packing_input = get_testing_packing_input()
+        boxes = packing_input.box_table.create_boxes()
+        # the boxes can fill at most 388 / 480 of the container
+        self.assertIsNone(rch.construct_packing(boxes, packing_input.container, incumbent_score=0.9))
+        self.assertIsNotNone(rch.construct_packing(boxes, packing_input.container, incumbent_score=0.5))
+
+    def test_heavy_boxes_are_dropped(self):
+        packing_input = get_testing_packing_input('profit')
+        boxes = packing_input.box_table.create_boxes()
+        bound = rch.OptimisticBound(boxes, Container((10, 8, 6), 50), 'profit')
+        self.assertEqual(bound.pending, 6 * 5 + 8 * 2 + 3 * 9)
+        bound.placed(boxes[0])
+        # 40 kg are left, the boxes of c (30 kg) still fit
+        self.assertEqual(bound.pending, 5 * 5 + 8 * 2 + 3 * 9)
+        bound.placed(boxes[1])
+        self.assertEqual(bound.pending, 4 * 5 + 8 * 2 + 3 * 9)
+        bound.placed(boxes[2])
+        # 20 kg are left
+        self.assertEqual(bound.pending, 3 * 5 + 8 * 2)
+
+
+class TestPrefixReuse(unittest.TestCase):
+    def test_same_result_without_reuse(self):
+        results = []
+        for reuse in [False, True]:
+            rch.PREFIX_REUSE = reuse
+            try:
+                for space_type in ['voxel', 'geometric']:
+                    packing_input = get_testing_packing_input('profit')
+                    packing_input.space_type = SpaceType(space_type)
+                    packing, iterations = rch.rch_iterations(packing_input, 10, seed=4)
+                    results.append(([(box.position, box.size) for box in packing.boxes], iterations))
+            finally:
+                rch.PREFIX_REUSE = True
+        self.assertEqual(results[:2], results[2:])
+
+    def test_known_sequence_is_replayed(self):
+        packing_input = get_testing_packing_input()
+        cache = rch.PrefixCache()
+        first = rch.construct_packing(packing_input.box_table.create_boxes(), packing_input.container, prefix_cache=cache)
+        boxes = packing_input.box_table.create_boxes()
+        packing = rch.Packing(packing_input.container)
+        prefix = cache.resume(boxes, packing, PotentialPoints([(0, 0, 0)]))
+        self.assertEqual(prefix.depth, len(boxes))
+        self.assertEqual([box.position for box in packing.boxes], [box.position for box in first.boxes])
+        self.assertEqual(packing.used_space.used_space_count, first.used_space.used_space_count)
+
+    def test_no_snapshot_larger_than_the_cache(self):
+        packing_input = get_testing_packing_input()
+        cache = rch.PrefixCache(max_bytes=1)
+        snapshot = rch.Packing.snapshot
+        def fail(*args): raise AssertionError('the snapshot was taken')
+        try:
+            rch.Packing.snapshot = fail
+            rch.construct_packing(packing_input.box_table.create_boxes(), packing_input.container, prefix_cache=cache)
+            # the same first boxes, the construction leaves the trie near the end
+            boxes = packing_input.box_table.create_boxes()
+            boxes[-1], boxes[-4] = boxes[-4], boxes[-1]
+            rch.construct_packing(boxes, packing_input.container, prefix_cache=cache)
+        finally:
+            rch.Packing.snapshot = snapshot
+        self.assertEqual(cache.state_bytes, 0)
+
+    def test_snapshot_is_not_changed_by_restored_packing(self):
+        for space_type in [SpaceType.VOXEL, SpaceType.GEOMETRIC]:
+            packing_input = get_testing_packing_input()
+            boxes = packing_input.box_table.create_boxes()
+            packing = rch.Packing(packing_input.container, space_type)
+            potential_points = PotentialPoints([(0, 0, 0)])
+            packing.add(boxes[0], (0, 0, 0), potential_points)
+            state = packing.snapshot(potential_points)
+            for _ in range(2):
+                packing.restore(state, boxes[:1], potential_points)
+                self.assertTrue(packing.can_be_added(boxes[1], (boxes[0].size[0], 0, 0)))
+                packing.add(boxes[1], (boxes[0].size[0], 0, 0), potential_points)
+                self.assertEqual(len(packing.boxes), 2)
+            self.assertFalse(packing.can_be_added(boxes[2], (boxes[0].size[0], 0, 0)))
+
+
+class TestDistributedRch(unittest.TestCase):
+    def get_input(self) -> PackingInput:
+        # the boxes don't all fit, so the solve runs all the iterations
+        input_data = get_testing_input()
+        input_data['container']['width'] = 8
+        input_data['iterations'] = 16
+        return rch.prepare_input(input_data)
+
+    def test_same_result_as_parallel_rch(self):
+        processes, addresses = rch_distributed.start_local_workers(2)
+        try:
+            result = rch_distributed.Coordinator(addresses).solve(self.get_input(), seed=11)
+            again = rch_distributed.Coordinator(addresses).solve(self.get_input(), seed=11)
+        finally:
+            for process in processes: process.terminate()
+        expected = rch.rch(self.get_input(), workers=2, seed=11).to_json()
+        self.assertEqual(result['solution'], expected['solution'])
+        self.assertEqual(again['solution'], expected['solution'])
+        self.assertEqual(result['stats']['iterations'], 16)
+
+    def test_unreachable_worker(self):
+        processes, addresses = rch_distributed.start_local_workers(2)
+        try:
+            processes[0].terminate()
+            processes[0].join()
+            result = rch_distributed.Coordinator(addresses).solve(self.get_input(), seed=11)
+        finally:
+            for process in processes: process.terminate()
+        self.assertEqual(result['stats']['iterations'], 16)
+
+    def test_cancel(self):
+        processes, addresses = rch_distributed.start_local_workers(1)
+        try:
+            input_data = get_testing_input()
+            input_data['container']['width'] = 8
+            input_data['iterations'] = 100000
+            stop_event = threading.Event()
+            threading.Timer(0.5, stop_event.set).start()
+            result = rch_distributed.Coordinator(addresses).solve(rch.prepare_input(input_data), seed=1, stop_event=stop_event)
+        finally:
+            for process in processes: process.terminate()
+        self.assertIn('solution', result)
+        self.assertLess(result['stats']['iterations'], 100000)
+
+    def test_rejects_unsigned_messages(self):
+        processes, addresses = rch_distributed.start_local_workers(1)
+        try:
+            with socket.create_connection(rch_distributed.parse_address(addresses[0])) as connection:
+                data = pickle.dumps(('close',))
+                connection.sendall(rch_distributed._HEADER.pack(len(data)) + bytes(rch_distributed._DIGEST_SIZE) + data)
+                connection.settimeout(5)
+                self.assertEqual(connection.recv(1), b'')
+        finally:
+            for process in processes: process.terminate()
+
+    def test_worker_needs_secret_on_other_hosts(self):
+        with self.assertRaises(ValueError):
+            rch_distributed.serve_worker(0, '')
+
+
+class TestSolveBatch(unittest.TestCase):
+    def test_results_in_order_with_errors(self):
+        manifests = [get_testing_input('volume'), { 'packages': [] }, get_testing_input('profit')]
+        for manifest in manifests: manifest['iterations'] = 2
+        async def run():
+            solve_server = server.SolveServer(workers=2, queue_size=0)
+            try:
+                response = await solve_server.dispatch('POST', '/api/solve/batch', json.dumps(manifests).encode('utf-8'))
+                return response.code, json.loads(response.body)
+            finally:
+                solve_server.shutdown()
+        code, results = asyncio.run(run())
+        self.assertEqual(code, 200)
+        self.assertEqual(len(results), 3)
+        self.assertIn('error', results[1])
+        for i in [0, 2]:
+            self.assertIn('solution', results[i])
+            self.assertLessEqual(results[i]['stats']['iterations'], 2)
+
+    def test_manifests_over_the_queue_get_errors(self):
+        manifests = [get_testing_input('volume'), get_testing_input('profit'), get_testing_input('priority')]
+        for manifest in manifests: manifest['iterations'] = 2
+        async def run():
+            solve_server = server.SolveServer(workers=1, queue_size=1)
+            try:
+                response = await solve_server.dispatch('POST', '/api/solve/batch', json.dumps(manifests).encode('utf-8'))
+                return json.loads(response.body)
+            finally:
+                solve_server.shutdown()
+        results = asyncio.run(run())
+        self.assertIn('solution', results[0])
+        self.assertIn('solution', results[1])
+        self.assertEqual(results[2]['error'], 'Solver queue is full')
+
+    def test_pack_reports_errors(self):
+        self.assertIn('error', rch.pack({ 'packages': [] }))
+
+    def test_invalid_body_is_rejected(self):
+        async def run(path: str, body: bytes):
+            solve_server = server.SolveServer(workers=1, queue_size=1)
+            try:
+                await solve_server.dispatch('POST', path, body)
+            finally:
+                solve_server.shutdown()
+        for path, body in [('/api/solve', b'{"packages": '), ('/api/solve', b'[]'), ('/api/solve/batch', b'not json'),
+                           ('/api/solve/batch', b'{}'), ('/api/jobs', b'\xff'), ('/api/jobs', b'3')]:
+            with self.assertRaises(server.HttpError) as context:
+                asyncio.run(run(path, body))
+            self.assertEqual(context.exception.code, 400, (path, body))
+
+
+class TestCompactFormat(unittest.TestCase):
+    def solve(self, output_format: str) -> dict:
+        input_data = get_testing_input()
+        input_data['format'] = output_format
+        return rch.rch(rch.prepare_input(input_data), workers=1, seed=6).to_json()
+
+    def test_same_solution_as_full_format(self):
+        full = self.solve('full')
+        compact = self.solve('compact')
+        columns = compact['solution']
+        self.assertEqual(len(columns['type']), len(full['solution']))
+        for i, box in enumerate(full['solution']):
+            self.assertEqual(compact['packages'][columns['type'][i]]['type'], box['type'])
+            self.assertEqual((columns['x'][i], columns['y'][i], columns['z'][i]), (box['x'], box['y'], box['z']))
+            self.assertEqual(compact['rotations'][columns['rotation'][i]], [box['rotation-x'], box['rotation-y'], box['rotation-z']])
+
+    def test_streamed_response(self):
+        input_data = get_testing_input()
+        input_data['format'] = 'compact'
+        input_data['iterations'] = 2
+        async def run():
+            solve_server = server.SolveServer(workers=1, queue_size=0)
+            try:
+                response = await solve_server.dispatch('POST', '/api/solve', json.dumps(input_data).encode('utf-8'))
+                self.assertEqual(response.body, b'')
+                return b''.join([chunk async for chunk in response.stream])
+            finally:
+                solve_server.shutdown()
+        result = json.loads(asyncio.run(run()))
+        self.assertEqual(sorted(result['solution']), ['rotation', 'type', 'x', 'y', 'z'])
+
+    def test_fleet_writes_rotations_once(self):
+        input_data = get_testing_input()
+        input_data['containers'] = [input_data.pop('container')] * 2
+        input_data['format'] = 'compact'
+        result = rch.rch_fleet(rch.prepare_input(input_data), workers=1, seed=1).to_json()
+        self.assertEqual(len(result['rotations']), 6)
+        self.assertTrue(all('rotations' not in container for container in result['containers']))
+
+    def test_cache_hit_of_reordered_packages(self):
+        def type_names(result, solution) -> list[str]:
+            return [result['packages'][i]['type'] for i in solution['type']]
+        for fleet in [False, True]:
+            input_data = get_testing_input()
+            input_data['format'] = 'compact'
+            if fleet: input_data['containers'] = [input_data.pop('container')] * 2
+            reordered = copy.deepcopy(input_data)
+            reordered['packages'].reverse()
+            cache = SolutionCache()
+            packing_input = rch.prepare_input(input_data)
+            result = (rch.rch_fleet if fleet else rch.rch)(packing_input, workers=1, seed=1).to_json()
+            cache.put(packing_input, result)
+            cached = cache.get(rch.prepare_input(reordered))
+            self.assertEqual(cached['packages'][0]['type'], 'c')
+            solutions = [(container['solution'], cached_container['solution']) for container, cached_container in zip(result['containers'], cached['containers'])] \
+                if fleet else [(result['solution'], cached['solution'])]
+            for solution, cached_solution in solutions:
+                self.assertEqual(type_names(cached, cached_solution), type_names(result, solution))
+            # the cached result isn't changed by the hit
+            self.assertEqual(cache.get(rch.prepare_input(copy.deepcopy(input_data))), dict(result, stats=dict(result['stats'], cached=True)))
+
+
+class TestAdmission(unittest.TestCase):
+    # the testing input with its sizes scaled so they don't share a divisor and the voxel map gets large
+    def large_input(self) -> dict:
+        input_data = get_testing_input()
+        for item in input_data['packages'] + [input_data['container']]:
+            for dimension in ('width', 'depth', 'height'): item[dimension] = int(item[dimension]) * 100 + 1
+        return input_data
+
+    def test_accepted(self):
+        packing_input = rch.prepare_input(get_testing_input())
+        self.assertEqual(packing_input.admission.to_json()['decision'], 'accepted')
+        self.assertIsNone(packing_input.budget.iterations)
+        result = rch.rch(packing_input, workers=1, seed=1).to_json()
+        self.assertEqual(result['stats']['admission']['actions'], [])
+
+    def test_too_many_items(self):
+        with self.assertRaises(rch.AdmissionRejected):
+            rch.admit(get_testing_input(), 1, 100, max_items=5)
+
+    def test_downscale_grid(self):
+        input_data = self.large_input()
+        admission = rch.admit(input_data, rch.get_scalar(input_data), 100, memory_limit=64, downscale=True)
+        self.assertEqual(admission.actions, ['downscale_grid'])
+        self.assertGreater(admission.grid, 1)
+        self.assertLessEqual(admission.estimate.memory, 64 * 2**20)
+        # the boxes alone don't fit
+        with self.assertRaises(rch.AdmissionRejected):
+            rch.admit(input_data, 1, 100, memory_limit=0.01, downscale=True)
+
+    def test_exact_resolution_is_not_downscaled(self):
+        input_data = self.large_input()
+        with self.assertRaises(rch.AdmissionRejected):
+            rch.admit(input_data, rch.get_scalar(input_data), 100, memory_limit=64)
+
+    def test_memory_is_shared_by_concurrent_solves(self):
+        input_data = self.large_input()
+        admission = rch.admit(input_data, rch.get_scalar(input_data), 100, memory_limit=64, downscale=True)
+        shared = rch.admit(input_data, rch.get_scalar(input_data), 100, memory_limit=64, downscale=True, concurrent_solves=4)
+        self.assertGreater(shared.grid, admission.grid)
+        self.assertLessEqual(shared.estimate.memory, 16 * 2**20)
+
+    def test_cap_iterations(self):
+        input_data = get_testing_input()
+        iteration_time = rch.CostEstimate.from_input(input_data, 1).iteration_time
+        admission = rch.admit(input_data, 1, 100, time_limit=10 * iteration_time)
+        self.assertEqual(admission.actions, ['cap_iterations'])
+        self.assertEqual(admission.iterations, 10)
+        # a timeLimit within the limit already bounds the solve
+        input_data['timeLimit'] = 5 * iteration_time
+        self.assertEqual(rch.admit(input_data, 1, 100, time_limit=10 * iteration_time).actions, [])
+        with self.assertRaises(rch.AdmissionRejected):
+            rch.admit(get_testing_input(), 1, 100, time_limit=iteration_time / 2)
+
+    def test_small_time_limit_with_a_long_iteration(self):
+        input_data = get_testing_input()
+        iteration_time = rch.CostEstimate.from_input(input_data, 1).iteration_time
+        # the first iteration runs past a small timeLimit, so it's checked as well
+        input_data['timeLimit'] = iteration_time / 100
+        with self.assertRaises(rch.AdmissionRejected):
+            rch.admit(input_data, 1, 100, time_limit=10 * iteration_time)
+        input_data['timeLimit'] = 1
+        with self.assertRaises(rch.AdmissionRejected):
+            rch.admit(input_data, 1, 100, time_limit=iteration_time / 2)
+
+    def test_rejected_by_server(self):
+        async def run():
+            solve_server = server.SolveServer(workers=1, queue_size=0)
+            try:
+                await solve_server.dispatch('POST', '/api/solve', json.dumps(get_testing_input()).encode('utf-8'))
+            finally:
+                solve_server.shutdown()
+        max_items = rch_admission.ADMISSION_MAX_ITEMS
+        try:
+            rch_admission.ADMISSION_MAX_ITEMS = 5
+            with self.assertRaises(server.HttpError) as context:
+                asyncio.run(run())
+            self.assertEqual(context.exception.code, 413)
+        finally:
+            rch_admission.ADMISSION_MAX_ITEMS = max_items
+
+
+class TestSolveJobs(unittest.TestCase):
+    def run_job(self, cancel: bool):
+        async def run():
+            solve_server = server.SolveServer(workers=1, queue_size=1)
+            try:
+                input_data = get_testing_input()
+                input_data['iterations'] = 20
+                response = await solve_server.dispatch('POST', '/api/jobs', json.dumps(input_data).encode('utf-8'))
+                self.assertEqual(response.code, 202)
+                job_id = json.loads(response.body)['id']
+                if cancel:
+                    await solve_server.dispatch('DELETE', f'/api/jobs/{job_id}', b'')
+                response = await solve_server.dispatch('GET', f'/api/jobs/{job_id}/events', b'')
+                events = [chunk.decode('utf-8') async for chunk in response.stream]
+                response = await solve_server.dispatch('GET', f'/api/jobs/{job_id}', b'')
+                return events, json.loads(response.body)
+            finally:
+                solve_server.shutdown()
+        return asyncio.run(run())
+
+    def test_progress_is_streamed(self):
+        events, job = self.run_job(cancel=False)
+        self.assertEqual(job['status'], 'done')
+        self.assertTrue(events[-1].startswith('event: done\n'))
+        self.assertTrue(all(event.startswith('event: progress\n') for event in events[:-1]))
+        self.assertGreater(len(events), 1)
+        self.assertIn('solution', job['result'])
+
+    def test_cancel(self):
+        events, job = self.run_job(cancel=True)
+        self.assertEqual(job['status'], 'cancelled')
+        self.assertTrue(events[-1].startswith('event: cancelled\n'))
+
+    def test_cancel_event_is_polled(self):
+        class CountingEvent(threading.Event):
+            calls = 0
+            def is_set(self):
+                self.calls += 1
+                return super().is_set()
+        event = CountingEvent()
+        polled = rch.PolledEvent(event, interval=60)
+        self.assertFalse(any(polled.is_set() for _ in range(100)))
+        self.assertEqual(event.calls, 1)
+        polled.set()
+        self.assertTrue(polled.is_set() and event.is_set())
+
+
+class TestGeometricSpace(unittest.TestCase):
+    def test_same_solution_as_voxel_space(self):
+        solutions = []
+        for space in ['voxel', 'geometric']:
+            input_data = get_testing_input()
+            input_data['space'] = space
+            result = rch.rch(rch.PackingInput(input_data, 1), workers=1, seed=3)
+            solutions.append(result.to_json()['solution'])
+        self.assertEqual(solutions[0], solutions[1])
+
+
+class TestUsedSpaceIndexes(unittest.TestCase):
+    def get_used_space(self) -> UsedSpace:
+        packing_input = get_testing_packing_input()
+        packing, _ = rch.rch_iterations(packing_input, 1, seed=5)
+        return packing.used_space
+
+    def test_height_map(self):
+        used_space = self.get_used_space()
+        occupied = used_space.used_space_map != UsedSpaceType.NOT_USED.value
+        heights = np.where(occupied.any(axis=2), used_space.size[2] - np.argmax(occupied[:, :, ::-1], axis=2), 0)
+        self.assertTrue(np.array_equal(used_space.height_map, heights))
+
+    def test_summed_area_table(self):
+        used_space = self.get_used_space()
+        occupied = used_space.used_space_map != UsedSpaceType.NOT_USED.value
+        for begin, end in [((0, 0, 0), used_space.size), ((1, 2, 1), (7, 5, 4)), ((3, 3, 3), (4, 4, 4))]:
+            expected = np.count_nonzero(occupied[begin[0]:end[0], begin[1]:end[1], begin[2]:end[2]])
+            self.assertEqual(used_space.occupied_count(begin, end), expected)
+
+
+class TestUnfloat(unittest.TestCase):
+    def get_packing(self, space_type: SpaceType) -> Packing:
+        # a column of boxes with gaps between them, placed top-first, on a non-stackable box
+        fragile = rch.BoxType('f', (4, 4, 3), 1, 1, 1, { RotationType.NONE }, False)
+        kind = rch.BoxType('a', (2, 2, 2), 1, 1, 1, { RotationType.NONE }, True)
+        packing = rch.Packing(Container((10, 10, 30), 1000), space_type)
+        potential_points = PotentialPoints()
+        boxes = [rch.Box(kind) for _ in range(5)] + [rch.Box(fragile)]
+        for i, box in enumerate(boxes):
+            box.set_position((0, 0, 25 - 5 * i))
+            packing.add(box, box.position, potential_points)
+        return packing
+
+    def test_stack_settles_in_one_pass(self):
+        for space_type in [SpaceType.VOXEL, SpaceType.GEOMETRIC]:
+            packing = self.get_packing(space_type)
+            packing.unfloat()
+            self.assertEqual([box.position[2] for box in packing.boxes], [11, 9, 7, 5, 3, 0])
+            self.assertFalse(any(packing.used_space.is_floating(box) for box in packing.boxes))
+
+    def test_indexes_after_unfloat(self):
+        packing = self.get_packing(SpaceType.VOXEL)
+        packing.unfloat()
+        used_space = packing.used_space
+        occupied = used_space.used_space_map != UsedSpaceType.NOT_USED.value
+        used = used_space.used_space_map == UsedSpaceType.USED.value
+        heights = np.where(occupied.any(axis=2), used_space.size[2] - np.argmax(occupied[:, :, ::-1], axis=2), 0)
+        self.assertTrue(np.array_equal(used_space.height_map, heights))
+        used_space.update_sats()
+        for sat, voxels in [(used_space.occupied_sat, occupied), (used_space.used_sat, used)]:
+            expected = voxels.cumsum(axis=0).cumsum(axis=1).cumsum(axis=2)
+            self.assertTrue(np.array_equal(sat[1:, 1:, 1:], expected))
+
+    def test_counts_wrap_around_the_table_type(self):
+        # more than 2**16 used voxels, the used voxels are counted in a uint16 table (the floor has 4800 cells)
+        used_space = UsedSpace((80, 60, 30))
+        self.assertEqual(used_space.used_sat.dtype, np.uint16)
+        self.assertEqual(UsedSpace.bytes_per_voxel(used_space.size), 1 + 4 + 2)
+        kind = rch.BoxType('a', (10, 10, 5), 1, 1, 1, { RotationType.NONE }, False)
+        for x in range(0, 80, 10):
+            for y in range(0, 60, 10):
+                for z in range(0, 24, 6):
+                    used_space.add(rch.Box(kind), (x, y, z))
+        self.assertGreater(used_space.used_space_count, 2**16)
+        points = np.array([(x, y, z) for x in range(0, 71, 7) for y in range(0, 51, 7) for z in range(0, 26, 3)])
+        box = rch.Box(kind)
+        for point, score, free in zip(points, used_space.get_support_scores(box, points), used_space.can_be_added_batch(box, points)):
+            point = tuple(int(value) for value in point)
+            self.assertEqual(score, used_space.get_support_score(box, point))
+            self.assertEqual(free, used_space.can_be_added(box, point))
+            end = tuple(point[i] + box.size[i] for i in range(3))
+            occupied = np.count_nonzero(used_space.used_space_map[point[0]:end[0], point[1]:end[1], point[2]:end[2]])
+            self.assertEqual(used_space.occupied_count(point, end), occupied)
+
+    def test_pending_cuboids_are_counted(self):
+        eager_voxels = rch_used_space.SAT_EAGER_VOXELS
+        try:
+            # every cuboid is kept pending until the tables are rebuilt
+            rch_used_space.SAT_EAGER_VOXELS = 0
+            used_space = UsedSpace((40, 30, 20))
+            stackable = rch.BoxType('a', (10, 10, 5), 1, 1, 1, { RotationType.NONE }, True)
+            fragile = rch.BoxType('f', (10, 10, 5), 1, 1, 1, { RotationType.NONE }, False)
+            box = rch.Box(stackable)
+            points = np.array([(x, y, z) for x in range(0, 31, 5) for y in range(0, 21, 5) for z in range(0, 16, 3)])
+            def check() -> None:
+                for point, score, free in zip(points, used_space.get_support_scores(box, points), used_space.can_be_added_batch(box, points)):
+                    point = tuple(int(value) for value in point)
+                    self.assertEqual(score, used_space.get_support_score(box, point))
+                    self.assertEqual(free, used_space.can_be_added(box, point))
+                    end = tuple(point[i] + box.size[i] for i in range(3))
+                    occupied = np.count_nonzero(used_space.used_space_map[point[0]:end[0], point[1]:end[1], point[2]:end[2]])
+                    self.assertEqual(used_space.occupied_count(point, end), occupied)
+            for i, (x, y) in enumerate([(0, 0), (10, 0), (0, 10), (20, 10)]):
+                used_space.add(rch.Box(fragile if i % 2 else stackable), (x, y, 0))
+            self.assertGreater(len(used_space.pending[0]), 0)
+            check()
+            snapshot = used_space.snapshot()
+            used_space.add(rch.Box(stackable), (0, 0, 5))
+            check()
+            used_space.restore(snapshot, [])
+            check()
+            used_space.update_sats(force=True)
+            self.assertEqual(len(used_space.pending[0]), 0)
+            check()
+        finally:
+            rch_used_space.SAT_EAGER_VOXELS = eager_voxels
+
+    def test_combined_boxes_move_together(self):
+        kind = rch.BoxType('a', (2, 2, 2), 1, 1, 1, { RotationType.NONE }, True)
+        box = combine(rch.Box(kind), rch.Box(kind), ['w', 'd'], 'lower')
+        packing = rch.Packing(Container((10, 10, 30), 1000))
+        box.set_position((0, 0, 6))
+        packing.add(box, box.position, PotentialPoints())
+        packing.unfloat()
+        self.assertEqual([real_box.position for real_box in box.get_all_real_boxes()], [(0, 0, 0), (0, 0, 2)])
+
+
+class TestBoxTable(unittest.TestCase):
+    def test_amounts(self):
+        box_table = get_testing_packing_input().box_table
+        self.assertEqual(len(box_table.kinds), 3)
+        self.assertEqual(len(box_table), 17)
+        self.assertEqual(len(box_table.create_boxes()), 17)
+
+    def test_sorted_table_matches_sorted_boxes(self):
+        box_table = get_testing_packing_input().box_table
+        for sorting_type in SortingType:
+            boxes = box_table.create_boxes()
+            rch.sort_boxes(boxes, sorting_type)
+            sorted_boxes = rch.sort_box_table(box_table, sorting_type).create_boxes()
+            self.assertEqual([box.kind for box in boxes], [box.kind for box in sorted_boxes])
+
+
+class TestPreprocessBoxes(unittest.TestCase):
+    # the quadratic pairing that combine_pass replaces
+    def reference_preprocess_boxes(self, boxes):
+        processed_boxes = []
+        combined_boxes = []
+        for i in range(len(boxes)):
+            for j in range(i + 1, len(boxes)):
+                a, b = boxes[i], boxes[j]
+                if not a.stackable or not b.stackable: continue
+                if a in combined_boxes or b in combined_boxes: continue
+                common_dims = a.get_common_dims(b)
+                if len(common_dims) >= 2:
+                    combined_boxes.extend([a, b])
+                    processed_boxes.append(combine(a, b, common_dims))
+        processed_boxes.extend([box for box in boxes if box not in combined_boxes])
+        return processed_boxes
+
+    def describe(self, boxes):
+        return [(box.size, [real_box.box_type for real_box in box.get_all_real_boxes()]) for box in boxes]
+
+    def test_same_pairs_as_reference(self):
+        input_data = get_testing_input()
+        input_data['packages'].append({ 'type': 'd', 'width': 4, 'depth': 3, 'height': 5, 'amount': 3, 'canRotate': True, 'canStackAbove': True, 'priority': 1, 'weight': 1, 'profit': 1 })
+        box_table = rch.PackingInput(input_data, 1).box_table
+        for seed in range(3):
+            rch.random.seed(seed)
+            expected = self.describe(self.reference_preprocess_boxes(box_table.create_boxes()))
+            rch.random.seed(seed)
+            actual = self.describe(rch.preprocess_boxes(box_table.create_boxes(), passes=1))
+            self.assertEqual(actual, expected)
+
+    def test_repeated_merging(self):
+        input_data = get_testing_input()
+        package = input_data['packages'][1]
+        input_data['packages'] = [dict(package, type=str(height), height=height, amount=1) for height in [1, 3, 4]]
+        box_table = rch.PackingInput(input_data, 1).box_table
+        self.assertEqual(len(rch.preprocess_boxes(box_table.create_boxes(), passes=1)), 2)
+        boxes = rch.preprocess_boxes(box_table.create_boxes(), passes=3)
+        self.assertEqual(len(boxes), 1)
+        self.assertEqual(volume(boxes[0].size), 2 * 2 * 8)
+        self.assertEqual(len(boxes[0].get_all_real_boxes()), 3)
+
+
+class TestPotentialPoints(unittest.TestCase):
+    def test_duplicates_and_eviction(self):
+        points = PotentialPoints([(0, 0, 0), (4, 0, 0)])
+        self.assertFalse(points.add((0, 0, 0)))
+        self.assertTrue(points.add((1, 1, 1)))
+        points.evict_covered((0, 0, 0), (2, 2, 2))
+        self.assertEqual(list(points), [(4, 0, 0)])
+
+    def test_eviction_looks_at_the_buckets(self):
+        rng = random.Random(3)
+        all_points = [(rng.randrange(100), rng.randrange(60), rng.randrange(40)) for _ in range(2000)]
+        points = PotentialPoints(all_points)
+        snapshot = points.snapshot()
+        for begin, end in [((10, 5, 0), (40, 35, 20)), ((0, 0, 0), (1, 1, 40)), ((90, 50, 30), (200, 200, 200)), ((0, 0, 0), (100, 60, 5))]:
+            expected = [p for p in points if not all(begin[i] <= p[i] < end[i] for i in range(3))]
+            points.evict_covered(begin, end)
+            self.assertEqual(list(points), expected)
+            self.assertEqual(sorted(p for bucket in points.buckets.values() for p in bucket), sorted(expected))
+        points.restore(snapshot)
+        self.assertEqual(len(points), len(set(all_points)))
+        points.remove(all_points[0])
+        self.assertEqual(sum(len(bucket) for bucket in points.buckets.values()), len(points))
+
+    def test_order(self):
+        points = PotentialPoints([(3, 0, 1), (1, 0, 2), (2, 0, 0), (0, 1, 1)])
+        self.assertEqual(points.ordered(True), [(2, 0, 0), (0, 1, 1), (3, 0, 1), (1, 0, 2)])
+        self.assertEqual(points.ordered(False), [(0, 1, 1), (1, 0, 2), (2, 0, 0), (3, 0, 1)])
+        self.assertEqual(points.as_array(True).tolist(), [[2, 0, 0], [0, 1, 1], [3, 0, 1], [1, 0, 2]])
+
+
+class TestBatchedPointEvaluation(unittest.TestCase):
+    def test_same_packing_as_sequential(self):
+        positions = []
+        for batched in [True, False]:
+            rch.BATCHED_POINT_EVALUATION = batched
+            try:
+                packing, _ = rch.rch_iterations(get_testing_packing_input(), 3, seed=11)
+            finally:
+                rch.BATCHED_POINT_EVALUATION = True
+            positions.append([box.position for box in packing.boxes])
+        self.assertEqual(positions[0], positions[1])
+
+
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file